@@ -21,6 +21,8 @@ install_requires = [
 extras_require={
                             'online' : ['pyacq',],
                             'opencl' : ['pyopencl'],
+                            'numba' : ['numba'],
+                            'blosc' : ['blosc'],
                         }
 
 long_description = ""
@@ -7,23 +7,21 @@
 .. automodule:: tridesclous.peeler
 
 
-
+Note that the GUI (PyQt5/pyqtgraph), matplotlib plots and neo based
+datasources are imported lazily on first access.
+So the core (DataIO, CatalogueConstructor, Peeler, ...) can be used
+headless and quickly in many process.
 
 """
-from .version import version as __version__
-
-import PyQt5 # this force pyqtgraph to deal with Qt5
+import importlib
+import sys
+import types
 
-# this avoid tinker problem when not installed
-import matplotlib
-matplotlib.use('Qt5Agg')
+from .version import version as __version__
 
 from .datasets import download_dataset, get_dataset
 
-#dynamic import 
-from .datasource import data_source_classes
-for c in data_source_classes.values():
-    globals()[c.__name__] = c
+from .datasource import data_source_classes, InMemoryDataSource, RawDataSource
 
 from .tools import open_prb
 from .dataio import DataIO
@@ -31,12 +29,53 @@ from .signalpreprocessor import offline_signal_preprocessor, estimate_medians_ma
 from .catalogueconstructor import CatalogueConstructor
 from .cataloguetools import apply_all_catalogue_steps
 from .peeler import Peeler
+from .peelertools import run_peeler_parallel, run_peelers_one_pass
 # from .peeler_cl import Peeler_OpenCl
 
 from .importers import import_from_spykingcircus
 
-from .matplotlibplot import *
 
+_lazy_names = {}
+for _name in ['plot_probe_geometry', 'plot_signals', 'plot_waveforms_with_geometry',
+                    'plot_waveforms', 'plot_features_scatter_2d']:
+    _lazy_names[_name] = 'matplotlibplot'
+for _name in ['QT', 'mkQApp',
+                    'CatalogueController', 'CatalogueTraceViewer', 'PeakList', 'ClusterPeakList',
+                    'NDScatter', 'WaveformViewer', 'SpikeSimilarityView', 'ClusterSimilarityView',
+                    'ClusterRatioSimilarityView', 'PairList', 'Silhouette', 'WaveformHistViewer',
+                    'FeatureTimeViewer', 'CatalogueWindow',
+                    'PeelerController', 'PeelerTraceViewer', 'SpikeList', 'ClusterSpikeList',
+                    'PeelerWaveformViewer', 'ISIViewer', 'CrossCorrelogramViewer', 'PeelerWindow',
+                    'MainWindow', 'InitializeDatasetWindow', 'ChannelGroupWidget', 'ProbeGeometryView']:
+    _lazy_names[_name] = 'gui'
+
+
+def _lazy_getattr(name):
+    if name in ('gui', 'matplotlibplot'):
+        return importlib.import_module('.' + name, __name__)
+
+    if name in _lazy_names:
+        module = importlib.import_module('.' + _lazy_names[name], __name__)
+        obj = getattr(module, name)
+        globals()[name] = obj
+        return obj
+
+    # datasource classes (neo based ones are registered on demand)
+    if name.endswith('DataSource') and name[:-len('DataSource')] in data_source_classes:
+        obj = data_source_classes[name[:-len('DataSource')]]
+        globals()[name] = obj
+        return obj
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class _LazyModule(types.ModuleType):
+    # module level __getattr__ (PEP 562) need python>=3.7, a module subclass work also for 3.6
+    def __getattr__(self, name):
+        return _lazy_getattr(name)
+
+sys.modules[__name__].__class__ = _LazyModule
 
-from .gui import *
 
+# "from tridesclous import *" also give lazy names (and so import the GUI)
+__all__ = [_name for _name in globals() if not _name.startswith('_')] + list(_lazy_names.keys())
@@ -19,9 +19,6 @@ import shutil
 import numpy as np
 import scipy.signal
 import scipy.interpolate
-import seaborn as sns
-sns.set_style("white")
-
 import sklearn
 
 from . import signalpreprocessor
@@ -30,12 +27,12 @@ from . import decomposition
 from . import cluster 
 from . import metrics
 
-from .tools import median_mad, get_pairs_over_threshold, int32_to_rgba, rgba_to_int32, make_color_dict
+from .tools import median_mad, get_pairs_over_threshold, int32_to_rgba, rgba_to_int32, make_color_dict, get_good_channel_mask
 
 
 from .iotools import ArrayCollection
 
-import matplotlib.pyplot as plt
+#~ import matplotlib.pyplot as plt
 
 from . import labelcodes
 
@@ -59,7 +56,7 @@ _reset_after_peak_arrays = ('some_peaks_index', 'some_waveforms',) + _reset_afte
 
 
 
-_persitent_arrays = ('all_peaks', 'signals_medians','signals_mads', 'clusters') + \
+_persitent_arrays = ('all_peaks', 'signals_medians','signals_mads', 'channel_mask', 'clusters') + \
                 _reset_after_peak_arrays
 
 
@@ -160,6 +157,7 @@ class CatalogueConstructor:
       * all_peaks (N, ) dtype = {0}
       * signals_medians (nb_sample, nb_channel, ) float32
       * signals_mads (nb_sample, nb_channel, ) float32
+      * channel_mask (nb_channel, ) bool (False for dead/noisy channels)
       * clusters (c, ) dtype= {1}
       * some_peaks_index (M) int64
       * some_waveforms (M, width, nb_channel) float32
@@ -261,6 +259,11 @@ class CatalogueConstructor:
             return 0
         return self.all_peaks.size
 
+    @property
+    def decimation_factor(self):
+        # index in processed signals = index in all_peaks // decimation_factor
+        return self.info.get('signal_preprocessor_params', {}).get('decimation_factor', 1)
+    
     @property
     def cluster_labels(self):
         if self.clusters is not None:
@@ -295,6 +298,8 @@ class CatalogueConstructor:
             memory_mode='memmap',
             
             internal_dtype = 'float32',
+            processed_signals_dtype=None,
+            processed_signals_storage='memmap',
             
             #signal preprocessor
             signalpreprocessor_engine='numpy',
@@ -302,8 +307,12 @@ class CatalogueConstructor:
             lowpass_freq=None,
             smooth_size=0,
             common_ref_removal=False,
+            common_ref_radius_um=100.,
             
             lostfront_chunksize=None,
+            noise_time_constant=None,
+            decimation_factor=1,
+            bad_channel_ratios=None,
             
             
             #peak detector
@@ -326,10 +335,26 @@ class CatalogueConstructor:
             Internal dtype for signals/waveforms/features.
             Support of intteger signal and waveform is planned for one day and should
             boost the process!!
-        signalpreprocessor_engine='numpy' or 'opencl'
+        processed_signals_dtype: None or 'int16'
+            dtype for storage of processed signals. None is internal_dtype.
+            'int16' store them quantized (0.01 MAD) and divide by 2 the disk usage, 
+            reading is done in internal_dtype (see DataIO.reset_processed_signals).
+            The Peeler use the same storage.
+        processed_signals_storage: 'memmap', 'compressed' or 'lazy'. default 'memmap'
+            'compressed' store processed signals in compressed chunks (see iotools.CompressedChunkArray):
+            less bytes to read/write on slow or shared disks but more CPU. 
+            'lazy' do not store them at all, they are recomputed from raw signals when read
+            (see DataIO.reset_processed_signals).
+            The Peeler use it also for processed signals (and spikes for 'compressed').
+        signalpreprocessor_engine='numpy', 'numpy_thread', 'numpy_inplace', 'fir', 'numba' or 'opencl'
             If you have pyopencl installed and correct ICD installed you can try
             'opencl' for high channel count some critial part of the processing is done on
             the GPU.
+            'numpy_thread' filter blocks of channels in parallel threads (high channel count
+            and many cores).
+            'numpy_inplace' filter in float32 without temporary arrays.
+            'fir' use a linear phase FIR with FFT overlap-save (latency lostfront_chunksize).
+            'numba' filter and normalize in one parallel numba kernel (numba must be installed).
         highpass_freq: float dfault 300
             High pass cut frquency of the filter. Can be None if the raw 
             dataset is already filtered.
@@ -340,14 +365,38 @@ class CatalogueConstructor:
         smooth_size: int default 0
             This a simple smooth convolution kernel. More or less act
             like a low pass filter. Can be use instead lowpass_freq.
-        common_ref_removal: bool. False by dfault.
+        common_ref_removal: bool or str. False by dfault.
             The remove the median of all channel sample by sample.
+            True or 'median' is the exact median, 'mean' is much faster, 'median_subset'
+            approximate the median with a subset of channels (fast for high channel count)
+            and 'local_mean' remove the mean of neighbour channels (see common_ref_radius_um).
+        common_ref_radius_um: float. default 100.
+            Radius of the neighborhood for common_ref_removal='local_mean'.
         lostfront_chunksize: int. default None
             size in sample of the margin at the front edge for each chunk to avoid border effect in backward filter.
             In you don't known put None then lostfront_chunksize will be int(sample_rate/highpass_freq)*3 which is quite robust (<5% error)
             compared to a true offline filtfilt.
-        peakdetector_engine: 'numpy' or 'opencl'
-            Engine for peak detection.
+        noise_time_constant: float or None. default None
+            None: medians and mads estimated by estimate_signals_noise are used for
+            normalization along the whole recording.
+            A time constant (in s) to follow noise drift: medians and mads are re-estimated 
+            online by the preprocessor (see signalpreprocessor.RunningNoiseEstimator) starting 
+            from estimate_signals_noise. The Peeler store the trajectory (see DataIO.get_noise_trajectory).
+        decimation_factor: int. default 1
+            Downsample processed signals by this factor after filtering (an anti alias lowpass at 
+            0.8 of the new nyquist replace lowpass_freq when needed). Peak detection, waveforms and the Peeler
+            then work at sample_rate/decimation_factor so n_left/n_right are in decimated samples.
+            Index in all_peaks and spikes are always in initial sample.
+            chunksize must be a multiple of decimation_factor.
+        bad_channel_ratios: None or (low_ratio, high_ratio). default None
+            None: all channels are used.
+            (low_ratio, high_ratio), for instance (0.1, 10.): estimate_signals_noise mark as bad the channels 
+            with a mad under low_ratio or over high_ratio times the median mad of all channels 
+            (see tools.get_good_channel_mask). Bad channels are skipped by the preprocessor, the peak 
+            detector and the Peeler (they are 0 in processed signals). The mask is the 'channel_mask' array.
+        peakdetector_engine: 'numpy', 'numba' or 'opencl'
+            Engine for peak detection. 'numba' with signalpreprocessor_engine='numba'
+            also compute the rectified sum in the preprocessing pass.
         peak_sign: '-' or '+'
             Signa of peak.
         relative_threshold: int default 7
@@ -368,28 +417,44 @@ class CatalogueConstructor:
         
         self.signal_preprocessor_params = dict(highpass_freq=highpass_freq, lowpass_freq=lowpass_freq, 
                         smooth_size=smooth_size, common_ref_removal=common_ref_removal,
-                        lostfront_chunksize=lostfront_chunksize, output_dtype=internal_dtype,
-                        signalpreprocessor_engine=signalpreprocessor_engine)
+                        common_ref_radius_um=common_ref_radius_um, lostfront_chunksize=lostfront_chunksize, output_dtype=internal_dtype,
+                        signalpreprocessor_engine=signalpreprocessor_engine,
+                        noise_time_constant=noise_time_constant, decimation_factor=decimation_factor)
+        assert chunksize % decimation_factor == 0, 'chunksize must be a multiple of decimation_factor'
         SignalPreprocessor_class = signalpreprocessor.signalpreprocessor_engines[signalpreprocessor_engine]
         self.signalpreprocessor = SignalPreprocessor_class(self.dataio.sample_rate, self.nb_channel, chunksize, self.dataio.source_dtype)
         
         
         self.peak_detector_params = dict(peak_sign=peak_sign, relative_threshold=relative_threshold, peak_span=peak_span)
         PeakDetector_class = peakdetector.peakdetector_engines[peakdetector_engine]
-        self.peakdetector = PeakDetector_class(self.dataio.sample_rate, self.nb_channel,
-                                                        self.chunksize, internal_dtype)
-        
-        #TODO make processed data as int32 ???
+        self.peakdetector = PeakDetector_class(self.dataio.sample_rate / decimation_factor, self.nb_channel,
+                                                        self.chunksize // decimation_factor, internal_dtype)
+        if peakdetector_engine == 'numba':
+            # rectified sum is computed while preprocessing when possible
+            self.peakdetector.link_preprocessor(self.signalpreprocessor)
+        
+        if processed_signals_dtype is None:
+            processed_signals_dtype = internal_dtype
+        assert processed_signals_storage in ('memmap', 'compressed', 'lazy')
         for i in range(self.dataio.nb_segment):
-            self.dataio.reset_processed_signals(seg_num=i, chan_grp=self.chan_grp, dtype=internal_dtype)
+            if processed_signals_storage == 'lazy':
+                # need signals_medians/signals_mads, done in run_signalprocessor_loop_one_segment
+                continue
+            self.dataio.reset_processed_signals(seg_num=i, chan_grp=self.chan_grp, dtype=processed_signals_dtype,
+                                    decimation_factor=decimation_factor, storage=processed_signals_storage)
         
         #~ self.nb_peak = 0
         
         # put all params in info
         self.info['internal_dtype'] = internal_dtype
+        self.info['processed_signals_dtype'] = processed_signals_dtype
+        self.info['processed_signals_storage'] = processed_signals_storage
         self.info['chunksize'] = chunksize
         self.info['signal_preprocessor_params'] = self.signal_preprocessor_params
         self.info['peak_detector_params'] = self.peak_detector_params
+        if bad_channel_ratios is not None:
+            bad_channel_ratios = [float(e) for e in bad_channel_ratios]
+        self.info['bad_channel_ratios'] = bad_channel_ratios
         self.flush_info()
     
     
@@ -414,15 +479,17 @@ class CatalogueConstructor:
         
         assert length<self.dataio.get_segment_length(seg_num), 'duration exeed size'
         
-        name = 'filetered_sigs_for_noise_estimation_seg_{}'.format(seg_num)
-        shape=(length - self.signal_preprocessor_params['lostfront_chunksize'], self.nb_channel)
-        filtered_sigs = self.arrays.create_array(name, self.info['internal_dtype'], shape, 'memmap')
-        
         params2 = dict(self.signal_preprocessor_params)
         params2.pop('signalpreprocessor_engine')
         params2['normalize'] = False
+        params2['geometry'] = self.geometry
         self.signalpreprocessor.change_params(**params2)
         
+        name = 'filetered_sigs_for_noise_estimation_seg_{}'.format(seg_num)
+        q = self.decimation_factor
+        shape=((length - self.signalpreprocessor.lostfront_chunksize + q - 1) // q, self.nb_channel)
+        filtered_sigs = self.arrays.create_array(name, self.info['internal_dtype'], shape, 'memmap')
+        
         iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=self.chan_grp, chunksize=self.chunksize, i_stop=length,
                                                     signal_type='initial')
         for pos, sigs_chunk in iterator:
@@ -437,6 +504,14 @@ class CatalogueConstructor:
         self.signals_medians[:] = signals_medians = np.median(filtered_sigs[:pos2], axis=0)
         self.signals_mads[:] = np.median(np.abs(filtered_sigs[:pos2]-signals_medians),axis=0)*1.4826
         
+        # dead or noisy channels
+        self.arrays.create_array('channel_mask', 'bool', (self.nb_channel,), 'memmap')
+        bad_channel_ratios = self.info.get('bad_channel_ratios', None)
+        if bad_channel_ratios is None:
+            self.channel_mask[:] = True
+        else:
+            self.channel_mask[:] = get_good_channel_mask(self.signals_mads, *bad_channel_ratios)
+        
         #detach filetered signals even if the file remains.
         self.arrays.detach_array(name)
         
@@ -455,7 +530,7 @@ class CatalogueConstructor:
             
             if chunk_peaks is not None:
                 peaks = np.zeros(chunk_peaks.size, dtype=_dtype_peak)
-                peaks['index'] = chunk_peaks
+                peaks['index'] = chunk_peaks * self.decimation_factor
                 peaks['segment'][:] = seg_num
                 peaks['cluster_label'][:] = labelcodes.LABEL_NO_WAVEFORM
                 self.arrays.append_chunk('all_peaks',  peaks)
@@ -480,9 +555,18 @@ class CatalogueConstructor:
         p['normalize'] = True
         p['signals_medians'] = self.signals_medians
         p['signals_mads'] = self.signals_mads
+        p['geometry'] = self.geometry
+        p['channel_mask'] = self.channel_mask
         self.signalpreprocessor.change_params(**p)
         
-        self.peakdetector.change_params(**self.peak_detector_params)
+        if self.info.get('processed_signals_storage', 'memmap') == 'lazy':
+            lazy_params = self.dataio.make_lazy_params(self.signal_preprocessor_params, self.chunksize,
+                                self.signals_medians, self.signals_mads,
+                                channel_mask=self.channel_mask, geometry=self.geometry)
+            self.dataio.reset_processed_signals(seg_num=seg_num, chan_grp=self.chan_grp, 
+                            decimation_factor=self.decimation_factor, storage='lazy', lazy_params=lazy_params)
+        
+        self.peakdetector.change_params(channel_mask=self.channel_mask, **self.peak_detector_params)
         
         iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=self.chan_grp, chunksize=self.chunksize, i_stop=length,
                                                     signal_type='initial')
@@ -539,7 +623,7 @@ class CatalogueConstructor:
         
         Parameters
         ----------
-        peakdetector_engine: 'numpy' or 'opencl'
+        peakdetector_engine: 'numpy', 'numba' or 'opencl'
             Engine for peak detection.
         peak_sign: '-' or '+'
             Signa of peak.
@@ -552,11 +636,12 @@ class CatalogueConstructor:
         """
         #TODO if not peak detector in class
         self.peak_detector_params = dict(peak_sign=peak_sign, relative_threshold=relative_threshold, peak_span=peak_span)
+        q = self.decimation_factor
         PeakDetector_class = peakdetector.peakdetector_engines[peakdetector_engine]
-        self.peakdetector = PeakDetector_class(self.dataio.sample_rate, self.nb_channel,
-                                                        self.info['chunksize'], self.info['internal_dtype'])
+        self.peakdetector = PeakDetector_class(self.dataio.sample_rate / q, self.nb_channel,
+                                                        self.info['chunksize'] // q, self.info['internal_dtype'])
 
-        self.peakdetector.change_params(**self.peak_detector_params)
+        self.peakdetector.change_params(channel_mask=self.channel_mask, **self.peak_detector_params)
         
         self.info['peak_detector_params'] = self.peak_detector_params
         self.flush_info()
@@ -567,16 +652,16 @@ class CatalogueConstructor:
         
         for seg_num in range(self.dataio.nb_segment):
             
-            self.peakdetector.change_params(**self.peak_detector_params)#this reset the fifo index
+            self.peakdetector.change_params(channel_mask=self.channel_mask, **self.peak_detector_params)#this reset the fifo index
             
             iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=self.chan_grp,
-                            chunksize=self.info['chunksize'], i_stop=None, signal_type='processed')
+                            chunksize=self.info['chunksize'] // q, i_stop=None, signal_type='processed')
             for pos, preprocessed_chunk in iterator:
                 n_peaks, chunk_peaks = self.peakdetector.process_data(pos, preprocessed_chunk)
             
                 if chunk_peaks is not None:
                     peaks = np.zeros(chunk_peaks.size, dtype=_dtype_peak)
-                    peaks['index'] = chunk_peaks
+                    peaks['index'] = chunk_peaks * q
                     peaks['segment'][:] = seg_num
                     peaks['cluster_label'][:] = labelcodes.LABEL_NO_WAVEFORM
                     self.arrays.append_chunk('all_peaks',  peaks)
@@ -662,7 +747,7 @@ class CatalogueConstructor:
         for seg_num in seg_nums:
             insegment_peaks  = self.all_peaks[some_peak_mask & (self.all_peaks['segment']==seg_num)]
             for peak in insegment_peaks:
-                i_start = peak['index']+n_left
+                i_start = peak['index']//self.decimation_factor+n_left
                 i_stop = i_start+peak_width
                 if align_waveform:
                     ratio = subsample_ratio
@@ -824,21 +909,22 @@ class CatalogueConstructor:
         #~ self.all_peaks
         #~ _dtype_peak = [('index', 'int64'), ('cluster_label', 'int64'), ('segment', 'int64'),]
         
+        q = self.decimation_factor
         some_noise_index = []
         n_by_seg = nb_snippet//self.dataio.nb_segment
         for seg_num in range(self.dataio.nb_segment):
             #~ length = self.dataio.get_segment_length(seg_num) #This is wrong
-            length = min(self.info['processed_length'], self.dataio.get_segment_length(seg_num))
+            length = min(self.info['processed_length'], self.dataio.get_segment_length(seg_num)) // q
             
             possibles = np.ones(length, dtype='bool')
             possibles[:peak_width] = False
             possibles[-peak_width:] = False
             peaks = self.all_peaks[self.all_peaks['segment']==seg_num]
             for peak in peaks:
-                possibles[peak['index']+n_left-n_right:peak['index']+n_right-n_left]
+                possibles[peak['index']//q+n_left-n_right:peak['index']//q+n_right-n_left]
             possible_indexes, = np.nonzero(possibles)
             noise_index = np.zeros(n_by_seg, dtype=_dtype_peak)
-            noise_index['index'] = possible_indexes[np.sort(np.random.choice(possible_indexes.size, size=n_by_seg))]
+            noise_index['index'] = possible_indexes[np.sort(np.random.choice(possible_indexes.size, size=n_by_seg))] * q
             noise_index['cluster_label'] = labelcodes.LABEL_NOISE
             noise_index['segment'][:] = seg_num
             some_noise_index.append(noise_index)
@@ -855,7 +941,7 @@ class CatalogueConstructor:
         #~ for seg_num in range(self.dataio.nb_segment):
             #~ insegment_indexes  = self.some_noise_index[(self.some_noise_index['segment']==seg_num)]
             #~ for ind in insegment_indexes:
-            i_start = ind['index']+n_left
+            i_start = ind['index']//q+n_left
             i_stop = i_start+peak_width
             snippet = self.dataio.get_signals_chunk(seg_num=ind['segment'], chan_grp=self.chan_grp, i_start=i_start, i_stop=i_stop, signal_type='processed')
             #~ print(i_start, i_stop, self.some_noise_snippet.shape, self.dataio.get_segment_length(ind['segment']))
@@ -1101,6 +1187,7 @@ class CatalogueConstructor:
             n = np.sum((self.clusters['cluster_label']>=0) & (self.clusters['color']==0))
 
         if n>0:
+            import seaborn as sns
             colors_int32 = np.array([rgba_to_int32(r,g,b) for r,g,b in sns.color_palette(palette, n)])
             
             if reset and interleaved and n>1:
@@ -1493,10 +1580,17 @@ class CatalogueConstructor:
         
         #params
         self.catalogue['signal_preprocessor_params'] = dict(self.info['signal_preprocessor_params'])
+        self.catalogue['processed_signals_dtype'] = self.info.get('processed_signals_dtype', self.info['internal_dtype'])
+        self.catalogue['processed_signals_storage'] = self.info.get('processed_signals_storage', 'memmap')
         self.catalogue['peak_detector_params'] = dict(self.info['peak_detector_params'])
         self.catalogue['clean_waveforms_params'] = dict(self.info['clean_waveforms_params'])
         self.catalogue['signals_medians'] = np.array(self.signals_medians, copy=True)
         self.catalogue['signals_mads'] = np.array(self.signals_mads, copy=True)
+        self.catalogue['geometry'] = np.array(self.geometry, copy=True)
+        if self.channel_mask is not None:
+            self.catalogue['channel_mask'] = np.array(self.channel_mask, copy=True)
+        else:
+            self.catalogue['channel_mask'] = np.ones(self.nb_channel, dtype='bool')
         
         
         t2 = time.perf_counter()
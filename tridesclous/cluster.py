@@ -15,7 +15,6 @@ from . import labelcodes
 from .tools import median_mad
 
 
-import matplotlib.pyplot as plt
 
 
 def find_clusters(catalogueconstructor, method='kmeans', selection=None, **kargs):
@@ -337,6 +336,7 @@ class SawChainCut:
                 count, _ = np.histogram(x, bins=self.bins)
                 count = count.astype(float)/np.sum(count)
                 
+                import matplotlib.pyplot as plt
                 filename = 'debug_sawchaincut/one_cut {}.png'.format(self.n_cut)
                 fig, ax = plt.subplots()
                 
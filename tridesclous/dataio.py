@@ -7,19 +7,35 @@
 
 import os, shutil
 import json
+import threading
 from collections import OrderedDict
 import numpy as np
-import pandas as pd
 from urllib.request import urlretrieve
 import pickle
 
 from .datasource import data_source_classes
 from .iotools import ArrayCollection
+from .signalpreprocessor import signalpreprocessor_engines
 from .tools import download_probe, create_prb_file_from_dict, fix_prb_file_py2
 from .export import export_list, export_dict
 
 _signal_types = ['initial', 'processed']
 
+# processed signals are normalized (unit is MAD) so int16 storage
+# give a 0.01 MAD resolution and a +-327 MAD range
+_default_quantization_scale = 0.01
+
+# see DataIO.set_chunk_cache
+_default_chunk_cache_block_size = 4096
+_default_chunk_cache_max_bytes = 256 * 1024**2
+
+# filter settling before each block of lazy processed signals
+_default_lazy_pre_roll_duration = 0.2
+
+# secondary indexes of spikes (see DataIO.get_spikes_in_time_range)
+_spikes_index_arrays = ['spikes_sorted_index', 'spikes_time_order', 'spikes_cluster_ranks', 'spikes_cluster_offsets']
+_dtype_cluster_offset = [('cluster_label', 'int64'), ('start', 'int64'), ('stop', 'int64')]
+
 
 
 
@@ -49,6 +65,12 @@ class DataIO:
     In each folder:
       * arrays.json describe the list of numpy array (name, dtype, shape)
       * XXX.raw are the raw numpy arrays and load with a simple memmap.
+      * XXX.zchunks + XXX.zindex for arrays stored in compressed chunks
+        (storage='compressed', see reset_processed_signals).
+      * processed_signals_lazy.json when processed signals are not stored but
+        computed on demand from raw signals (storage='lazy', see reset_processed_signals).
+      * XXX.length is the committed length of an array still being appended (spikes
+        while the Peeler is running), so it can be read from another process.
       * some array are struct arrays (aka array of struct)
       
     The datasource system is based on neo.rawio so all format in neo.rawio are
@@ -62,6 +84,8 @@ class DataIO:
     DataIO save the processed signals as float32 by default. So if
     you have a 10Go raw dataset tridesclous will need at least 20 Go more for storage
     of the processed signals.
+    Processed signals can also be stored quantized as int16 with one scale per channel
+    (see reset_processed_signals), this only need 10 Go more.
     
     
     **Usage**::
@@ -98,6 +122,20 @@ class DataIO:
     
     def __init__(self, dirname='test'):
         self.dirname = dirname
+        
+        # cache of signals blocks, disabled by default (see set_chunk_cache)
+        self._chunk_cache = OrderedDict()
+        self._chunk_cache_lock = threading.Lock()
+        self._chunk_cache_generation = 0
+        self._chunk_cache_nbytes = 0
+        self._chunk_cache_hits = 0
+        self._chunk_cache_misses = 0
+        self.chunk_cache_max_bytes = 0
+        self.chunk_cache_block_size = _default_chunk_cache_block_size
+        
+        # (chan_grp, seg_num) > list of (index, cluster_label) appended since reset_spikes
+        self._spikes_index_buffer = {}
+        
         if not os.path.exists(dirname):
             os.mkdir(dirname)
         
@@ -376,6 +414,9 @@ class DataIO:
 
     
     def _open_processed_data(self):
+        # arrays can have been written by others
+        self.clear_chunk_cache()
+        
         self.channel_group_path = {}
         self.segments_path = {}
         for chan_grp in self.channel_groups.keys():
@@ -398,8 +439,25 @@ class DataIO:
                 arrays = ArrayCollection(parent=None, dirname=self.segments_path[chan_grp][i])
                 self.arrays[chan_grp].append(arrays)
             
-                for name in ['processed_signals', 'spikes']:
+                for name in ['processed_signals', 'processed_signals_scale', 'processed_signals_decimation',
+                                    'spikes', 'noise_trajectory'] + _spikes_index_arrays:
                     self.arrays[chan_grp][i].load_if_exists(name)
+        
+        self._lazy_processed = {}
+        for chan_grp in self.channel_groups.keys():
+            self._lazy_processed[chan_grp] = []
+            for i in range(self.nb_segment):
+                filename = os.path.join(self.segments_path[chan_grp][i], 'processed_signals_lazy.json')
+                if os.path.exists(filename):
+                    with open(filename, 'r', encoding='utf8') as f:
+                        self._lazy_processed[chan_grp].append(json.load(f))
+                else:
+                    self._lazy_processed[chan_grp].append(None)
+        
+        if self.chunk_cache_max_bytes == 0 and \
+                any(lazy is not None for lazies in self._lazy_processed.values() for lazy in lazies):
+            # lazy blocks are expensive to compute
+            self.set_chunk_cache()
     
     def get_segment_length(self, seg_num):
         """
@@ -418,7 +476,7 @@ class DataIO:
     
     def get_signals_chunk(self, seg_num=0, chan_grp=0,
                 i_start=None, i_stop=None,
-                signal_type='initial'): #return_type='raw_numpy'
+                signal_type='initial', dequantize=True): #return_type='raw_numpy'
         """
         Get a chunk of signal for for a given segment index and channel group.
         
@@ -437,20 +495,24 @@ class DataIO:
             stop index (not included)
         signal_type: str
             'initial' or 'processed'
-        
-        
+        dequantize: bool (default True)
+            Only when 'processed' signals are stored quantized (int16).
+            If True return the float32 signals (stored * scale) else the stored int16
+            view, see get_processed_signals_scale.
         
         """
-        channels = self.channel_groups[chan_grp]['channels']
-        
-        if signal_type=='initial':
-            data = self.datasource.get_signals_chunk(seg_num=seg_num, i_start=i_start, i_stop=i_stop)
-            data = data[:, channels]
-        elif signal_type=='processed':
-            data = self.arrays[chan_grp][seg_num].get('processed_signals')[i_start:i_stop, :]
-        else:
+        if signal_type not in _signal_types:
             raise(ValueError, 'signal_type is not valide')
         
+        data = self._get_cached_signals(seg_num, chan_grp, i_start, i_stop, signal_type)
+        if data is None:
+            data = self._read_signals(seg_num, chan_grp, i_start, i_stop, signal_type)
+        
+        if signal_type=='processed':
+            scale = self.get_processed_signals_scale(seg_num=seg_num, chan_grp=chan_grp)
+            if dequantize and scale is not None:
+                data = data * scale
+        
         return data
         #~ if return_type=='raw_numpy':
             #~ return data
@@ -459,10 +521,217 @@ class DataIO:
         #~ elif return_type=='pandas':
             #~ raise(NotImplementedError)
 
-    def iter_over_chunk(self, seg_num=0, chan_grp=0,  i_stop=None, chunksize=1024, **kargs):
+    def _read_signals(self, seg_num, chan_grp, i_start, i_stop, signal_type):
+        # stored signals (not dequantized) without cache
+        if signal_type=='initial':
+            channels = self.channel_groups[chan_grp]['channels']
+            data = self.datasource.get_signals_chunk(seg_num=seg_num, i_start=i_start, i_stop=i_stop)
+            data = data[:, channels]
+        elif signal_type=='processed':
+            if self.is_processed_signals_lazy(seg_num=seg_num, chan_grp=chan_grp):
+                length = self.get_processed_signals_length(seg_num=seg_num, chan_grp=chan_grp)
+                i_start, i_stop, _ = slice(i_start, i_stop).indices(length)
+                data = self._compute_lazy_processed(seg_num, chan_grp, i_start, max(i_start, i_stop))
+            else:
+                data = self.arrays[chan_grp][seg_num].get('processed_signals')[i_start:i_stop, :]
+        return data
+    
+    def is_processed_signals_lazy(self, seg_num=0, chan_grp=0):
+        """
+        True when processed signals are computed on demand (storage='lazy').
+        """
+        return self._lazy_processed[chan_grp][seg_num] is not None
+    
+    def get_processed_signals_length(self, seg_num=0, chan_grp=0):
+        """
+        Length of processed signals (can be decimated).
+        """
+        lazy = self._lazy_processed[chan_grp][seg_num]
+        if lazy is not None:
+            return lazy['shape'][0]
+        return self.arrays[chan_grp][seg_num].get('processed_signals').shape[0]
+    
+    def make_lazy_params(self, signal_preprocessor_params, chunksize, signals_medians, signals_mads,
+                    channel_mask=None, geometry=None, pre_roll_duration=_default_lazy_pre_roll_duration):
+        """
+        Make lazy_params for reset_processed_signals(storage='lazy') from the preprocessor
+        params of the catalogue (same keys as catalogue['signal_preprocessor_params']).
+        """
+        lazy_params = dict(
+            signal_preprocessor_params=dict(signal_preprocessor_params),
+            chunksize=int(chunksize),
+            signals_medians=[float(e) for e in signals_medians],
+            signals_mads=[float(e) for e in signals_mads],
+            channel_mask=None if channel_mask is None else [bool(e) for e in channel_mask],
+            geometry=None if geometry is None else np.asarray(geometry, dtype='float64').tolist(),
+            pre_roll_duration=float(pre_roll_duration),
+        )
+        return lazy_params
+    
+    def _compute_lazy_processed(self, seg_num, chan_grp, i_start, i_stop):
+        # processed samples [i_start, i_stop[ from raw signals with a fresh preprocessor
+        lazy = self._lazy_processed[chan_grp][seg_num]
+        p = dict(lazy['signal_preprocessor_params'])
+        engine = p.pop('signalpreprocessor_engine', 'numpy')
+        chunksize = lazy['chunksize']
+        nb_channel = self.nb_channel(chan_grp)
+        dtype = p.get('output_dtype', 'float32')
+        p['normalize'] = True
+        p['signals_medians'] = np.array(lazy['signals_medians'], dtype=dtype)
+        p['signals_mads'] = np.array(lazy['signals_mads'], dtype=dtype)
+        if lazy['channel_mask'] is not None:
+            p['channel_mask'] = np.array(lazy['channel_mask'], dtype='bool')
+        if lazy['geometry'] is not None:
+            p['geometry'] = np.array(lazy['geometry'])
+        
+        SignalPreprocessor_class = signalpreprocessor_engines[engine]
+        preprocessor = SignalPreprocessor_class(self.sample_rate, nb_channel, chunksize, self.source_dtype)
+        preprocessor.change_params(**p)
+        q = preprocessor.decimation_factor
+        
+        out = np.zeros((i_stop - i_start, nb_channel), dtype=preprocessor.output_dtype)
+        if i_stop <= i_start:
+            return out
+        
+        # chunks on the same grid as a full run (multiple of chunksize)
+        length = self.get_segment_length(seg_num)
+        pre_roll = int(np.ceil(lazy['pre_roll_duration'] * self.sample_rate / chunksize)) * chunksize
+        pos = max((i_start * q) // chunksize * chunksize - pre_roll, 0)
+        # output are late of lostfront_chunksize
+        last = i_stop * q + preprocessor.lostfront_chunksize
+        while pos < last and pos + chunksize <= length:
+            pos += chunksize
+            sigs_chunk = self._read_signals(seg_num, chan_grp, pos - chunksize, pos, 'initial')
+            pos2, preprocessed_chunk = preprocessor.process_data(pos, sigs_chunk)
+            if preprocessed_chunk is None:
+                continue
+            ind0 = pos2 - preprocessed_chunk.shape[0]
+            i0 = max(ind0, i_start)
+            i1 = min(pos2, i_stop)
+            if i1 > i0:
+                out[i0 - i_start:i1 - i_start] = preprocessed_chunk[i0 - ind0:i1 - ind0]
+        
+        return out
+    
+    def set_chunk_cache(self, max_bytes=_default_chunk_cache_max_bytes, block_size=_default_chunk_cache_block_size):
+        """
+        Enable (or disable with max_bytes=0) a cache for get_signals_chunk.
+        
+        Signals are read by blocks of block_size samples aligned on multiple of block_size
+        and kept in memory (key is (seg_num, chan_grp, signal_type, block)) until max_bytes
+        is reached, then the least recently used blocks are removed.
+        This is useful when many small overlapping windows are read (trace viewers,
+        extract_some_waveforms, ...) on a slow storage. For a single sequential pass
+        (Peeler, preprocessing) the cache is useless so it is disabled by default.
+        Requests bigger than max_bytes/2 are not cached.
+        
+        Blocks of processed signals are invalidated when written with set_signals_chunk
+        or reset_processed_signals. If processed signals are written by another DataIO
+        (or process) clear_chunk_cache() must be called.
+        """
+        self.clear_chunk_cache()
+        self.chunk_cache_max_bytes = int(max_bytes)
+        self.chunk_cache_block_size = int(block_size)
+        self._chunk_cache_hits = 0
+        self._chunk_cache_misses = 0
+    
+    def clear_chunk_cache(self, seg_num=None, chan_grp=None, signal_type=None, i_start=None, i_stop=None):
+        """
+        Remove blocks from the cache of get_signals_chunk.
+        None is for all, i_start/i_stop limit to blocks that overlap this range.
+        """
+        bs = self.chunk_cache_block_size
+        with self._chunk_cache_lock:
+            self._chunk_cache_generation += 1
+            for key in list(self._chunk_cache.keys()):
+                seg_num_, chan_grp_, signal_type_, b = key
+                if seg_num is not None and seg_num_ != seg_num:
+                    continue
+                if chan_grp is not None and chan_grp_ != chan_grp:
+                    continue
+                if signal_type is not None and signal_type_ != signal_type:
+                    continue
+                if i_start is not None and (b + 1) * bs <= i_start:
+                    continue
+                if i_stop is not None and b * bs >= i_stop:
+                    continue
+                block = self._chunk_cache.pop(key)
+                self._chunk_cache_nbytes -= block.nbytes
+    
+    def get_chunk_cache_stats(self):
+        """
+        Return a dict with hits/misses (in blocks) and the memory used by the cache.
+        """
+        with self._chunk_cache_lock:
+            stats = dict(hits=self._chunk_cache_hits, misses=self._chunk_cache_misses,
+                    nb_block=len(self._chunk_cache), nbytes=self._chunk_cache_nbytes,
+                    max_bytes=self.chunk_cache_max_bytes, block_size=self.chunk_cache_block_size)
+        return stats
+    
+    def _get_cached_signals(self, seg_num, chan_grp, i_start, i_stop, signal_type):
+        # return None when the cache can not be used
+        if self.chunk_cache_max_bytes <= 0:
+            return None
+        
+        if signal_type=='initial':
+            length = self.get_segment_length(seg_num)
+            itemsize = np.dtype(self.source_dtype).itemsize
+        elif self.is_processed_signals_lazy(seg_num=seg_num, chan_grp=chan_grp):
+            length = self.get_processed_signals_length(seg_num=seg_num, chan_grp=chan_grp)
+            lazy = self._lazy_processed[chan_grp][seg_num]
+            itemsize = np.dtype(lazy['signal_preprocessor_params'].get('output_dtype', 'float32')).itemsize
+        else:
+            arr = self.arrays[chan_grp][seg_num].get('processed_signals')
+            length = arr.shape[0]
+            itemsize = arr.dtype.itemsize
+        # same bounds as numpy slicing
+        i_start, i_stop, _ = slice(i_start, i_stop).indices(length)
+        if i_stop <= i_start:
+            return None
+        
+        bs = self.chunk_cache_block_size
+        b0 = i_start // bs
+        b1 = (i_stop - 1) // bs + 1
+        block_nbytes = bs * self.nb_channel(chan_grp) * itemsize
+        if (b1 - b0) * block_nbytes > self.chunk_cache_max_bytes // 2:
+            return None
+        
+        out = None
+        for b in range(b0, b1):
+            key = (seg_num, chan_grp, signal_type, b)
+            with self._chunk_cache_lock:
+                block = self._chunk_cache.get(key, None)
+                if block is not None:
+                    self._chunk_cache.move_to_end(key)
+                    self._chunk_cache_hits += 1
+                generation = self._chunk_cache_generation
+            
+            if block is None:
+                block = np.array(self._read_signals(seg_num, chan_grp, b * bs, min((b + 1) * bs, length), signal_type))
+                with self._chunk_cache_lock:
+                    self._chunk_cache_misses += 1
+                    # not cached if invalidated while reading
+                    if generation == self._chunk_cache_generation and key not in self._chunk_cache:
+                        self._chunk_cache[key] = block
+                        self._chunk_cache_nbytes += block.nbytes
+                        while self._chunk_cache_nbytes > self.chunk_cache_max_bytes:
+                            _, old_block = self._chunk_cache.popitem(last=False)
+                            self._chunk_cache_nbytes -= old_block.nbytes
+            
+            if out is None:
+                out = np.empty((i_stop - i_start, block.shape[1]), dtype=block.dtype)
+            s0 = max(i_start, b * bs)
+            s1 = min(i_stop, (b + 1) * bs)
+            out[s0 - i_start:s1 - i_start] = block[s0 - b * bs:s1 - b * bs]
+        
+        return out
+    
+    def iter_over_chunk(self, seg_num=0, chan_grp=0,  i_stop=None, chunksize=1024, i_start=None, **kargs):
         """
         Create an iterable on signals. ('initial' or 'processed')
         
+        i_start (default 0) is the start of the first chunk.
+        
         Usage
         ----------
         
@@ -470,15 +739,23 @@ class DataIO:
                 do_something_on_chunk(sig_chunk)
         
         """
+        if kargs.get('signal_type', 'initial') == 'processed':
+            # can be decimated
+            full_length = self.get_processed_signals_length(seg_num=seg_num, chan_grp=chan_grp)
+        else:
+            full_length = self.get_segment_shape(seg_num, chan_grp=chan_grp)[0]
         if i_stop is not None:
-            length = min(self.get_segment_shape(seg_num, chan_grp=chan_grp)[0], i_stop)
+            length = min(full_length, i_stop)
         else:
-            length = self.get_segment_shape(seg_num, chan_grp=chan_grp)[0]
+            length = full_length
         
+        if i_start is None:
+            i_start = 0
         
-        nloop = length//chunksize
+        nloop = (length - i_start)//chunksize
+        first = i_start
         for i in range(nloop):
-            i_stop = (i+1)*chunksize
+            i_stop = first + (i+1)*chunksize
             i_start = i_stop - chunksize
             sigs_chunk = self.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp, i_start=i_start, i_stop=i_stop, **kargs)
             yield  i_stop, sigs_chunk
@@ -490,12 +767,126 @@ class DataIO:
             #~ sigs_chunk = self.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp, i_start=i_start, i_stop=i_stop, **kargs)
             #~ yield  i_stop, sigs_chunk
     
-    def reset_processed_signals(self, seg_num=0, chan_grp=0, dtype='float32'):
+    def iter_over_chunk_multi_group(self, seg_num=0, chan_grps=None, i_stop=None, chunksize=1024, i_start=None):
+        """
+        Same as iter_over_chunk for 'initial' signals but for several channel groups at once.
+        Each raw chunk is read only once from the datasource and then splitted
+        for each channel group.
+        
+        Usage
+        ----------
+        
+            for ind, sigs_chunks in data.iter_over_chunk_multi_group(seg_num=0, chan_grps=[0, 1], chunksize=1024):
+                for chan_grp, sig_chunk in sigs_chunks.items():
+                    do_something_on_chunk(chan_grp, sig_chunk)
+        
+        """
+        if chan_grps is None:
+            chan_grps = list(self.channel_groups.keys())
+        all_channels = {chan_grp: self.channel_groups[chan_grp]['channels'] for chan_grp in chan_grps}
+        
+        length = self.get_segment_length(seg_num)
+        if i_stop is not None:
+            length = min(length, i_stop)
+        
+        if i_start is None:
+            i_start = 0
+        
+        nloop = (length - i_start)//chunksize
+        first = i_start
+        for i in range(nloop):
+            i_stop = first + (i+1)*chunksize
+            i_start = i_stop - chunksize
+            data = self.datasource.get_signals_chunk(seg_num=seg_num, i_start=i_start, i_stop=i_stop)
+            # read once (memmap) all channels
+            data = np.array(data)
+            sigs_chunks = {chan_grp: data[:, channels] for chan_grp, channels in all_channels.items()}
+            yield  i_stop, sigs_chunks
+    
+    def reset_processed_signals(self, seg_num=0, chan_grp=0, dtype='float32', quantization_scale=None,
+                    decimation_factor=1, storage='memmap', lazy_params=None):
         """
         Reset processed signals.
+        
+        When dtype is an integer type ('int16') processed signals are stored quantized:
+        stored = round(signals / scale) with one scale per channel.
+        quantization_scale is a float or an array (one per channel), default is 0.01
+        (processed signals are normalized so 0.01 MAD).
+        
+        With decimation_factor>1 processed signals are stored decimated: processed sample i
+        is the initial sample i*decimation_factor (see get_processed_signals_decimation).
+        
+        storage is 'memmap' (default) or 'compressed': processed signals are stored
+        in compressed chunks (see iotools.CompressedChunkArray), reading is slower for CPU
+        but less bytes are read from the disk. Several process must not write in the same
+        'compressed' array.
+        
+        storage='lazy' do not store processed signals at all: get_signals_chunk compute
+        them on demand from the raw signals with the same preprocessing chain
+        (see make_lazy_params) starting pre_roll_duration before each block to settle
+        filters. Blocks are kept in the chunk cache (see set_chunk_cache).
+        Writes (set_signals_chunk) are ignored, dtype and quantization_scale are not used.
+        Results can very slightly differ from stored signals because of the filter warm-up.
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        shape = self.get_segment_shape(seg_num, chan_grp=chan_grp)
+        q = int(decimation_factor)
+        shape = ((shape[0] + q - 1) // q, shape[1])
+        assert storage in ('memmap', 'compressed', 'lazy'), 'storage must be memmap, compressed or lazy'
+        self.clear_chunk_cache(seg_num=seg_num, chan_grp=chan_grp, signal_type='processed')
+        
+        lazy_filename = os.path.join(self.segments_path[chan_grp][seg_num], 'processed_signals_lazy.json')
+        if storage == 'lazy':
+            assert lazy_params is not None, 'storage lazy need lazy_params (see make_lazy_params)'
+            assert lazy_params['signal_preprocessor_params'].get('decimation_factor', 1) == q, 'decimation_factor mismatch'
+            lazy = dict(lazy_params)
+            lazy['shape'] = list(shape)
+            with open(lazy_filename, 'w', encoding='utf8') as f:
+                json.dump(lazy, f, indent=4)
+            self._lazy_processed[chan_grp][seg_num] = lazy
+            # this is the point of lazy
+            arrays.delete_array('processed_signals')
+            if self.chunk_cache_max_bytes == 0:
+                self.set_chunk_cache()
+        else:
+            if os.path.exists(lazy_filename):
+                os.remove(lazy_filename)
+            self._lazy_processed[chan_grp][seg_num] = None
+            arrays.create_array('processed_signals', dtype, shape, storage)
+        
+        if q > 1:
+            arrays.add_array('processed_signals_decimation', np.array([q], dtype='int64'), 'memmap')
+        else:
+            arrays.detach_array('processed_signals_decimation')
+        if np.dtype(dtype).kind in 'iu' and storage != 'lazy':
+            if quantization_scale is None:
+                quantization_scale = _default_quantization_scale
+            scale = np.zeros(shape[1], dtype='float32')
+            scale[:] = quantization_scale
+            assert np.all(scale>0), 'quantization_scale must be positive'
+            arrays.add_array('processed_signals_scale', scale, 'memmap')
+        else:
+            arrays.detach_array('processed_signals_scale')
+    
+    def get_processed_signals_scale(self, seg_num=0, chan_grp=0):
         """
-        self.arrays[chan_grp][seg_num].create_array('processed_signals', dtype, 
-                            self.get_segment_shape(seg_num, chan_grp=chan_grp), 'memmap')
+        Return the per channel scale of quantized processed signals
+        or None when they are stored as float.
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        if 'processed_signals_scale' not in arrays.keys():
+            return None
+        return arrays.get('processed_signals_scale')
+    
+    def get_processed_signals_decimation(self, seg_num=0, chan_grp=0):
+        """
+        Return the decimation factor of processed signals (1 when not decimated).
+        Index in processed signals = index in initial signals // decimation.
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        if 'processed_signals_decimation' not in arrays.keys():
+            return 1
+        return int(arrays.get('processed_signals_decimation')[0])
     
     def set_signals_chunk(self,sigs_chunk, seg_num=0, chan_grp=0, i_start=None, i_stop=None, signal_type='processed'):
         """
@@ -504,21 +895,40 @@ class DataIO:
         assert signal_type != 'initial'
 
         if signal_type=='processed':
+            if self.is_processed_signals_lazy(seg_num=seg_num, chan_grp=chan_grp):
+                # computed on demand
+                return
+            self.clear_chunk_cache(seg_num=seg_num, chan_grp=chan_grp, signal_type='processed',
+                                i_start=i_start, i_stop=i_stop)
             data = self.arrays[chan_grp][seg_num].get('processed_signals')
+            scale = self.get_processed_signals_scale(seg_num=seg_num, chan_grp=chan_grp)
+            if scale is not None:
+                # quantize
+                info = np.iinfo(data.dtype)
+                sigs_chunk = sigs_chunk / scale
+                np.rint(sigs_chunk, out=sigs_chunk)
+                np.clip(sigs_chunk, info.min, info.max, out=sigs_chunk)
             data[i_start:i_stop, :] = sigs_chunk
         
     def flush_processed_signals(self, seg_num=0, chan_grp=0):
         """
-        Flush the underlying memmap for processed signals.
+        Flush the underlying memmap (or compressed chunks) for processed signals.
         """
+        if self.is_processed_signals_lazy(seg_num=seg_num, chan_grp=chan_grp):
+            return
         self.arrays[chan_grp][seg_num].flush_array('processed_signals')
     
-    def reset_spikes(self, seg_num=0,  chan_grp=0, dtype=None):
+    def reset_spikes(self, seg_num=0,  chan_grp=0, dtype=None, storage='memmap'):
         """
         Reset spikes.
+        storage is 'memmap' or 'compressed' like for reset_processed_signals.
         """
         assert dtype is not None
-        self.arrays[chan_grp][seg_num].initialize_array('spikes', 'memmap', dtype, (-1,))
+        assert storage in ('memmap', 'compressed'), 'storage must be memmap or compressed'
+        self.arrays[chan_grp][seg_num].initialize_array('spikes', storage, dtype, (-1,))
+        for name in _spikes_index_arrays:
+            self.arrays[chan_grp][seg_num].delete_array(name)
+        self._spikes_index_buffer[(chan_grp, seg_num)] = []
         
     def append_spikes(self, seg_num=0, chan_grp=0, spikes=None):
         """
@@ -526,16 +936,164 @@ class DataIO:
         """
         if spikes is None: return
         self.arrays[chan_grp][seg_num].append_chunk('spikes', spikes)
+        buffer = self._spikes_index_buffer.get((chan_grp, seg_num), None)
+        if buffer is not None:
+            # keep columns for the index so spikes are not read again at flush
+            buffer.append((spikes['index'].copy(), spikes['cluster_label'].copy()))
         
     def flush_spikes(self, seg_num=0, chan_grp=0):
         """
-        Flush underlying memmap for spikes.
+        Flush underlying memmap (or compressed chunks) for spikes
+        and build the spikes indexes (see get_spikes_in_time_range).
         """
         self.arrays[chan_grp][seg_num].finalize_array('spikes')
+        buffer = self._spikes_index_buffer.pop((chan_grp, seg_num), None)
+        if buffer is None:
+            self.rebuild_spikes_index(seg_num=seg_num, chan_grp=chan_grp)
+        elif len(buffer) == 0:
+            self._build_spikes_index(seg_num, chan_grp, np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64'))
+        else:
+            self._build_spikes_index(seg_num, chan_grp, np.concatenate([e[0] for e in buffer]),
+                                                np.concatenate([e[1] for e in buffer]))
+    
+    def rebuild_spikes_index(self, seg_num=0, chan_grp=0):
+        """
+        Rebuild the spikes indexes from the spikes array.
+        Needed only if spikes have been modified outside of DataIO.
+        """
+        spikes = self.arrays[chan_grp][seg_num].get('spikes')
+        spikes = spikes[:]
+        self._build_spikes_index(seg_num, chan_grp, spikes['index'].copy(), spikes['cluster_label'].copy())
+    
+    def _compute_spikes_index(self, times, labels):
+        # 'spikes_sorted_index': spike time sorted, a time range is a range of rank with searchsorted
+        # 'spikes_time_order': rank > position in spikes, only when spikes are not sorted by time
+        # 'spikes_cluster_ranks': ranks grouped by cluster (sorted inside each cluster)
+        # 'spikes_cluster_offsets': cluster_label, start, stop in spikes_cluster_ranks
+        index = {}
+        times = times.astype('int64')
+        if times.size > 1 and np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='stable')
+            times = times[order]
+            labels = labels[order]
+            index['spikes_time_order'] = order.astype('int64')
+        else:
+            index['spikes_time_order'] = None
+        index['spikes_sorted_index'] = times
+        
+        index['spikes_cluster_ranks'] = np.argsort(labels, kind='stable').astype('int64')
+        cluster_labels, counts = np.unique(labels, return_counts=True)
+        offsets = np.zeros(cluster_labels.size, dtype=_dtype_cluster_offset)
+        offsets['cluster_label'] = cluster_labels
+        offsets['stop'] = np.cumsum(counts)
+        offsets['start'] = offsets['stop'] - counts
+        index['spikes_cluster_offsets'] = offsets
+        return index
+    
+    def _build_spikes_index(self, seg_num, chan_grp, times, labels):
+        arrays = self.arrays[chan_grp][seg_num]
+        index = self._compute_spikes_index(times, labels)
+        for name in _spikes_index_arrays:
+            if index[name] is None:
+                arrays.delete_array(name)
+            else:
+                arrays.add_array(name, index[name], 'memmap')
+    
+    def _get_spikes_index(self, seg_num, chan_grp):
+        arrays = self.arrays[chan_grp][seg_num]
+        if arrays.is_appending('spikes'):
+            # Peeler still running : index of the committed spikes in ram, nothing written
+            spikes = arrays.get('spikes')[:]
+            return self._compute_spikes_index(spikes['index'], spikes['cluster_label'])
+        if 'spikes_sorted_index' not in arrays.keys():
+            # working dir from a previous version
+            self.rebuild_spikes_index(seg_num=seg_num, chan_grp=chan_grp)
+        index = {}
+        for name in _spikes_index_arrays:
+            if name in arrays.keys():
+                index[name] = arrays.get(name)
+            else:
+                index[name] = None
+        return index
+    
+    def refresh_spikes(self, seg_num=0, chan_grp=0):
+        """
+        Reload spikes from disk. Useful for a process (GUI, monitoring) watching spikes
+        growing while a Peeler in another process is appending them.
+        """
+        self.arrays[chan_grp][seg_num].load_if_exists('spikes')
+    
+    def get_spikes_in_time_range(self, seg_num=0, chan_grp=0, i_start=None, i_stop=None, cluster_label=None):
+        """
+        Read spikes with i_start <= index < i_stop (in sample) sorted by time,
+        optionally only for one cluster_label.
+        
+        Contrary to get_spikes, i_start/i_stop are in sample and not positions in the
+        spikes array. This use the indexes built at flush_spikes so the cost is
+        O(log n) + the number of spikes returned.
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        if 'spikes' not in arrays.keys():
+            return
+        spikes = arrays.get('spikes')
+        index = self._get_spikes_index(seg_num, chan_grp)
+        sorted_index = index['spikes_sorted_index']
+        
+        r0 = 0 if i_start is None else np.searchsorted(sorted_index, i_start, side='left')
+        r1 = sorted_index.size if i_stop is None else np.searchsorted(sorted_index, i_stop, side='left')
+        r1 = max(r0, r1)
+        if cluster_label is None:
+            ranks = slice(r0, r1)
+        else:
+            offsets = index['spikes_cluster_offsets']
+            k = np.searchsorted(offsets['cluster_label'], cluster_label)
+            if k == offsets.size or offsets['cluster_label'][k] != cluster_label:
+                return spikes[:0]
+            cluster_ranks = index['spikes_cluster_ranks'][offsets['start'][k]:offsets['stop'][k]]
+            ranks = cluster_ranks[np.searchsorted(cluster_ranks, r0):np.searchsorted(cluster_ranks, r1)]
+        
+        time_order = index['spikes_time_order']
+        if time_order is None:
+            return spikes[ranks]
+        else:
+            return spikes[time_order[ranks]]
+    
+    def get_spike_counts_by_cluster(self, seg_num=0, chan_grp=0):
+        """
+        Return a dict cluster_label > number of spikes, from the spikes indexes.
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        if 'spikes' not in arrays.keys():
+            return {}
+        offsets = self._get_spikes_index(seg_num, chan_grp)['spikes_cluster_offsets']
+        return { int(o['cluster_label']) : int(o['stop'] - o['start']) for o in offsets }
+    
+    def save_noise_trajectory(self, noise_trajectory, seg_num=0, chan_grp=0):
+        """
+        Save the noise trajectory (index, medians, mads) estimated along the segment
+        when the preprocessor have a noise_time_constant.
+        None remove an existing one.
+        """
+        if noise_trajectory is None:
+            self.arrays[chan_grp][seg_num].detach_array('noise_trajectory')
+        else:
+            self.arrays[chan_grp][seg_num].add_array('noise_trajectory', noise_trajectory, 'memmap')
+    
+    def get_noise_trajectory(self, seg_num=0, chan_grp=0):
+        """
+        Read the noise trajectory: a struct array with 'index' (in sample), 'medians' and 'mads'
+        (by channel). None if the Peeler did not use a noise_time_constant.
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        if 'noise_trajectory' not in arrays.keys():
+            return None
+        return arrays.get('noise_trajectory')
     
     def get_spikes(self, seg_num=0, chan_grp=0, i_start=None, i_stop=None):
         """
-        Read spikes
+        Read spikes.
+        While the Peeler is still appending, only the already committed spikes are returned
+        (another process can call refresh_spikes to see new ones).
         """
         spikes = self.arrays[chan_grp][seg_num].get('spikes')
         if spikes is None:
@@ -4,12 +4,61 @@ import re
 from collections import OrderedDict
 
 
-data_source_classes = OrderedDict()
+class _DataSourceClasses(OrderedDict):
+    """
+    OrderedDict of all datasource classes.
+    
+    Classes based on neo.rawio are only registered on the first read access,
+    because importing neo and all its rawio is slow and not needed when
+    data are already in a working dir with raw files.
+    """
+    _neo_registered = False
+    
+    def _register_neo(self):
+        if not self._neo_registered:
+            self._neo_registered = True
+            _register_neo_rawio_classes(self)
+    
+    def __getitem__(self, key):
+        if not OrderedDict.__contains__(self, key):
+            self._register_neo()
+        return OrderedDict.__getitem__(self, key)
+    
+    def __contains__(self, key):
+        if not OrderedDict.__contains__(self, key):
+            self._register_neo()
+        return OrderedDict.__contains__(self, key)
+    
+    def __iter__(self):
+        self._register_neo()
+        return OrderedDict.__iter__(self)
+    
+    def __len__(self):
+        self._register_neo()
+        return OrderedDict.__len__(self)
+    
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+    
+    def keys(self):
+        self._register_neo()
+        return OrderedDict.keys(self)
+    
+    def values(self):
+        self._register_neo()
+        return OrderedDict.values(self)
+    
+    def items(self):
+        self._register_neo()
+        return OrderedDict.items(self)
 
-possible_modes = ['one-file', 'multi-file', 'one-dir', 'multi-dir', 'other']
 
+data_source_classes = _DataSourceClasses()
+
+possible_modes = ['one-file', 'multi-file', 'one-dir', 'multi-dir', 'other']
 
-import neo
 
 
 
@@ -126,10 +175,6 @@ data_source_classes['RawData'] = RawDataSource
 
 
 
-import neo.rawio
-#~ print(rawiolist)
-#~ print('neo.rawio')
-
 io_gui_params = {
     'RawBinarySignal':[
                 {'name': 'dtype', 'type': 'list', 'values':['int16', 'uint16', 'float32', 'float64']},
@@ -213,32 +258,35 @@ class NeoRawIOAggregator(DataSourceBase):
         return rawio.get_analogsignal_chunk(block_index=0, seg_index=s, 
                         i_start=i_start, i_stop=i_stop)
 
-#Put 'RawBinarySignal' at first position
-rawiolist = list(neo.rawio.rawiolist)
-if neo.rawio.RawBinarySignalRawIO in rawiolist:
-    # to avoid bug in readthe doc with moc
-    RawBinarySignalRawIO = rawiolist.pop(rawiolist.index(neo.rawio.RawBinarySignalRawIO))
-#~ rawiolist.insert(0, RawBinarySignalRawIO)
-
-for rawio_class in rawiolist:
-    name = rawio_class.__name__.replace('RawIO', '')
-    class_name = name+'DataSource'
-    datasource_class = type(class_name,(NeoRawIOAggregator,), { })
-    datasource_class.rawio_class = rawio_class
-    if rawio_class.rawmode in ('multi-file', 'one-file'):
-        #multi file in neo have another meaning
-        datasource_class.mode = 'multi-file'
-    elif rawio_class.rawmode in ('one-dir', ):
-        datasource_class.mode = 'multi-dir'
-    else:
-        continue
-    
-    #gui stuffs
-    if name in io_gui_params:
-        datasource_class.gui_params = io_gui_params[name]
+def _register_neo_rawio_classes(classes):
+    import neo.rawio
+    
+    #Put 'RawBinarySignal' at first position
+    rawiolist = list(neo.rawio.rawiolist)
+    if neo.rawio.RawBinarySignalRawIO in rawiolist:
+        # to avoid bug in readthe doc with moc
+        RawBinarySignalRawIO = rawiolist.pop(rawiolist.index(neo.rawio.RawBinarySignalRawIO))
+    #~ rawiolist.insert(0, RawBinarySignalRawIO)
+    
+    for rawio_class in rawiolist:
+        name = rawio_class.__name__.replace('RawIO', '')
+        class_name = name+'DataSource'
+        datasource_class = type(class_name,(NeoRawIOAggregator,), { })
+        datasource_class.rawio_class = rawio_class
+        if rawio_class.rawmode in ('multi-file', 'one-file'):
+            #multi file in neo have another meaning
+            datasource_class.mode = 'multi-file'
+        elif rawio_class.rawmode in ('one-dir', ):
+            datasource_class.mode = 'multi-dir'
+        else:
+            continue
         
-    data_source_classes[name] = datasource_class
-    #~ print(datasource_class, datasource_class.mode )
+        #gui stuffs
+        if name in io_gui_params:
+            datasource_class.gui_params = io_gui_params[name]
+            
+        OrderedDict.__setitem__(classes, name, datasource_class)
+        #~ print(datasource_class, datasource_class.mode )
 
 
     
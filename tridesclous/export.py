@@ -1,14 +1,13 @@
 import os
 from collections import OrderedDict
 
+import importlib.util
+
 import numpy as np
 import scipy.io
 
-try:
-    import pandas as pd
-    HAS_PANDAS = True
-except ImportError:
-    HAS_PANDAS = False
+# pandas is slow to import so only imported when exporting to excel
+HAS_PANDAS = importlib.util.find_spec('pandas') is not None
 
 
 class GenericSpikeExporter:
@@ -86,6 +85,7 @@ class ExcelSpikeExporter(GenericSpikeExporter):
     ext = 'xslx'
     def write_out_data(self, out_data, filename):
         assert HAS_PANDAS
+        import pandas as pd
         writer = pd.ExcelWriter(filename+'.xlsx')
         for key, (spike_indexes, spike_labels) in out_data.items():
             df = pd.DataFrame()
@@ -1,3 +1,9 @@
+import PyQt5 # this force pyqtgraph to deal with Qt5
+
+# this avoid tinker problem when not installed
+import matplotlib
+matplotlib.use('Qt5Agg', force=False)
+
 from .myqt import QT,mkQApp
 
 #for catalogue window
@@ -25,6 +25,9 @@ class CatalogueController(ControllerBase):
         self.cc = self.catalogueconstructor = catalogueconstructor
         self.dataio = catalogueconstructor.dataio
         self.nb_channel = self.dataio.nb_channel(self.chan_grp)
+        if self.dataio.chunk_cache_max_bytes == 0:
+            # viewers read many small overlapping windows
+            self.dataio.set_chunk_cache()
 
         self.init_plot_attributes()
     
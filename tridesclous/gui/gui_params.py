@@ -14,6 +14,11 @@ Preprocessor
     * common_ref_removal (bool): this substracts sample by sample the median across channels
        When there is a strong noise that appears on all channels (sometimes due to reference) you
        can substract it. This is as if all channels would re referenced numerically to there medians.
+       'mean' and 'median_subset' are faster variants for high channel count and 'local_mean'
+       substracts the mean of neighbour channels within common_ref_radius_um.
+    * common_ref_radius_um (float): radius for common_ref_removal='local_mean'.
+    * decimation_factor (int): downsample processed signals by this factor after filtering
+       (with an anti alias lowpass). All next steps are faster. n_left/n_right are then in decimated samples.
     * chunksize (int): the whole processing chain is applied chunk by chunk, this is the chunk size in sample. Typically 1024.
        The smaller size lead to less memory but more CPU comsuption in Peeler. For online, this will be more or less the latency.
     * lostfront_chunksize (int): size in sample of the margin at the front edge for each chunk to avoid border effect in backward filter.
@@ -23,11 +28,20 @@ Preprocessor
       flavor (and so CPU) or opencl with home made CL kernel (and so use GPU computing). If you have big fat GPU and are able to install
       "opencl driver" (ICD) for your platform the opencl flavor should speedup the peeler because pre processing signal take a quite
       important amoung of time.
+      'numpy_thread' is the numpy flavor with channels splitted in blocks filtered in parallel threads, usefull
+      for high channel count on a multi core CPU.
+      'numpy_inplace' keep signals in float32 with preallocated buffers (no temporary array), this reduce
+      memory traffic at high channel count.
+      'fir' use a linear phase FIR (2*lostfront_chunksize+1 taps) applied with FFT overlap-save instead of the
+      forward/backward IIR filter. The latency is exactly lostfront_chunksize and the cost do not depend on filter length.
+      'numba' do forward/backward filter and normalization in one compiled kernel parallel over channel blocks
+      (numba must be installed).
     
 Peak detector
 ----------------------
 
-  * peakdetector_engine (str): 'numpy' or 'opencl'.  See signal_preprocessor_engine. Here the speedup is small.
+  * peakdetector_engine (str): 'numpy', 'numba' or 'opencl'.  See signal_preprocessor_engine. Here the speedup is small.
+    'numba' with the 'numba' preprocessor engine compute the rectified sum in the same pass as the filter.
   * peak_sign (str) : sign of the peak ('+' or '-'). The double detection ('+-') is intentionaly NOT implemented is tridesclous
     because it lead to many mistake for users in multi electrode arrays where the same cluster is seen both on negative peak
     and positive rebounce.
@@ -122,14 +136,16 @@ preprocessor_params = [
     {'name': 'highpass_freq', 'type': 'float', 'value':400., 'step': 10., 'suffix': 'Hz', 'siPrefix': True},
     {'name': 'lowpass_freq', 'type': 'float', 'value':5000., 'step': 10., 'suffix': 'Hz', 'siPrefix': True},
     {'name': 'smooth_size', 'type': 'int', 'value':0},
-    {'name': 'common_ref_removal', 'type': 'bool', 'value':False},
+    {'name': 'common_ref_removal', 'type': 'list', 'value':False, 'values':[False, True, 'mean', 'median_subset', 'local_mean']},
+    {'name': 'common_ref_radius_um', 'type': 'float', 'value':100., 'step': 10., 'suffix': 'um'},
     {'name': 'chunksize', 'type': 'int', 'value':1024, 'decilmals':5},
     {'name': 'lostfront_chunksize', 'type': 'int', 'value':0, 'decilmals':0, 'limits': (0, np.inf),},
-    {'name': 'signalpreprocessor_engine', 'type': 'list', 'value' : 'numpy', 'values':['numpy', 'opencl']},
+    {'name': 'decimation_factor', 'type': 'int', 'value':1, 'limits': (1, 16),},
+    {'name': 'signalpreprocessor_engine', 'type': 'list', 'value' : 'numpy', 'values':['numpy', 'numpy_thread', 'numpy_inplace', 'fir', 'numba', 'opencl']},
 ]
 
 peak_detector_params = [
-    {'name': 'peakdetector_engine', 'type': 'list', 'value' : 'numpy', 'values':['numpy', 'opencl']},
+    {'name': 'peakdetector_engine', 'type': 'list', 'value' : 'numpy', 'values':['numpy', 'numba', 'opencl']},
     {'name': 'peak_sign', 'type': 'list',  'value':'-', 'values':['-', '+']},
     {'name': 'relative_threshold', 'type': 'float', 'value': 5., 'step': .1,},
     {'name': 'peak_span', 'type': 'float', 'value':0.0002, 'step': 0.0001, 'suffix': 's', 'siPrefix': True},
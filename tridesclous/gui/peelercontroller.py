@@ -28,6 +28,9 @@ class PeelerController(ControllerBase):
         
         self.chan_grp = catalogue['chan_grp']
         self.nb_channel = self.dataio.nb_channel(self.chan_grp)
+        if self.dataio.chunk_cache_max_bytes == 0:
+            # viewers read many small overlapping windows
+            self.dataio.set_chunk_cache()
         
         
         self.init_plot_attributes()
@@ -68,7 +71,12 @@ class PeelerController(ControllerBase):
         #~ self.cluster_labels = np.unique(self.spikes['cluster_label'])#TODO take from catalogue
         
         
-        self.cluster_count = { k:np.sum(self.spikes['cluster_label']==k) for k in self.cluster_labels}
+        # from the spikes indexes, no scan
+        self.cluster_count = { k:0 for k in self.cluster_labels}
+        for i in range(self.dataio.nb_segment):
+            for k, count in self.dataio.get_spike_counts_by_cluster(seg_num=i, chan_grp=self.chan_grp).items():
+                if k in self.cluster_count:
+                    self.cluster_count[k] += count
         
         
         self.cluster_visible = {k:k>=0 for k  in self.cluster_labels}
@@ -323,8 +323,9 @@ class BaseTraceViewer(WidgetBase):
             c = self.controller.get_max_on_channel(label)
             
             if c  is None:
+                q = self.controller.dataio.get_processed_signals_decimation(seg_num=seg_num, chan_grp=self.controller.chan_grp)
                 wf = self.controller.dataio.get_signals_chunk(seg_num=seg_num, chan_grp=self.controller.chan_grp,
-                        i_start=peak_ind, i_stop=peak_ind+1,
+                        i_start=peak_ind//q, i_stop=peak_ind//q+1,
                         signal_type='processed')
                 c = np.argmax(np.abs(wf))
             
@@ -351,11 +352,17 @@ class BaseTraceViewer(WidgetBase):
         self.scroll_time.setPageStep(int(sr*self.xsize))
         self.scroll_time.valueChanged.connect(self.on_scroll_time)
         
-        ind1 = max(0, int((t1-t_start)*sr))
+        # processed signals can be decimated, spikes index are in initial sample
+        if self.signal_type=='processed':
+            q = self.dataio.get_processed_signals_decimation(seg_num=self.seg_num, chan_grp=self.controller.chan_grp)
+        else:
+            q = 1
+        
+        ind1 = max(0, int((t1-t_start)*sr)) // q * q
         ind2 = int((t2-t_start)*sr)
 
         sigs_chunk = self.dataio.get_signals_chunk(seg_num=self.seg_num, chan_grp=self.controller.chan_grp,
-                i_start=ind1, i_stop=ind2, signal_type=self.signal_type)
+                i_start=ind1//q, i_stop=ind2//q, signal_type=self.signal_type)
         
         if sigs_chunk is None: 
             return
@@ -374,7 +381,7 @@ class BaseTraceViewer(WidgetBase):
         data_curves += self.offsets[self.visible_channels, None]
         data_curves[:,0] = np.nan
         data_curves = data_curves.flatten()
-        times_chunk = np.arange(sigs_chunk.shape[0], dtype='float32')/self.dataio.sample_rate+max(t1, 0)
+        times_chunk = np.arange(sigs_chunk.shape[0], dtype='float32')*q/self.dataio.sample_rate+max(t1, 0)
         times_chunk_tile = np.tile(times_chunk, nb_visible)
         self.signals_curve.setData(times_chunk_tile, data_curves)
         
@@ -406,7 +413,7 @@ class BaseTraceViewer(WidgetBase):
             keep = (all_spikes['segment']==self.seg_num) & (all_spikes['index']>=ind1) & (all_spikes['index']<ind2)
             spikes_chunk = np.array(all_spikes[keep], copy=True)
             spikes_chunk['index'] -= ind1
-            inwindow_ind = spikes_chunk['index']
+            inwindow_ind = spikes_chunk['index'] // q
             inwindow_label = spikes_chunk['cluster_label']
             inwindow_selected = np.array(self.controller.spike_selection[keep])
 
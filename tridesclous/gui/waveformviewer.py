@@ -410,8 +410,9 @@ class WaveformViewerBase(WidgetBase):
         
         n_left, n_right = self.controller.get_waveform_left_right()
         
+        q = self.controller.dataio.get_processed_signals_decimation(seg_num=seg_num, chan_grp=self.controller.chan_grp)
         wf = self.controller.dataio.get_signals_chunk(seg_num=seg_num, chan_grp=self.controller.chan_grp,
-                i_start=peak_ind+n_left, i_stop=peak_ind+n_right,
+                i_start=peak_ind//q+n_left, i_stop=peak_ind//q+n_right,
                 signal_type='processed')
         
         if wf.shape[0]==(n_right-n_left):
@@ -4,14 +4,410 @@ import io
 import sys
 import shutil
 import gc
+import zlib
+from collections import OrderedDict
 
 import numpy as np
 
+try:
+    import blosc
+    HAVE_BLOSC = True
+except ImportError:
+    HAVE_BLOSC = False
+
+
+def _compress_chunk(buf, itemsize, codec):
+    if codec == 'blosc':
+        return blosc.compress(buf, typesize=itemsize, cname='zstd', clevel=1, shuffle=blosc.SHUFFLE)
+    elif codec == 'zlib':
+        # byte-shuffle : first bytes of all items then second bytes...
+        b = np.frombuffer(buf, dtype='uint8').reshape(-1, itemsize).T
+        return zlib.compress(np.ascontiguousarray(b).tobytes(), 1)
+    else:
+        raise ValueError('codec {} unknown'.format(codec))
+
+
+def _decompress_chunk(buf, itemsize, codec):
+    if codec == 'blosc':
+        assert HAVE_BLOSC, 'blosc is needed to read this array'
+        return blosc.decompress(buf)
+    elif codec == 'zlib':
+        b = np.frombuffer(zlib.decompress(buf), dtype='uint8').reshape(itemsize, -1).T
+        return np.ascontiguousarray(b).tobytes()
+    else:
+        raise ValueError('codec {} unknown'.format(codec))
+
+
+class CompressedChunkArray:
+    """
+    Array stored on disk in compressed chunks of chunk_rows along the first axis.
+    
+    Files are:
+      * name.zchunks : compressed chunks one after the other
+      * name.zindex : (offset, nbytes) int64 for each chunk, offset -1 for a never written chunk (zeros)
+    
+    Chunks are compressed with blosc (zstd + byte-shuffle) when available
+    else with zlib and a numpy byte-shuffle.
+    
+    Indexing is done on the first axis (int, slice, index array or bool mask)
+    then on others axis on the decompressed part, so slicing still gives random access.
+    A small LRU cache keep the last cache_size decompressed chunks. Writes go to the cache
+    and modified chunks are compressed and appended to the file on eviction or flush(),
+    so writing sequentially by blocks is efficient. Rewritten chunks are not reclaimed
+    in the file until the array is created again.
+    
+    This is not a numpy array: np.asarray(arr) or arr[:] decompress everything.
+    """
+    def __init__(self, dirname, name, dtype, shape, mode='r+', chunk_rows=4096, codec=None, cache_size=8):
+        self.dirname = dirname
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.chunk_rows = int(chunk_rows)
+        if codec is None:
+            codec = 'blosc' if HAVE_BLOSC else 'zlib'
+        self.codec = codec
+        self.cache_size = cache_size
+        
+        self._row_shape = self.shape[1:]
+        self._row_nbytes = int(np.prod(self._row_shape)) * self.dtype.itemsize
+        self._cache = OrderedDict()
+        
+        chunks_filename = os.path.join(dirname, name+'.zchunks')
+        index_filename = os.path.join(dirname, name+'.zindex')
+        if mode == 'w+':
+            self._index = np.zeros((0, 2), dtype='int64')
+            self._file = open(chunks_filename, mode='wb+')
+        else:
+            self._index = np.fromfile(index_filename, dtype='int64').reshape(-1, 2)
+            self._file = open(chunks_filename, mode='rb+')
+        self._resize_index()
+    
+    @property
+    def ndim(self):
+        return len(self.shape)
+    
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+    
+    @property
+    def nb_chunk(self):
+        return (self.shape[0] + self.chunk_rows - 1) // self.chunk_rows
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __repr__(self):
+        return '<CompressedChunkArray {} {} {} codec={}>'.format(self.name, self.shape, self.dtype, self.codec)
+    
+    def __array__(self, dtype=None):
+        arr = self[:]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+    
+    def _resize_index(self):
+        n = self.nb_chunk
+        if self._index.shape[0] < n:
+            extra = np.zeros((n - self._index.shape[0], 2), dtype='int64')
+            extra[:, 0] = -1
+            self._index = np.concatenate([self._index, extra], axis=0)
+    
+    def _get_chunk(self, c):
+        if c in self._cache:
+            self._cache.move_to_end(c)
+            return self._cache[c][0]
+        
+        chunk = np.zeros((self.chunk_rows, ) + self._row_shape, dtype=self.dtype)
+        offset, nbytes = self._index[c]
+        if offset >= 0:
+            self._file.seek(offset)
+            buf = _decompress_chunk(self._file.read(nbytes), self.dtype.itemsize, self.codec)
+            n = len(buf) // self._row_nbytes
+            chunk[:n] = np.frombuffer(buf, dtype=self.dtype).reshape((n, ) + self._row_shape)
+        
+        self._cache[c] = [chunk, False]
+        while len(self._cache) > self.cache_size:
+            c_old, (chunk_old, dirty) = self._cache.popitem(last=False)
+            if dirty:
+                self._write_chunk(c_old, chunk_old)
+        return chunk
+    
+    def _write_chunk(self, c, chunk):
+        n = min(self.chunk_rows, self.shape[0] - c * self.chunk_rows)
+        buf = _compress_chunk(chunk[:n].tobytes(), self.dtype.itemsize, self.codec)
+        self._file.seek(0, os.SEEK_END)
+        self._index[c] = self._file.tell(), len(buf)
+        self._file.write(buf)
+    
+    def _rows(self, key):
+        # split key in row indices (for first axis) and the rest
+        if isinstance(key, tuple):
+            key0, rest = key[0], key[1:]
+        else:
+            key0, rest = key, ()
+        
+        if isinstance(key0, slice):
+            start, stop, step = key0.indices(self.shape[0])
+            rows = np.arange(start, stop, step, dtype='int64')
+            return rows, rest, False, step == 1
+        elif isinstance(key0, (int, np.integer)):
+            if key0 < 0:
+                key0 += self.shape[0]
+            assert 0 <= key0 < self.shape[0], 'index out of bounds'
+            return np.array([key0], dtype='int64'), rest, True, True
+        else:
+            key0 = np.asarray(key0)
+            if key0.dtype == 'bool':
+                assert key0.size == self.shape[0], 'bool mask size mismatch'
+                rows = np.flatnonzero(key0)
+            else:
+                rows = key0.astype('int64').copy()
+                rows[rows < 0] += self.shape[0]
+            assert np.all((rows >= 0) & (rows < self.shape[0])), 'index out of bounds'
+        return rows, rest, False, False
+    
+    def __getitem__(self, key):
+        rows, rest, scalar, contiguous = self._rows(key)
+        out = np.empty((rows.size, ) + self._row_shape, dtype=self.dtype)
+        chunk_inds = rows // self.chunk_rows
+        # consecutive rows in the same chunk are copied at once
+        limits = np.flatnonzero(np.diff(chunk_inds)) + 1
+        for i0, i1 in zip(np.r_[0, limits], np.r_[limits, rows.size]):
+            if i0 == i1:
+                continue
+            chunk = self._get_chunk(chunk_inds[i0])
+            local_rows = rows[i0:i1] - chunk_inds[i0] * self.chunk_rows
+            if contiguous:
+                local_rows = slice(local_rows[0], local_rows[-1] + 1)
+            out[i0:i1] = chunk[local_rows]
+        if scalar:
+            out = out[0]
+        if len(rest) > 0:
+            if scalar:
+                out = out[rest]
+            else:
+                out = out[(slice(None), ) + rest]
+        return out
+    
+    def __setitem__(self, key, value):
+        rows, rest, scalar, contiguous = self._rows(key)
+        # broadcast value to the shape of self[key] (with a row axis when scalar)
+        dummy = np.broadcast_to(np.zeros((), dtype=self.dtype), (rows.size, ) + self._row_shape)
+        target_shape = dummy[(slice(None), ) + rest].shape
+        if scalar:
+            value = np.asarray(value, dtype=self.dtype)[None, ...]
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), target_shape)
+        chunk_inds = rows // self.chunk_rows
+        limits = np.flatnonzero(np.diff(chunk_inds)) + 1
+        for i0, i1 in zip(np.r_[0, limits], np.r_[limits, rows.size]):
+            if i0 == i1:
+                continue
+            c = chunk_inds[i0]
+            chunk = self._get_chunk(c)
+            local_rows = rows[i0:i1] - c * self.chunk_rows
+            if contiguous:
+                local_rows = slice(local_rows[0], local_rows[-1] + 1)
+            if len(rest) == 0:
+                chunk[local_rows] = value[i0:i1]
+            else:
+                sub = chunk[local_rows]
+                sub[(slice(None), ) + rest] = value[i0:i1]
+                if not contiguous:
+                    # fancy indexing gives a copy
+                    chunk[local_rows] = sub
+            self._cache[c][1] = True
+    
+    def append(self, arr_chunk):
+        """
+        Append rows at the end, the first axis grows.
+        """
+        arr_chunk = np.asarray(arr_chunk, dtype=self.dtype).reshape((-1, ) + self._row_shape)
+        n = self.shape[0]
+        self.shape = (n + arr_chunk.shape[0], ) + self._row_shape
+        self._resize_index()
+        if arr_chunk.shape[0] > 0:
+            self[n:] = arr_chunk
+    
+    def flush(self):
+        for c, v in self._cache.items():
+            chunk, dirty = v
+            if dirty:
+                self._write_chunk(c, chunk)
+                v[1] = False
+        self._file.flush()
+        self._index[:self.nb_chunk].tofile(os.path.join(self.dirname, self.name+'.zindex'))
+    
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+    
+    def get_storage_info(self):
+        """
+        Parameters saved in arrays.json to reopen the array.
+        """
+        return dict(chunk_rows=self.chunk_rows, codec=self.codec)
+    
+    def compression_ratio(self):
+        """
+        Uncompressed size / compressed size of written chunks (garbage from rewrites not counted).
+        """
+        written = self._index[:self.nb_chunk, 0] >= 0
+        compressed = np.sum(self._index[:self.nb_chunk, 1][written])
+        if compressed == 0:
+            return 1.
+        nrows = sum(min(self.chunk_rows, self.shape[0] - c * self.chunk_rows) for c in np.flatnonzero(written))
+        return nrows * self._row_nbytes / compressed
+
+
+# target size of uncompressed chunks for memory_mode='compressed'
+_compressed_chunk_nbytes = 2**20
+
+# size of the ram write block of GrowableArray (appendable memmap)
+_growable_block_nbytes = 2**20
+
+
+class GrowableArray:
+    """
+    Appendable array on disk used by ArrayCollection for memory_mode='memmap' appendable arrays.
+    
+    Small appended chunks are buffered in ram and copied by blocks of block_nbytes
+    into a preallocated memmap. The file is grown geometrically (x2) when full,
+    so the number of resize and syscall stay small even with tiny chunks.
+    
+    The committed length (rows already in the memmap) is written in name.length
+    after the data, so a reader (same process with get_committed() or another process
+    with ArrayCollection.load_if_exists) can safely read up to this length while
+    appending continue.
+    
+    finalize() truncates the file to the exact size and removes name.length.
+    """
+    def __init__(self, dirname, name, dtype, row_shape, block_nbytes=_growable_block_nbytes):
+        self.dirname = dirname
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.row_nbytes = int(np.prod(self.row_shape)) * self.dtype.itemsize
+        self.block_rows = max(1, block_nbytes // max(self.row_nbytes, 1))
+        
+        self.filename = os.path.join(dirname, name+'.raw')
+        self.length_filename = os.path.join(dirname, name+'.length')
+        
+        self.length = 0
+        self.capacity = 0
+        self._memmap = None
+        self._buffer = np.empty((self.block_rows, ) + self.row_shape, dtype=self.dtype)
+        self._nbuf = 0
+        
+        with open(self.filename, mode='wb'):
+            pass
+        self._write_length()
+    
+    def __repr__(self):
+        return '<GrowableArray {} length={} capacity={} {}>'.format(self.name, self.length, self.capacity, self.dtype)
+    
+    def append(self, arr_chunk):
+        arr_chunk = np.asarray(arr_chunk, dtype=self.dtype).reshape((-1, ) + self.row_shape)
+        n = arr_chunk.shape[0]
+        if self._nbuf + n > self.block_rows:
+            self.commit()
+            if n >= self.block_rows:
+                # big chunk go directly
+                self._write(arr_chunk)
+                self._write_length()
+                return
+        self._buffer[self._nbuf:self._nbuf+n] = arr_chunk
+        self._nbuf += n
+        if self._nbuf == self.block_rows:
+            self.commit()
+    
+    def commit(self):
+        """
+        Copy the ram buffer to the memmap and publish the new length for readers.
+        """
+        if self._nbuf > 0:
+            self._write(self._buffer[:self._nbuf])
+            self._nbuf = 0
+        self._write_length()
+    
+    def _write(self, data):
+        n = data.shape[0]
+        if n == 0:
+            return
+        needed = self.length + n
+        if needed > self.capacity:
+            self._grow(needed)
+        self._memmap[self.length:needed] = data
+        self.length = needed
+    
+    def _grow(self, needed):
+        capacity = max(needed, self.capacity * 2, self.block_rows)
+        if self.row_nbytes == 0:
+            self.capacity = capacity
+            return
+        with open(self.filename, mode='rb+') as f:
+            f.truncate(capacity * self.row_nbytes)
+        # the old mapping stay valid for views already given to readers
+        self._memmap = np.memmap(self.filename, dtype=self.dtype, mode='r+', shape=(capacity, ) + self.row_shape)
+        self.capacity = capacity
+    
+    def _write_length(self):
+        # atomic replace : a reader never see a partial length
+        tmp_filename = self.length_filename + '.tmp'
+        np.array([self.length], dtype='int64').tofile(tmp_filename)
+        os.replace(tmp_filename, self.length_filename)
+    
+    def get_committed(self):
+        """
+        View on the rows already committed (buffered rows are not included).
+        """
+        if self._memmap is None or self.length == 0:
+            return np.zeros((0, ) + self.row_shape, dtype=self.dtype)
+        return self._memmap[:self.length]
+    
+    def close(self):
+        self.commit()
+        if self._memmap is not None:
+            self._memmap.flush()
+        self._memmap = None
+    
+    def finalize(self):
+        """
+        Commit, truncate the file to the exact size and remove name.length.
+        Return the final length.
+        """
+        self.close()
+        try:
+            with open(self.filename, mode='rb+') as f:
+                f.truncate(self.length * self.row_nbytes)
+        except OSError:
+            # still mapped (windows) : the file keep its capacity, readers use the shape
+            pass
+        if os.path.exists(self.length_filename):
+            os.remove(self.length_filename)
+        return self.length
+    
+    @staticmethod
+    def read_committed_length(dirname, name):
+        """
+        Committed length of an array being appended (possibly by another process).
+        """
+        length_filename = os.path.join(dirname, name+'.length')
+        if not os.path.exists(length_filename):
+            return 0
+        return int(np.fromfile(length_filename, dtype='int64')[0])
+
+
+
 class ArrayCollection:
     """
     Collection of arrays.
     Some live in ram some ondisk via memmap.
-    Some can be appendable.
+    Some live ondisk in compressed chunks (memory_mode='compressed', see CompressedChunkArray).
+    Some can be appendable (memmap appendable are GrowableArray, readable while appending).
     Automatique seattr to parent.
     """
     def __init__(self, parent=None, dirname=None):
@@ -34,12 +430,20 @@ class ArrayCollection:
             d = {}
             for name in self._array:
                 if self._array_attr[name]['state']=='a':
+                    if isinstance(self._array[name], GrowableArray):
+                        # readers get the committed length from name.length
+                        a = self._array[name]
+                        dt = a.dtype.name if a.dtype.fields is None else a.dtype.descr
+                        d[name] = dict(dtype=dt, shape=[-1] + list(a.row_shape), appending=True)
                     continue
                 if self._array[name].dtype.fields is None:
                     dt = self._array[name].dtype.name
                 else:
                     dt = self._array[name].dtype.descr
                 d[name] = dict(dtype=dt, shape=list(self._array[name].shape))
+                if self._array_attr[name]['memory_mode'] == 'compressed':
+                    d[name]['storage'] = 'compressed'
+                    d[name].update(self._array[name].get_storage_info())
             json.dump(d, f, indent=4)        
     
     def _check_nb_ref(self, name):
@@ -67,7 +471,7 @@ class ArrayCollection:
         if name in self._array and (self._array_attr[name]['memory_mode'] == 'memmap'):
             if (self._array_attr[name]['state'] == 'a'):
                 # case appendable and memmap
-                self._array[name].close()
+                self._array[name].finalize()
                 self._array.pop(name)
                 self._array_attr.pop(name)
             else:
@@ -80,7 +484,12 @@ class ArrayCollection:
                         delattr(self.parent, name)
                 del(a)
                 self._array_attr.pop(name)
-                
+        
+        if name in self._array and (self._array_attr[name]['memory_mode'] == 'compressed'):
+            self._array.pop(name).close()
+            self._array_attr.pop(name)
+            if self.parent is not None and hasattr(self.parent, name):
+                delattr(self.parent, name)
         
         if os.path.exists(self._fname(name)):
             mode = 'r+'
@@ -126,6 +535,9 @@ class ArrayCollection:
                 self._check_nb_ref(name)
             
             mode = self._fix_existing(name)
+            if mode == 'r+' and os.path.getsize(self._fname(name)) != np.prod(shape) * np.dtype(dtype).itemsize:
+                # dtype or shape have changed : the file is rewritten to not keep old content and size
+                mode = 'w+'
             # detect when 0 size because np.memmap  bug with size=0
             if np.prod(shape)>0:
                 arr = np.memmap(self._fname(name), dtype=dtype, mode=mode, shape=shape)
@@ -134,6 +546,9 @@ class ArrayCollection:
                     f.write('')
                 arr = np.empty(shape, dtype=dtype)
                 #~ print('empty array memmap !!!!', name, shape)
+        elif memory_mode=='compressed':
+            self._fix_existing(name)
+            arr = self._create_compressed(name, dtype, shape)
         
         self._array[name] = arr
         self._array_attr[name] = {'state':'w', 'memory_mode':memory_mode}
@@ -143,19 +558,32 @@ class ArrayCollection:
         self.flush_json()
         return arr
     
+    def _create_compressed(self, name, dtype, shape):
+        if os.path.exists(self._fname(name)):
+            # not used anymore
+            os.remove(self._fname(name))
+        row_nbytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+        chunk_rows = max(1, _compressed_chunk_nbytes // max(row_nbytes, 1))
+        return CompressedChunkArray(self.dirname, name, dtype, shape, mode='w+', chunk_rows=chunk_rows)
+    
     def add_array(self, name, data, memory_mode):
         self.create_array(name, data.dtype, data.shape, memory_mode)
         self._array[name][:] = data
         self.flush_array(name)
 
     def delete_array(self, name):
-        if name not in self._array:
-            return
-        #~ if self._array_attr[name]['memory_mode'] == 'memmap':
-            #~ #delete file if exist
-            #~ filename = self._fname(name)
+        """
+        Detach the array and remove its files.
+        """
         self.detach_array(name)
-        raise(NotimplementedError)
+        for ext in ('.raw', '.length', '.zchunks', '.zindex'):
+            filename = self._fname(name, ext=ext)
+            if os.path.exists(filename):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    # still mapped somewhere (windows), the file remains
+                    pass
         
         
     def detach_array(self, name, mmap_close=False):
@@ -164,6 +592,10 @@ class ArrayCollection:
         a = self._array.pop(name)
         if mmap_close and hasattr(a, '_mmap'):
             a._mmap.close()
+        if isinstance(a, CompressedChunkArray):
+            a.close()
+        elif isinstance(a, GrowableArray):
+            a.finalize()
         self._array_attr.pop(name)
         if self.parent is not None:
             delattr(self.parent, name)
@@ -173,13 +605,19 @@ class ArrayCollection:
         if memory_mode=='ram':
             self._array[name] = []
         elif memory_mode=='memmap':
-            mode = self._fix_existing(name)
-            self._array[name] = open(self._fname(name), mode='wb+')
+            self._fix_existing(name)
+            self._array[name] = GrowableArray(self.dirname, name, dtype, shape[1:])
+        elif memory_mode=='compressed':
+            self._fix_existing(name)
+            shape = (0, ) + tuple(shape[1:])
+            self._array[name] = self._create_compressed(name, dtype, shape)
         
         self._array_attr[name] = {'state':'a', 'memory_mode':memory_mode, 'dtype': dtype, 'shape':shape}
         
         if self.parent is not None:
             setattr(self.parent, name, None)
+        if memory_mode=='memmap':
+            self.flush_json()
     
     def append_chunk(self, name, arr_chunk):
         assert self._array_attr[name]['state']=='a'
@@ -188,7 +626,9 @@ class ArrayCollection:
         if memory_mode=='ram':
             self._array[name].append(arr_chunk)
         elif memory_mode=='memmap':
-            self._array[name].write(arr_chunk.tobytes(order='C'))
+            self._array[name].append(arr_chunk)
+        elif memory_mode=='compressed':
+            self._array[name].append(arr_chunk)
         
         
     def finalize_array(self, name):
@@ -198,14 +638,16 @@ class ArrayCollection:
         if memory_mode=='ram':
             self._array[name] = np.concatenate(self._array[name], axis=0)
         elif memory_mode=='memmap':
-            self._array[name].close()
-            try:
-                self._array[name] = np.memmap(self._fname(name), dtype=self._array_attr[name]['dtype'],
-                                                mode='r+').reshape(self._array_attr[name]['shape'])
-            except ValueError:
-                #empty file = 0 elements
-                #FIXME: find something else
-                self._array[name] = np.zeros((0,), dtype=self._array_attr[name]['dtype']).reshape(self._array_attr[name]['shape'])
+            a = self._array[name]
+            length = a.finalize()
+            if length * a.row_nbytes > 0:
+                self._array[name] = np.memmap(self._fname(name), dtype=a.dtype, mode='r+',
+                                                shape=(length, ) + a.row_shape)
+            else:
+                # np.memmap do not support 0 size
+                self._array[name] = np.zeros((length, ) + a.row_shape, dtype=a.dtype)
+        elif memory_mode=='compressed':
+            self._array[name].flush()
             
         self._array_attr[name]['state'] = 'r'
         if self.parent is not None:
@@ -217,8 +659,13 @@ class ArrayCollection:
         if memory_mode=='ram':
             pass
         elif memory_mode=='memmap':
-            if self._array[name].size>0:
+            if self._array_attr[name]['state'] == 'a':
+                # make appended rows visible to readers
+                self._array[name].commit()
+            elif self._array[name].size>0:
                 self._array[name].flush()
+        elif memory_mode=='compressed':
+            self._array[name].flush()
     
     
     def load_if_exists(self, name):
@@ -240,8 +687,31 @@ class ArrayCollection:
             if isinstance(d[name]['dtype'], str):
                 dtype = np.dtype(d[name]['dtype'])
             else:
-                dtype = np.dtype([ (k,v) for k,v in d[name]['dtype']])
+                # descr can have a sub array shape (name, type, shape)
+                dtype = np.dtype([ tuple(e[:2]) + tuple(tuple(shape) for shape in e[2:]) for e in d[name]['dtype']])
             shape = d[name]['shape']
+            if name in self._array and self._array_attr[name]['memory_mode'] == 'compressed':
+                self._array[name].close()
+            if d[name].get('storage', 'memmap') == 'compressed':
+                arr = CompressedChunkArray(self.dirname, name, dtype, shape, mode='r+',
+                                chunk_rows=d[name]['chunk_rows'], codec=d[name]['codec'])
+                self._array[name] = arr
+                self._array_attr[name] = {'state':'r', 'memory_mode':'compressed'}
+                if self.parent is not None:
+                    setattr(self.parent, name, self._array[name])
+                return
+            if d[name].get('appending', False):
+                # being appended (maybe by another process) : read only up to the committed length
+                shape = [GrowableArray.read_committed_length(self.dirname, name)] + shape[1:]
+                if np.prod(shape)>0:
+                    arr = np.memmap(self._fname(name), dtype=dtype, mode='r', shape=tuple(shape))
+                else:
+                    arr = np.empty(shape, dtype=dtype)
+                self._array[name] = arr
+                self._array_attr[name] = {'state':'r', 'memory_mode':'memmap', 'appending':True}
+                if self.parent is not None:
+                    setattr(self.parent, name, self._array[name])
+                return
             if np.prod(d[name]['shape'])>0:
                 arr = np.memmap(self._fname(name), dtype=dtype, mode='r+')
                 arr = arr[:np.prod(shape)]
@@ -277,8 +747,20 @@ class ArrayCollection:
     
     def get(self, name):
         assert name in self._array_attr
+        if self._array_attr[name]['state'] == 'a' and isinstance(self._array[name], GrowableArray):
+            # already committed part, readable while appending
+            return self._array[name].get_committed()
         return self._array[name]
     
+    def is_appending(self, name):
+        """
+        True if the array is being appended, here or by another process (when loaded).
+        """
+        if name not in self._array_attr:
+            return False
+        attr = self._array_attr[name]
+        return attr['state'] == 'a' or attr.get('appending', False)
+    
     def keys(self):
         return self._array.keys()
     
@@ -1,5 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
+import seaborn as sns
+sns.set_style("white")
 
 from .tools import median_mad
 from .dataio import DataIO
@@ -39,11 +41,17 @@ def plot_signals(dataio_or_cataloguecconstructor, chan_grp=0, seg_num=0, time_sl
     channel_group = dataio.channel_groups[chan_grp]
     channels = channel_group['channels']
     
-    i_start = int(time_slice[0]*dataio.sample_rate)
+    # processed signals can be decimated, peaks index are in initial sample
+    if signal_type=='processed':
+        q = dataio.get_processed_signals_decimation(seg_num=seg_num, chan_grp=chan_grp)
+    else:
+        q = 1
+    
+    i_start = int(time_slice[0]*dataio.sample_rate) // q * q
     i_stop = int(time_slice[1]*dataio.sample_rate)
     
     raw_sigs = dataio.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp,
-                i_start=i_start, i_stop=i_stop, signal_type=signal_type)
+                i_start=i_start//q, i_stop=i_stop//q, signal_type=signal_type)
     
     if signal_type=='initial':
         med, mad = median_mad(raw_sigs)
@@ -59,7 +67,7 @@ def plot_signals(dataio_or_cataloguecconstructor, chan_grp=0, seg_num=0, time_sl
     
     
     
-    times = np.arange(sigs.shape[0])/dataio.sample_rate
+    times = np.arange(sigs.shape[0])*q/dataio.sample_rate
     fig, ax = plt.subplots()
     ax.plot(times, sigs)
     
@@ -70,6 +78,7 @@ def plot_signals(dataio_or_cataloguecconstructor, chan_grp=0, seg_num=0, time_sl
         keep = (peaks['segment']==seg_num) & (peaks['index']>=i_start) & (peaks['index']<i_stop)
         peak_indexes = peaks[keep]['index'].copy()
         peak_indexes -= i_start
+        peak_indexes //= q
         
         if with_peaks:
             for i in range(len(channels)):
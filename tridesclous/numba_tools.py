@@ -0,0 +1,149 @@
+"""
+numba kernels for the 'numba' engines of signalpreprocessor and peakdetector.
+
+numba is optional and slow to import, so this module is only imported by
+the numba engines at construction (HAVE_NUMBA in signalpreprocessor and peakdetector
+only check that numba is installed).
+Kernels are compiled at first call.
+
+"""
+import numpy as np
+
+import os
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def setup_threading_layer():
+    """
+    Prefer omp/workqueue threading layer, unless the user choose one with env variables.
+    Must be called before the first parallel kernel is run.
+    """
+    if HAVE_NUMBA and 'NUMBA_THREADING_LAYER' not in os.environ and 'NUMBA_THREADING_LAYER_PRIORITY' not in os.environ:
+        # run_peeler_parallel fork processes: with the tbb layer forked children hang at exit
+        numba.config.THREADING_LAYER_PRIORITY = ['omp', 'workqueue', 'tbb']
+
+
+if HAVE_NUMBA:
+
+    @numba.njit(cache=True, inline='always')
+    def _sos_section(x, coeff, z0, z1):
+        # one second order section on several channels in place
+        for i in range(x.size):
+            y = coeff[0] * x[i] + z0[i]
+            z0[i] = coeff[1] * x[i] - coeff[4] * y + z1[i]
+            z1[i] = coeff[2] * x[i] - coeff[5] * y
+            x[i] = y
+
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_filtfilt_chunk(data, coefficients, zi, zi_backward, forward_buffer, i1, i2, out,
+                            normalize, medians, mads,
+                            detect, peak_sign, thresh, partial_sum, nb_block):
+        """
+        Online filtfilt of one chunk (see SignalPreprocessor_Numpy) in one pass by block of channels:
+          * forward sos filter of data with state zi, appended to forward_buffer
+          * backward sos filter (zero state) of forward_buffer, samples i1:i2 are written in out
+          * optional normalization with medians/mads
+          * optional rectification and sum by block of channels in partial_sum
+
+        Channels are splitted in nb_block blocks processed in parallel.
+        Inside a block the loop is over samples then channels so memory is read
+        contiguously in the (sample, channel) layout.
+        forward_buffer is (backward_chunksize, nb_channel), zi and zi_backward (nb_section, 2, nb_channel).
+        """
+        n = data.shape[0]
+        nb_channel = data.shape[1]
+        nb_section = coefficients.shape[0]
+        L = forward_buffer.shape[0]
+        for b in numba.prange(nb_block):
+            c0 = b * nb_channel // nb_block
+            c1 = (b + 1) * nb_channel // nb_block
+            # one sample of the block, the inner loop on channels is vectorized
+            x = np.empty(c1 - c0)
+            # roll
+            for s in range(L - n):
+                for c in range(c0, c1):
+                    forward_buffer[s, c] = forward_buffer[s + n, c]
+            # forward (direct form II transposed like scipy.signal.sosfilt)
+            for s in range(n):
+                for c in range(c0, c1):
+                    x[c - c0] = data[s, c]
+                for sec in range(nb_section):
+                    _sos_section(x, coefficients[sec], zi[sec, 0, c0:c1], zi[sec, 1, c0:c1])
+                for c in range(c0, c1):
+                    forward_buffer[L - n + s, c] = x[c - c0]
+            # backward from the end with zero state
+            zi_backward[:, :, c0:c1] = 0.
+            for s in range(L - 1, i1 - 1, -1):
+                for c in range(c0, c1):
+                    x[c - c0] = forward_buffer[s, c]
+                for sec in range(nb_section):
+                    _sos_section(x, coefficients[sec], zi_backward[sec, 0, c0:c1], zi_backward[sec, 1, c0:c1])
+                if s >= i2:
+                    continue
+                acc = 0.
+                for c in range(c0, c1):
+                    # cast to output dtype before normalization like other engines
+                    out[s - i1, c] = x[c - c0]
+                    if normalize:
+                        out[s - i1, c] = (out[s - i1, c] - medians[c]) / mads[c]
+                    v = out[s - i1, c]
+                    if detect:
+                        if peak_sign == 1 and v >= thresh:
+                            acc += v
+                        elif peak_sign == -1 and v <= -thresh:
+                            acc += v
+                if detect:
+                    partial_sum[b, s - i1] = acc
+
+
+    @numba.njit(cache=True)
+    def numba_rectify_and_sum(sigs, channels, peak_sign, thresh, out):
+        """
+        Rectified sum over channels (see peakdetector._rectify_and_sum) in out.
+        """
+        n = sigs.shape[0]
+        for s in range(n):
+            out[s] = 0.
+            for c in channels:
+                v = sigs[s, c]
+                if peak_sign == 1 and v >= thresh:
+                    out[s] += v
+                elif peak_sign == -1 and v <= -thresh:
+                    out[s] += v
+
+
+    @numba.njit(cache=True)
+    def numba_detect_peaks_in_rectified(sig, k, peak_sign, thresh, ind_peaks):
+        """
+        Same as peakdetector._detect_peaks_in_rectified: local extrema over +-k.
+        Index of peaks (in sig) are written in ind_peaks, return the number of peaks.
+        """
+        nb_peak = 0
+        for i in range(k, sig.shape[0] - k):
+            v = sig[i]
+            if peak_sign == 1:
+                if not v > thresh:
+                    continue
+                peak = True
+                for j in range(1, k + 1):
+                    if not (v > sig[i - j] and v >= sig[i + j]):
+                        peak = False
+                        break
+            else:
+                if not v < -thresh:
+                    continue
+                peak = True
+                for j in range(1, k + 1):
+                    if not (v < sig[i - j] and v <= sig[i + j]):
+                        peak = False
+                        break
+            if peak:
+                ind_peaks[nb_peak] = i
+                nb_peak += 1
+        return nb_peak
@@ -4,11 +4,16 @@ Here 2 version for peakdetector.
 
 """
 
+import importlib.util
+
 import numpy as np
 
 #~ from pyacq.core.stream.ringbuffer import RingBuffer
 from .tools import FifoBuffer
 
+# numba is slow to import so numba_tools is only imported by PeakDetectorEngine_Numba
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
 try:
     import pyopencl
     mf = pyopencl.mem_flags
@@ -18,24 +23,45 @@ except ImportError:
 
 
 def detect_peaks_in_chunk(sig, k, thresh, peak_sign):
-    sig = sig.copy()
+    sum_rectified = _rectify_and_sum(sig, thresh, peak_sign)
+    
+    ind_peaks = _detect_peaks_in_rectified(sum_rectified, k, thresh, peak_sign)
     
+    return ind_peaks
+
+
+def _rectify_and_sum(sig, thresh, peak_sign, out=None, scratch=None, mask=None):
+    # sig is not modified, scratch (same shape as sig) and mask (bool) can be given
+    # to avoid allocation at each call
+    if scratch is None:
+        scratch = np.empty(sig.shape, dtype=sig.dtype)
+    if mask is None:
+        mask = np.empty(sig.shape, dtype='bool')
+    
+    # multiply by the mask is much faster than boolean indexing
     if peak_sign == '+':
-        sig[sig<thresh] = 0.
+        np.greater_equal(sig, thresh, out=mask)
     else:
-        sig[sig>-thresh] = 0.
-
+        np.less_equal(sig, -thresh, out=mask)
+    np.multiply(sig, mask, out=scratch)
+    
+    if out is None:
+        out = np.empty(sig.shape[0], dtype=sig.dtype)
     if sig.shape[1]>1:
-        sum_rectified = np.sum(sig, axis=1)
+        np.sum(scratch, axis=1, out=out)
     else:
-        sum_rectified = sig[:,0]
-    
-    ind_peaks = _detect_peaks_in_rectified(sum_rectified, k, thresh, peak_sign)
+        out[:] = scratch[:, 0]
     
-    return ind_peaks
+    return out
+
 
+# under this span the 2*k comparisons are faster than the sliding extremum
+_min_span_sliding_extremum = 8
 
 def _detect_peaks_in_rectified(sig_rectified, k, thresh, peak_sign):
+    if k >= _min_span_sliding_extremum:
+        return _detect_peaks_sliding_extremum(sig_rectified, k, thresh, peak_sign)
+    
     sig_center = sig_rectified[k:-k]
     if peak_sign == '+':
         peaks = sig_center>thresh
@@ -54,6 +80,108 @@ def _detect_peaks_in_rectified(sig_rectified, k, thresh, peak_sign):
     return ind_peaks
 
 
+def _sliding_extremum(sig, k, func):
+    """
+    Extremum (func is np.maximum or np.minimum) of all windows of size k:
+    out[i] = func.reduce(sig[i:i+k]) for i in range(sig.size-k+1)
+    
+    This is the van Herk/Gil-Werman algorithm: prefix and suffix extremum inside blocks
+    of size k, each window is the extremum of one suffix and one prefix.
+    The cost do not depend on k.
+    """
+    n = sig.size
+    nb_block = -(-n // k)
+    padded = np.empty(nb_block * k, dtype=sig.dtype)
+    padded[:n] = sig
+    # padding is never used by complete windows
+    padded[n:] = sig[-1]
+    blocks = padded.reshape(nb_block, k)
+    prefix = func.accumulate(blocks, axis=1).reshape(-1)
+    suffix = func.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(-1)
+    return func(suffix[:n-k+1], prefix[k-1:n])
+
+
+def _detect_peaks_sliding_extremum(sig_rectified, k, thresh, peak_sign):
+    # same result as _detect_peaks_in_rectified: a peak is strictly over the k samples before
+    # and over or equal the k samples after, so compared to the extremum of each side
+    n = sig_rectified.size
+    sig_center = sig_rectified[k:n-k]
+    if peak_sign == '+':
+        peaks = sig_center>thresh
+        if not np.any(peaks):
+            return np.zeros(0, dtype='int64')
+        extremum = _sliding_extremum(sig_rectified, k, np.maximum)
+        peaks &= sig_center>extremum[:n-2*k]
+        peaks &= sig_center>=extremum[k+1:n-k+1]
+    elif peak_sign == '-':
+        peaks = sig_center<-thresh
+        if not np.any(peaks):
+            return np.zeros(0, dtype='int64')
+        extremum = _sliding_extremum(sig_rectified, k, np.minimum)
+        peaks &= sig_center<extremum[:n-2*k]
+        peaks &= sig_center<=extremum[k+1:n-k+1]
+    
+    ind_peaks,  = np.nonzero(peaks)
+
+    ind_peaks += k
+    return ind_peaks
+
+
+class IncrementalPeakDetector:
+    """
+    Same as detect_peaks_in_chunk but keep the rectified sum and the peak mask
+    of the whole buffer so that, after the buffer have been modified on some
+    windows (for instance a spike substraction in the Peeler), only theses
+    windows are recomputed.
+    
+    Usage:
+      detector.reset(sig)  # full detection
+      detector.update(sig, start, stop)  # sig[start:stop] have changed
+      detector.get_peaks()
+    
+    Peaks are identical to detect_peaks_in_chunk(sig, k, thresh, peak_sign).
+    
+    channels (optional) restrict the rectified sum to some channels (others are masked).
+    """
+    def __init__(self, k, thresh, peak_sign, channels=None):
+        self.k = k
+        self.thresh = thresh
+        self.peak_sign = peak_sign
+        self.channels = channels
+    
+    def reset(self, sig):
+        self.length = sig.shape[0]
+        if self.channels is not None:
+            sig = sig[:, self.channels]
+        self.sum_rectified = _rectify_and_sum(sig, self.thresh, self.peak_sign)
+        self.peak_mask = np.zeros(self.length, dtype='bool')
+        self._update_mask(self.k, self.length - self.k)
+    
+    def update(self, sig, start, stop):
+        start = max(start, 0)
+        stop = min(stop, self.length)
+        if stop<=start:
+            return
+        sig = sig[start:stop]
+        if self.channels is not None:
+            sig = sig[:, self.channels]
+        self.sum_rectified[start:stop] = _rectify_and_sum(sig, self.thresh, self.peak_sign)
+        # a peak depend on its +-k neighborhood
+        self._update_mask(max(start - self.k, self.k), min(stop + self.k, self.length - self.k))
+    
+    def _update_mask(self, start, stop):
+        if stop<=start:
+            return
+        k = self.k
+        ind_peaks = _detect_peaks_in_rectified(self.sum_rectified[start-k:stop+k], k, self.thresh, self.peak_sign)
+        self.peak_mask[start:stop] = False
+        self.peak_mask[ind_peaks + start - k] = True
+    
+    def get_peaks(self):
+        ind_peaks,  = np.nonzero(self.peak_mask)
+        return ind_peaks
+
+
 class PeakDetectorEngine_Numpy:
     def __init__(self, sample_rate, nb_channel, chunksize, dtype,):
         self.sample_rate = sample_rate
@@ -64,17 +192,14 @@ class PeakDetectorEngine_Numpy:
         self.n_peak = 0
         
     def process_data(self, pos, newbuf):
-        newbuf = newbuf.copy()
+        n = newbuf.shape[0]
+        if self.good_channels is not None:
+            # masked channels are skipped
+            newbuf = np.take(newbuf, self.good_channels, axis=1, out=self.channels_buffer[:n])
         
-        if self.peak_sign == '+':
-            newbuf[newbuf<self.relative_threshold] = 0.
-        else:
-            newbuf[newbuf>-self.relative_threshold] = 0.
-
-        if self.nb_channel>1:
-            sum_rectified = np.sum(newbuf, axis=1)
-        else:
-            sum_rectified = newbuf[:,0]
+        # preallocated buffers, newbuf is not modified
+        sum_rectified = _rectify_and_sum(newbuf, self.relative_threshold, self.peak_sign,
+                            out=self.sum_rectified[:n], scratch=self.rectify_scratch[:n], mask=self.rectify_mask[:n])
         
         #~ self.ring_sum.new_chunk(sum_rectified, index=pos)
         self.fifo_sum_rectified.new_chunk(sum_rectified, pos)
@@ -116,16 +241,29 @@ class PeakDetectorEngine_Numpy:
         
         #~ return None, None
         
-    def change_params(self, peak_sign=None, relative_threshold=None, peak_span=None):
+    def change_params(self, peak_sign=None, relative_threshold=None, peak_span=None, channel_mask=None):
         self.peak_sign = peak_sign
         self.relative_threshold = relative_threshold
         self.peak_span = peak_span
         
+        if channel_mask is not None and not np.all(channel_mask):
+            self.good_channels, = np.nonzero(channel_mask)
+        else:
+            self.good_channels = None
+        
+        nb_channel = self.nb_channel if self.good_channels is None else self.good_channels.size
+        if self.good_channels is not None:
+            self.channels_buffer = np.zeros((self.chunksize, nb_channel), dtype=self.dtype)
+        self.rectify_scratch = np.zeros((self.chunksize, nb_channel), dtype=self.dtype)
+        self.rectify_mask = np.zeros((self.chunksize, nb_channel), dtype='bool')
+        self.sum_rectified = np.zeros(self.chunksize, dtype=self.dtype)
+        
         self.n_span = int(self.sample_rate*self.peak_span)//2
         self.n_span = max(1, self.n_span)
         
         #~ self.ring_sum = RingBuffer((self.chunksize*2,), self.dtype, double=True)
-        self.fifo_sum_rectified = FifoBuffer((self.chunksize*2,), self.dtype)
+        # only the chunk + 2*n_span are needed, so each roll only copy 2*n_span samples
+        self.fifo_sum_rectified = FifoBuffer((self.chunksize + 2*self.n_span,), self.dtype)
         
         
 
@@ -187,10 +325,11 @@ class PeakDetectorEngine_OpenCL:
         
         return None, None
         
-    def change_params(self, peak_sign=None, relative_threshold=None, peak_span=None):
+    def change_params(self, peak_sign=None, relative_threshold=None, peak_span=None, channel_mask=None):
         self.peak_sign = peak_sign
         self.relative_threshold = relative_threshold
         self.peak_span = peak_span
+        # channel_mask is not used: masked channels are 0 (see SignalPreprocessor) so not detected
         
         self.n_span = int(self.sample_rate*self.peak_span)//2
         self.n_span = max(1, self.n_span)
@@ -292,6 +431,86 @@ class PeakDetectorEngine_OpenCL:
     """
 
 
-peakdetector_engines = { 'numpy' : PeakDetectorEngine_Numpy, 'opencl' : PeakDetectorEngine_OpenCL}
+class PeakDetectorEngine_Numba:
+    """
+    Same as PeakDetectorEngine_Numpy but rectify, sum and local extrema are
+    numba kernels (see numba_tools) without temporary copy of the chunk.
+    
+    With link_preprocessor(signalpreprocessor) and the 'numba' signal preprocessor
+    engine, the rectified sum is computed by the preprocessor in the same pass
+    as filtering and normalization (see SignalPreprocessor_Numba), so here
+    only the local extrema are searched.
+    """
+    def __init__(self, sample_rate, nb_channel, chunksize, dtype,):
+        assert HAVE_NUMBA, 'numba is not installed'
+        from . import numba_tools
+        numba_tools.setup_threading_layer()
+        self.numba_rectify_and_sum = numba_tools.numba_rectify_and_sum
+        self.numba_detect_peaks_in_rectified = numba_tools.numba_detect_peaks_in_rectified
+        
+        self.sample_rate = sample_rate
+        self.nb_channel = nb_channel
+        self.chunksize = chunksize
+        self.dtype = dtype
+        
+        self.n_peak = 0
+        self.signalpreprocessor = None
+    
+    def link_preprocessor(self, signalpreprocessor):
+        # only SignalPreprocessor_Numba can compute the rectified sum
+        if hasattr(signalpreprocessor, 'set_fused_detection'):
+            self.signalpreprocessor = signalpreprocessor
+    
+    def process_data(self, pos, newbuf):
+        n = newbuf.shape[0]
+        
+        sum_rectified = None
+        if self.signalpreprocessor is not None:
+            sum_rectified = self.signalpreprocessor.get_sum_rectified(pos, n)
+        if sum_rectified is None:
+            sum_rectified = self.sum_rectified[:n]
+            self.numba_rectify_and_sum(newbuf, self.channels, self.sign, self.relative_threshold, sum_rectified)
+        
+        self.fifo_sum_rectified.new_chunk(sum_rectified, pos)
+        
+        k = self.n_span
+        if pos-(n+2*k)<0:
+            # the very first buffer is sacrified because of peak span
+            return None, None
+        
+        sig_rectified = self.fifo_sum_rectified.get_data(pos-(n+2*k), pos)
+        nb_peak = self.numba_detect_peaks_in_rectified(sig_rectified, k, self.sign, self.relative_threshold, self.ind_peaks)
+        
+        if nb_peak>0:
+            ind_peaks = self.ind_peaks[:nb_peak] + pos - n -2*k
+            self.n_peak += nb_peak
+            return self.n_peak, ind_peaks
+        
+        return None, None
+    
+    def change_params(self, peak_sign=None, relative_threshold=None, peak_span=None, channel_mask=None):
+        self.peak_sign = peak_sign
+        self.relative_threshold = relative_threshold
+        self.peak_span = peak_span
+        self.sign = {'+':1, '-':-1}[peak_sign]
+        
+        if channel_mask is not None and not np.all(channel_mask):
+            self.channels, = np.nonzero(channel_mask)
+        else:
+            self.channels = np.arange(self.nb_channel)
+        
+        self.n_span = int(self.sample_rate*self.peak_span)//2
+        self.n_span = max(1, self.n_span)
+        
+        self.fifo_sum_rectified = FifoBuffer((self.chunksize + 2*self.n_span,), self.dtype)
+        self.sum_rectified = np.zeros(self.chunksize, dtype=self.dtype)
+        self.ind_peaks = np.zeros(self.chunksize + 2*self.n_span, dtype='int64')
+        
+        if self.signalpreprocessor is not None:
+            self.signalpreprocessor.set_fused_detection(peak_sign, relative_threshold)
+
+
+peakdetector_engines = { 'numpy' : PeakDetectorEngine_Numpy, 'opencl' : PeakDetectorEngine_OpenCL,
+                                    'numba' : PeakDetectorEngine_Numba}
 
 
@@ -9,17 +9,19 @@ import os
 import json
 from collections import OrderedDict, namedtuple
 import time
+import threading
+import queue
 
 import numpy as np
 import scipy.signal
 
 
 from . import signalpreprocessor
-from .peakdetector import  detect_peaks_in_chunk
+from .peakdetector import  IncrementalPeakDetector
 
 from .tools import make_color_dict
 
-import matplotlib.pyplot as plt
+#~ import matplotlib.pyplot as plt
 #import seaborn as sns
 
 
@@ -56,6 +58,9 @@ LABEL_MAXIMUM_SHIFT = -13
 maximum_jitter_shift = 4
 #~ maximum_jitter_shift = 1
 
+# interval in s between 2 records of the running noise (noise_time_constant)
+_noise_record_interval = 1.
+
 class Peeler:
     """
     The peeler is core of spike sorting itself.
@@ -99,6 +104,8 @@ class Peeler:
                                         sparse_threshold_mad=1.5,
                                         use_opencl_with_sparse=False,
                                         use_pythran_with_sparse=False,
+                                        use_batch_classification=False,
+                                        substraction_threshold_mad=None,
                                         ):
         """
         Set parameters for the Peeler.
@@ -126,6 +133,18 @@ class Peeler:
             the labelling of each spike. Usefull for high channel count.
         use_pythran_with_sparse: bool
             experimental same as use_opencl_with_sparse but with pythran
+        use_batch_classification: bool (default False)
+            Classify all peaks of a peeling iteration at once instead of one by one.
+            Distances to all centers are computed with one matrix product and
+            jitters are estimated in a vectorized way. Peaks that overlap a spike
+            accepted in the same iteration are postponed to the next one.
+            Usefull for high channel count and many clusters.
+            Not compatible with use_sparse_template.
+        substraction_threshold_mad: float or None (default None)
+            When not None, the prediction of a spike is substracted from the residual
+            only on channels where its center goes above this threshold (in MAD).
+            For high channel count this avoid to touch channels far from the cell.
+            None substract on all channels.
         """
         assert catalogue is not None
         self.catalogue = catalogue
@@ -135,12 +154,16 @@ class Peeler:
         self.sparse_threshold_mad = sparse_threshold_mad
         self.use_opencl_with_sparse = use_opencl_with_sparse
         self.use_pythran_with_sparse = use_pythran_with_sparse
-        
+        self.use_batch_classification = use_batch_classification
+        self.substraction_threshold_mad = substraction_threshold_mad
+
         # Some check
         if self.use_opencl_with_sparse or self.use_pythran_with_sparse:
             assert self.use_sparse_template, 'For that option you must use sparse template'
         if self.use_sparse_template:
             assert self.use_opencl_with_sparse or self.use_pythran_with_sparse, 'For that option you must use OpenCL or Pytran'
+        if self.use_batch_classification:
+            assert not self.use_sparse_template, 'use_batch_classification is not compatible with sparse template'
         if self.use_opencl_with_sparse:
             assert HAVE_PYOPENCL, 'OpenCL is not available'
         if self.use_pythran_with_sparse:
@@ -148,6 +171,16 @@ class Peeler:
         
         self.colors = make_color_dict(self.catalogue['clusters'])
         
+        # dead/noisy channels (see CatalogueConstructor bad_channel_ratios) are 0 in processed
+        # signals and in centers, they are skipped for distances and substraction
+        channel_mask = self.catalogue.get('channel_mask', None)
+        if channel_mask is not None and not np.all(channel_mask):
+            self.good_channels, = np.nonzero(channel_mask)
+            self.catalogue['centers0_good'] = np.ascontiguousarray(self.catalogue['centers0'][:, :, self.good_channels])
+        else:
+            self.good_channels = None
+            self.catalogue['centers0_good'] = self.catalogue['centers0']
+        
         # precompute some value for jitter estimation
         n = self.catalogue['cluster_labels'].size
         self.catalogue['wf1_norm2'] = np.zeros(n)
@@ -162,7 +195,28 @@ class Peeler:
             self.catalogue['wf1_norm2'][i] = wf1.dot(wf1)
             self.catalogue['wf2_norm2'][i] = wf2.dot(wf2)
             self.catalogue['wf1_dot_wf2'][i] = wf1.dot(wf2)
-        
+
+        if self.use_batch_classification:
+            # flat centers and their squared norm for ||w||^2 - 2*w.c + ||c||^2
+            centers = self.catalogue['centers0_good']
+            self.catalogue['centers0_flat'] = np.ascontiguousarray(centers.reshape(centers.shape[0], -1))
+            self.catalogue['centers0_norm2'] = np.sum(self.catalogue['centers0_flat']**2, axis=1)
+
+        if self.substraction_threshold_mad is None and self.good_channels is None:
+            self.catalogue.pop('substraction_channels', None)
+        elif self.substraction_threshold_mad is None:
+            self.catalogue['substraction_channels'] = [self.good_channels] * self.catalogue['centers0'].shape[0]
+        else:
+            # channels where the prediction is substracted for each cluster
+            centers = self.catalogue['centers0']
+            self.catalogue['substraction_channels'] = []
+            for i in range(centers.shape[0]):
+                mask = np.any(np.abs(centers[i])>self.substraction_threshold_mad, axis=0)
+                mask[self.catalogue['max_on_channel'][i]] = True
+                if self.good_channels is not None:
+                    mask &= channel_mask
+                self.catalogue['substraction_channels'].append(np.nonzero(mask)[0])
+
         if self.use_sparse_template:
             centers = wf0 = self.catalogue['centers0']
             #~ print(centers.shape)
@@ -250,50 +304,73 @@ class Peeler:
         
         #~ t1 = time.perf_counter()
         good_spikes = []
-        all_ready_tested = []
+        # peaks are detected once on the whole fifo and then only recomputed
+        # around substracted spikes (see _substract_spikes)
+        self.peakdetector.reset(self.fifo_residuals)
+        all_ready_tested = np.zeros(self.fifo_residuals.shape[0], dtype='bool')
         while True:
             #detect peaks
-            t3 = time.perf_counter()
-            local_peaks = detect_peaks_in_chunk(self.fifo_residuals, self.n_span, self.relative_threshold, self.peak_sign)
-            t4 = time.perf_counter()
+            #~ t3 = time.perf_counter()
+            local_peaks = self.peakdetector.get_peaks()
+            #~ t4 = time.perf_counter()
             #~ print('self.fifo_residuals median', np.median(self.fifo_residuals, axis=0))
             #~ print('  detect_peaks_in_chunk', (t4-t3)*1000.)
             
-            if len(all_ready_tested)>0:
-                local_peaks_to_check = local_peaks[~np.in1d(local_peaks, all_ready_tested)]
-            else:
-                local_peaks_to_check = local_peaks
+            local_peaks_to_check = local_peaks[~all_ready_tested[local_peaks]]
             
             n_ok = 0
-            for i, local_peak in enumerate(local_peaks_to_check):
-                #~ print('    local_peak', local_peak, 'i', i)
-                #~ t3 = time.perf_counter()
-                spike = self.classify_and_align_one_spike(local_peak, self.fifo_residuals, self.catalogue)
-                #~ t4 = time.perf_counter()
-                #~ print('    classify_and_align_one_spike', (t4-t3)*1000.)
+            if self.use_batch_classification:
+                spikes = self.classify_and_align_batch(local_peaks_to_check, self.fifo_residuals, self.catalogue)
                 
-                if spike.cluster_label>=0:
-                    #~ t3 = time.perf_counter()
-                    #~ print('     >>spike.index', spike.index, spike.cluster_label, 'abs index', spike.index+shift)
-                    spikes = np.array([spike], dtype=_dtype_spike)
-                    prediction = make_prediction_signals(spikes, self.fifo_residuals.dtype, self.fifo_residuals.shape, self.catalogue, safe=False)
-                    self.fifo_residuals -= prediction
-                    spikes['index'] += shift
-                    good_spikes.append(spikes)
-                    n_ok += 1
-                    #~ t4 = time.perf_counter()
-                    #~ print('    make_prediction_signals and sub', (t4-t3)*1000.)
+                # keep only good spikes that do not overlap another good spike of this iteration
+                # others are postponed because the residual will change under them
+                min_dist = self.peak_width + 2*maximum_jitter_shift
+                keep = np.zeros(spikes.size, dtype='bool')
+                last_index = None
+                for i in np.nonzero(spikes['cluster_label']>=0)[0]:
+                    if last_index is None or np.abs(spikes[i]['index']-last_index)>min_dist:
+                        keep[i] = True
+                        last_index = spikes[i]['index']
+                
+                accepted = spikes[keep]
+                if accepted.size>0:
+                    self._substract_spikes(accepted, all_ready_tested)
+                    n_ok = accepted.size
                     
-                    #~ print('    all_ready_tested before', all_ready_tested)
-                    all_ready_tested = [ind for ind in all_ready_tested if np.abs(spike.index-ind)>self.peak_width]
-                    #~ print('    all_ready_tested new deal', all_ready_tested)
+                    # bad peaks near an accepted spike will be tested again on the new residual
+                    bad = spikes['cluster_label']<0
+                    near = np.any(np.abs(spikes['index'][:, None] - accepted['index'][None, :])<=min_dist, axis=1)
+                    all_ready_tested[local_peaks_to_check[bad & ~near]] = True
+                    
+                    accepted['index'] += shift
+                    good_spikes.append(accepted)
                 else:
-                    all_ready_tested.append(local_peak)
+                    all_ready_tested[local_peaks_to_check] = True
+            else:
+                for i, local_peak in enumerate(local_peaks_to_check):
+                    #~ print('    local_peak', local_peak, 'i', i)
+                    #~ t3 = time.perf_counter()
+                    spike = self.classify_and_align_one_spike(local_peak, self.fifo_residuals, self.catalogue)
+                    #~ t4 = time.perf_counter()
+                    #~ print('    classify_and_align_one_spike', (t4-t3)*1000.)
+                
+                    if spike.cluster_label>=0:
+                        #~ t3 = time.perf_counter()
+                        #~ print('     >>spike.index', spike.index, spike.cluster_label, 'abs index', spike.index+shift)
+                        spikes = np.array([spike], dtype=_dtype_spike)
+                        self._substract_spikes(spikes, all_ready_tested)
+                        spikes['index'] += shift
+                        good_spikes.append(spikes)
+                        n_ok += 1
+                        #~ t4 = time.perf_counter()
+                        #~ print('    make_prediction_signals and sub', (t4-t3)*1000.)
+                    else:
+                        all_ready_tested[local_peak] = True
             
             if n_ok==0:
                 # no peak can be labeled
                 # reserve bad spikes on the right limit for next time
-                local_peaks = local_peaks[local_peaks<(self.chunksize+self.n_span)]
+                local_peaks = local_peaks[local_peaks<(self.processed_chunksize+self.n_span)]
                 bad_spikes = np.zeros(local_peaks.shape[0], dtype=_dtype_spike)
                 bad_spikes['index'] = local_peaks + shift
                 bad_spikes['cluster_label'] = LABEL_UNCLASSIFIED
@@ -308,7 +385,7 @@ class Peeler:
         # and keep then until the next loop this avoid unordered spike
         if len(good_spikes)>0:
             good_spikes = np.concatenate(good_spikes)
-            near_border = (good_spikes['index'] - shift)>=(self.chunksize+self.n_span)
+            near_border = (good_spikes['index'] - shift)>=(self.processed_chunksize+self.n_span)
             near_border_good_spikes = good_spikes[near_border].copy()
             good_spikes = good_spikes[~near_border]
 
@@ -320,12 +397,27 @@ class Peeler:
         
         # all_spikes = all_spikes[np.argsort(all_spikes['index'])]
         all_spikes = all_spikes.take(np.argsort(all_spikes['index']))
+        all_spikes['index'] *= self.decimation_factor
         self.total_spike += all_spikes.size
         
         return abs_head_index, preprocessed_chunk, self.total_spike, all_spikes
             
     
     
+    def _substract_spikes(self, spikes, all_ready_tested):
+        """
+        Substract spikes (local index) from fifo_residuals, then update peaks
+        only on the modified windows and forget already tested peaks near them.
+        """
+        substract_prediction_signals(spikes, self.fifo_residuals, self.catalogue, safe=False)
+        
+        # same position as in _iter_prediction_waveforms
+        local_pos = spikes['index'] - np.round(spikes['jitter']).astype('int64') + self.catalogue['n_left']
+        for i in range(spikes.size):
+            self.peakdetector.update(self.fifo_residuals, local_pos[i], local_pos[i] + self.peak_width)
+            ind = spikes[i]['index']
+            all_ready_tested[max(ind - self.peak_width, 0):ind + self.peak_width + 1] = False
+    
     def _initialize_before_each_segment(self, sample_rate=None, nb_channel=None, source_dtype=None):
         
         self.nb_channel = nb_channel
@@ -343,21 +435,29 @@ class Peeler:
         p['normalize'] = True
         p['signals_medians'] = self.catalogue['signals_medians']
         p['signals_mads'] = self.catalogue['signals_mads']
+        p['geometry'] = self.catalogue.get('geometry', None)
+        p['channel_mask'] = self.catalogue.get('channel_mask', None)
         self.signalpreprocessor.change_params(**p)
         
         assert self.chunksize>self.signalpreprocessor.lostfront_chunksize
         
         self.internal_dtype = self.signalpreprocessor.output_dtype
+        
+        # with decimation, peeling is done on decimated signals
+        # and spikes index are given back in initial sample
+        self.decimation_factor = self.signalpreprocessor.decimation_factor
+        self.processed_chunksize = self.chunksize // self.decimation_factor
+        self.processed_sample_rate = self.signalpreprocessor.output_sample_rate
 
         self.peak_sign = self.catalogue['peak_detector_params']['peak_sign']
         self.relative_threshold = self.catalogue['peak_detector_params']['relative_threshold']
         peak_span = self.catalogue['peak_detector_params']['peak_span']
-        self.n_span = int(sample_rate*peak_span)//2
+        self.n_span = int(self.processed_sample_rate*peak_span)//2
         self.n_span = max(1, self.n_span)
         self.peak_width = self.catalogue['peak_width']
         self.n_side = self.catalogue['peak_width'] + maximum_jitter_shift + self.n_span + 1
         
-        assert self.chunksize > (self.n_side+1), 'chunksize is too small because of n_size'
+        assert self.processed_chunksize > (self.n_side+1), 'chunksize is too small because of n_size'
         
         self.alien_value_threshold = self.catalogue['clean_waveforms_params']['alien_value_threshold']
         
@@ -365,14 +465,76 @@ class Peeler:
         
         self.near_border_good_spikes = []
         
-        self.fifo_residuals = np.zeros((self.n_side+self.chunksize, nb_channel), 
+        self.fifo_residuals = np.zeros((self.n_side+self.processed_chunksize, nb_channel), 
                                                                 dtype=self.internal_dtype)
+        
+        self.peakdetector = IncrementalPeakDetector(self.n_span, self.relative_threshold, self.peak_sign,
+                                                        channels=self.good_channels)
+        
+        self.noise_trajectory = []
+        self._next_noise_record = 0
+    
+    def _record_noise(self, sig_index):
+        # keep medians/mads of the running noise estimation, one by _noise_record_interval
+        if self.signalpreprocessor.noise_estimator is None or sig_index is None:
+            return
+        if sig_index >= self._next_noise_record:
+            medians = self.catalogue['signals_medians'].copy()
+            mads = self.catalogue['signals_mads'].copy()
+            # the preprocessor only follow good channels
+            good = slice(None) if self.good_channels is None else self.good_channels
+            medians[good] = self.signalpreprocessor.signals_medians
+            mads[good] = self.signalpreprocessor.signals_mads
+            self.noise_trajectory.append((sig_index * self.decimation_factor, medians, mads))
+            self._next_noise_record = sig_index + int(_noise_record_interval * self.processed_sample_rate)
+    
+    def _save_noise_trajectory(self, seg_num, chan_grp):
+        if len(self.noise_trajectory) == 0:
+            self.dataio.save_noise_trajectory(None, seg_num=seg_num, chan_grp=chan_grp)
+            return
+        dtype = [('index', 'int64'), ('medians', self.internal_dtype, (self.nb_channel,)),
+                        ('mads', self.internal_dtype, (self.nb_channel,))]
+        noise_trajectory = np.array(self.noise_trajectory, dtype=dtype)
+        self.dataio.save_noise_trajectory(noise_trajectory, seg_num=seg_num, chan_grp=chan_grp)
     
     
     def initialize_online_loop(self, sample_rate=None, nb_channel=None, source_dtype=None):
         self._initialize_before_each_segment(sample_rate=sample_rate, nb_channel=nb_channel, source_dtype=source_dtype)
     
-    def run_offline_loop_one_segment(self, seg_num=0, duration=None, progressbar=True):
+    def run_offline_loop_one_segment(self, seg_num=0, duration=None, progressbar=True, pipelined=False, queue_size=8):
+        """
+        Run the Peeler on one segment and write processed signals and spikes.
+        
+        With pipelined=True, reading signals is done in a read-ahead thread and
+        writing processed signals and spikes in a write-behind thread, so that
+        disk latency is overlapped with computing. queue_size is the max number
+        of chunks waiting in each queue. Results are the same.
+        """
+        chan_grp = self.catalogue['chan_grp']
+        
+        length = self.initialize_offline_segment(seg_num=seg_num, duration=duration)
+        
+        iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=self.chunksize, 
+                                                    i_stop=length, signal_type='initial')
+        if pipelined:
+            self._run_pipelined_loop(iterator, seg_num, chan_grp, length, progressbar, queue_size)
+        else:
+            if progressbar:
+                iterator = tqdm(iterable=iterator, total=length//self.chunksize)
+            for pos, sigs_chunk in iterator:
+                self.process_and_write_one_chunk(seg_num, pos, sigs_chunk)
+        
+        self.finalize_offline_segment(seg_num=seg_num)
+    
+    def initialize_offline_segment(self, seg_num=0, duration=None):
+        """
+        Initialize engines and reset processed signals and spikes of one segment.
+        Return the length to be processed.
+        
+        initialize_offline_segment / process_and_write_one_chunk / finalize_offline_segment
+        is the same as run_offline_loop_one_segment but let the caller feed chunks
+        (for instance several channel groups from one read, see peelertools.run_peelers_one_pass).
+        """
         chan_grp = self.catalogue['chan_grp']
         
         kargs = {}
@@ -388,38 +550,213 @@ class Peeler:
         #~ length -= length%self.chunksize
         
         #initialize engines
-        self.dataio.reset_processed_signals(seg_num=seg_num, chan_grp=chan_grp, dtype=self.internal_dtype)
-        self.dataio.reset_spikes(seg_num=seg_num, chan_grp=chan_grp, dtype=_dtype_spike)
-
-        iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=self.chunksize, 
-                                                    i_stop=length, signal_type='initial')
-        if progressbar:
-            iterator = tqdm(iterable=iterator, total=length//self.chunksize)
-        for pos, sigs_chunk in iterator:
-            
-            sig_index, preprocessed_chunk, total_spike, spikes = self.process_one_chunk(pos, sigs_chunk)
-            
-            if sig_index<=0:
-                continue
-            
-            # save preprocessed_chunk to file
-            self.dataio.set_signals_chunk(preprocessed_chunk, seg_num=seg_num,chan_grp=chan_grp,
-                        i_start=sig_index-preprocessed_chunk.shape[0], i_stop=sig_index,
-                        signal_type='processed')
-            
-            if spikes is not None and spikes.size>0:
-                self.dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=spikes)
-        
+        storage = self.catalogue.get('processed_signals_storage', 'memmap')
+        self.dataio.reset_processed_signals(seg_num=seg_num, chan_grp=chan_grp,
+                        dtype=self.catalogue.get('processed_signals_dtype', self.internal_dtype),
+                        decimation_factor=self.decimation_factor,
+                        storage=storage, lazy_params=self._make_lazy_params(storage))
+        self.dataio.reset_spikes(seg_num=seg_num, chan_grp=chan_grp, dtype=_dtype_spike,
+                        storage='compressed' if storage=='compressed' else 'memmap')
+        
+        return length
+    
+    def _make_lazy_params(self, storage):
+        # processed signals recomputed on demand with the same preprocessing
+        if storage != 'lazy':
+            return None
+        return self.dataio.make_lazy_params(self.catalogue['signal_preprocessor_params'], self.chunksize,
+                            self.catalogue['signals_medians'], self.catalogue['signals_mads'],
+                            channel_mask=self.catalogue.get('channel_mask', None),
+                            geometry=self.catalogue.get('geometry', None))
+    
+    def process_and_write_one_chunk(self, seg_num, pos, sigs_chunk):
+        sig_index, preprocessed_chunk, total_spike, spikes = self.process_one_chunk(pos, sigs_chunk)
+        self._record_noise(sig_index)
+        self._write_one_chunk(seg_num, self.catalogue['chan_grp'], sig_index, preprocessed_chunk, spikes)
+    
+    def finalize_offline_segment(self, seg_num=0):
+        chan_grp = self.catalogue['chan_grp']
         if len(self.near_border_good_spikes)>0:
             # deal with extra remaining spikes
             extra_spikes = self.near_border_good_spikes[0]
             extra_spikes = extra_spikes.take(np.argsort(extra_spikes['index']))
+            extra_spikes['index'] *= self.decimation_factor
             self.total_spike += extra_spikes.size
             if extra_spikes.size>0:
                 self.dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=extra_spikes)
         
         self.dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp)
         self.dataio.flush_spikes(seg_num=seg_num, chan_grp=chan_grp)
+        self._save_noise_trajectory(seg_num, chan_grp)
+    
+    def _write_one_chunk(self, seg_num, chan_grp, sig_index, preprocessed_chunk, spikes):
+        if sig_index<=0:
+            return
+        
+        # save preprocessed_chunk to file
+        self.dataio.set_signals_chunk(preprocessed_chunk, seg_num=seg_num,chan_grp=chan_grp,
+                    i_start=sig_index-preprocessed_chunk.shape[0], i_stop=sig_index,
+                    signal_type='processed')
+        
+        if spikes is not None and spikes.size>0:
+            self.dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=spikes)
+    
+    def _run_pipelined_loop(self, iterator, seg_num, chan_grp, length, progressbar, queue_size):
+        read_queue = queue.Queue(maxsize=queue_size)
+        write_queue = queue.Queue(maxsize=queue_size)
+        stop_event = threading.Event()
+        writer_errors = []
+        
+        def put_or_stop(item):
+            # never block forever when the compute loop is gone
+            while not stop_event.is_set():
+                try:
+                    read_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def reader():
+            try:
+                for pos, sigs_chunk in iterator:
+                    # force the read (memmap) in this thread
+                    if not put_or_stop((pos, np.array(sigs_chunk))):
+                        return
+                put_or_stop(None)
+            except Exception as e:
+                put_or_stop(e)
+            finally:
+                # release the datasource iterator
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+        
+        def writer():
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    break
+                if len(writer_errors)>0:
+                    # drain the queue
+                    continue
+                try:
+                    self._write_one_chunk(seg_num, chan_grp, *item)
+                except Exception as e:
+                    writer_errors.append(e)
+        
+        reader_thread = threading.Thread(target=reader, daemon=True)
+        writer_thread = threading.Thread(target=writer, daemon=True)
+        reader_thread.start()
+        writer_thread.start()
+        
+        if progressbar:
+            pbar = tqdm(total=length//self.chunksize)
+        try:
+            while True:
+                item = read_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise(item)
+                pos, sigs_chunk = item
+                sig_index, preprocessed_chunk, total_spike, spikes = self.process_one_chunk(pos, sigs_chunk)
+                self._record_noise(sig_index)
+                if sig_index is not None:
+                    # the preprocessor could reuse its buffer
+                    preprocessed_chunk = preprocessed_chunk.copy()
+                write_queue.put((sig_index, preprocessed_chunk, spikes))
+                if progressbar:
+                    pbar.update(1)
+                if len(writer_errors)>0:
+                    break
+        finally:
+            stop_event.set()
+            reader_thread.join()
+            write_queue.put(None)
+            writer_thread.join()
+            if progressbar:
+                pbar.close()
+        
+        if len(writer_errors)>0:
+            raise(writer_errors[0])
+    
+    def run_offline_loop_one_shard(self, seg_num=0, i_start=0, i_stop=None, pre_roll=0, progressbar=False):
+        """
+        Peel only the time shard [i_start, i_stop[ of one segment.
+
+        This is used to split a long segment across several workers
+        (see peelertools.run_peeler_parallel).
+
+        The loop start pre_roll samples before i_start to settle the filter
+        state and the fifo of residuals, and continue after i_stop until all
+        spikes before i_stop are labeled. i_start and pre_roll must be multiple
+        of chunksize.
+
+        Processed signals are written only on [i_start, i_stop[ in the already
+        existing 'processed_signals' array (it is not reset here).
+
+        Returns spikes with index in [i_start, i_stop[ so that concatenating
+        consecutive shards give each spike only once.
+        
+        With a noise_time_constant in the catalogue, the running noise estimation
+        restart from the catalogue at each shard and the trajectory is not saved.
+        """
+        chan_grp = self.catalogue['chan_grp']
+        assert i_start % self.chunksize == 0, 'i_start must be a multiple of chunksize'
+        assert pre_roll % self.chunksize == 0, 'pre_roll must be a multiple of chunksize'
+
+        kargs = {}
+        kargs['sample_rate'] = self.dataio.sample_rate
+        kargs['nb_channel'] = self.dataio.nb_channel(chan_grp)
+        kargs['source_dtype'] = self.dataio.source_dtype
+        self._initialize_before_each_segment(**kargs)
+
+        length = self.dataio.get_segment_length(seg_num)
+        if i_stop is None:
+            i_stop = length
+
+        # spikes are given with a delay of lostfront_chunksize + n_side
+        lostfront_chunksize = self.signalpreprocessor.lostfront_chunksize
+        post_roll = (((lostfront_chunksize + self.n_side) // self.chunksize) + 2) * self.chunksize
+
+        iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=self.chunksize,
+                        i_start=max(i_start - pre_roll, 0), i_stop=min(i_stop + post_roll, length), signal_type='initial')
+        if progressbar:
+            iterator = tqdm(iterable=iterator, total=(i_stop - i_start + pre_roll + post_roll)//self.chunksize)
+
+        shard_spikes = []
+        for pos, sigs_chunk in iterator:
+            sig_index, preprocessed_chunk, total_spike, spikes = self.process_one_chunk(pos, sigs_chunk)
+
+            if sig_index<=0:
+                continue
+
+            # save only the part inside the shard (processed signals can be decimated)
+            ind0 = sig_index-preprocessed_chunk.shape[0]
+            i0 = max(ind0, i_start // self.decimation_factor)
+            i1 = min(sig_index, (i_stop + self.decimation_factor - 1) // self.decimation_factor)
+            if i1>i0:
+                self.dataio.set_signals_chunk(preprocessed_chunk[i0-ind0:i1-ind0], seg_num=seg_num,chan_grp=chan_grp,
+                            i_start=i0, i_stop=i1, signal_type='processed')
+
+            if spikes is not None and spikes.size>0:
+                shard_spikes.append(spikes)
+
+        if i_stop + post_roll >= length and len(self.near_border_good_spikes)>0:
+            # end of segment: deal with extra remaining spikes
+            extra_spikes = self.near_border_good_spikes[0]
+            extra_spikes = extra_spikes.take(np.argsort(extra_spikes['index']))
+            extra_spikes['index'] *= self.decimation_factor
+            shard_spikes.append(extra_spikes)
+
+        self.dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp)
+
+        if len(shard_spikes)>0:
+            shard_spikes = np.concatenate(shard_spikes)
+        else:
+            shard_spikes = np.zeros(0, dtype=_dtype_spike)
+        keep = (shard_spikes['index']>=i_start) & (shard_spikes['index']<i_stop)
+        return shard_spikes[keep]
 
     def run_offline_all_segment(self, **kargs):
         #TODO remove chan_grp here because it is redundant from catalogue['chan_grp']
@@ -563,7 +900,10 @@ class Peeler:
             # replace by this (indentique but faster, a but)
             
             #~ t1 = time.perf_counter()
-            d = catalogue['centers0']-waveform[None, :, :]
+            if self.good_channels is None:
+                d = catalogue['centers0_good']-waveform[None, :, :]
+            else:
+                d = catalogue['centers0_good']-waveform[None, :, self.good_channels]
             d *= d
             #s = d.sum(axis=1).sum(axis=1)  # intuitive
             #s = d.reshape(d.shape[0], -1).sum(axis=1) # a bit faster
@@ -635,11 +975,148 @@ class Peeler:
             #~ print('bad prediction')
             return LABEL_UNCLASSIFIED, 0.
 
+    def classify_and_align_batch(self, local_indexes, residual, catalogue):
+        """
+        Same as classify_and_align_one_spike but for several peaks at once.
 
-def make_prediction_signals(spikes, dtype, shape, catalogue, safe=True):
-    #~ n_left, peak_width, 
-    
-    prediction = np.zeros(shape, dtype=dtype)
+        All peaks are classified on the same residual.
+        Return a spikes array (_dtype_spike) with index local to residual.
+        """
+        width = catalogue['peak_width']
+        n_left = catalogue['n_left']
+        alien_value_threshold = catalogue['clean_waveforms_params']['alien_value_threshold']
+
+        spikes = np.zeros(len(local_indexes), dtype=_dtype_spike)
+        spikes['index'] = local_indexes
+        spikes['cluster_label'] = LABEL_UNCLASSIFIED
+        labels = spikes['cluster_label']
+        jitters = spikes['jitter']
+
+        #ind is the windows border!!!!!
+        ind = spikes['index'] + n_left
+
+        right_limit = (ind+width+maximum_jitter_shift+1)>=residual.shape[0]
+        left_limit = ~right_limit & (ind<=maximum_jitter_shift)
+        labels[right_limit] = LABEL_RIGHT_LIMIT
+        labels[left_limit] = LABEL_LEFT_LIMIT
+
+        if catalogue['centers0'].shape[0]==0:
+            # empty catalogue
+            return spikes
+
+        sel, = np.nonzero(~right_limit & ~left_limit)
+        if sel.size==0:
+            return spikes
+
+        waveforms = residual[ind[sel, None] + np.arange(width)[None, :], :]
+
+        if alien_value_threshold is not None:
+            alien = np.any(np.abs(waveforms)>alien_value_threshold, axis=(1, 2))
+            labels[sel[alien]] = LABEL_ALIEN
+            sel = sel[~alien]
+            waveforms = waveforms[~alien]
+
+        labels[sel], jitters[sel] = self.estimate_jitter_batch(waveforms)
+
+        # if more than one sample of jitter
+        # then we try a peak shift
+        # take it if better
+        sel = sel[(np.abs(jitters[sel])>0.5) & (labels[sel]>=0)]
+        shifts = -np.round(jitters[sel]).astype('int64')
+
+        too_far = np.abs(shifts)>maximum_jitter_shift
+        labels[sel[too_far]] = LABEL_MAXIMUM_SHIFT
+        sel, shifts = sel[~too_far], shifts[~too_far]
+
+        new_ind = ind[sel] + shifts
+        right_limit = (new_ind+width)>=residual.shape[0]
+        left_limit = ~right_limit & (new_ind<0)
+        labels[sel[right_limit]] = LABEL_RIGHT_LIMIT
+        labels[sel[left_limit]] = LABEL_LEFT_LIMIT
+        inside = ~right_limit & ~left_limit
+        sel, shifts, new_ind = sel[inside], shifts[inside], new_ind[inside]
+
+        if sel.size>0:
+            waveforms = residual[new_ind[:, None] + np.arange(width)[None, :], :]
+            new_labels, new_jitters = self.estimate_jitter_batch(waveforms)
+            better = np.abs(new_jitters)<np.abs(jitters[sel])
+            labels[sel[better]] = new_labels[better]
+            jitters[sel[better]] = new_jitters[better]
+            spikes['index'][sel[better]] += shifts[better]
+
+        #security if with jitter the index is out
+        good = labels>=0
+        local_pos = spikes['index'] - np.round(jitters).astype('int64') + n_left
+        labels[good & (local_pos<0)] = LABEL_LEFT_LIMIT
+        labels[good & (local_pos>=0) & ((local_pos+width)>=residual.shape[0])] = LABEL_RIGHT_LIMIT
+
+        return spikes
+
+    def estimate_jitter_batch(self, waveforms):
+        """
+        Same as estimate_one_jitter but for several waveforms (nb, width, nb_channel).
+
+        The distance to centers use ||w||^2 - 2*w.c + ||c||^2 so that
+        it is one matrix product for all waveforms and all clusters.
+        ||w||^2 do not change the argmin so it is not computed.
+
+        Return labels and jitters arrays.
+        """
+        catalogue = self.catalogue
+        n = waveforms.shape[0]
+
+        if self.good_channels is None:
+            flat_waveforms = waveforms.reshape(n, -1)
+        else:
+            flat_waveforms = waveforms[:, :, self.good_channels].reshape(n, -1)
+        s = catalogue['centers0_norm2'][None, :] - 2 * flat_waveforms.dot(catalogue['centers0_flat'].T)
+        cluster_idx = np.argmin(s, axis=1)
+
+        k = catalogue['cluster_labels'][cluster_idx]
+        chan = catalogue['max_on_channel'][cluster_idx]
+
+        wf0 = catalogue['centers0'][cluster_idx, :, chan]
+        wf1 = catalogue['centers1'][cluster_idx, :, chan]
+        wf2 = catalogue['centers2'][cluster_idx, :, chan]
+        wf = waveforms[np.arange(n), :, chan]
+
+        wf1_norm2= catalogue['wf1_norm2'][cluster_idx]
+        wf2_norm2 = catalogue['wf2_norm2'][cluster_idx]
+        wf1_dot_wf2 = catalogue['wf1_dot_wf2'][cluster_idx]
+
+        h = wf - wf0
+        h0_norm2 = np.sum(h**2, axis=1)
+        h_dot_wf1 = np.sum(h*wf1, axis=1)
+        jitter0 = h_dot_wf1/wf1_norm2
+        h1_norm2 = np.sum((h-jitter0[:, None]*wf1)**2, axis=1)
+
+        jitter1 = np.zeros(n)
+        #order 1 is better than order 0
+        order1 = h0_norm2 > h1_norm2
+        if np.any(order1):
+            j0 = jitter0[order1]
+            h_dot_wf2 = np.sum(h[order1]*wf2[order1], axis=1)
+            rss_first = -2*h_dot_wf1[order1] + 2*j0*(wf1_norm2[order1] - h_dot_wf2) + \
+                            3*j0**2*wf1_dot_wf2[order1] + j0**3*wf2_norm2[order1]
+            rss_second = 2*(wf1_norm2[order1] - h_dot_wf2) + 6*j0*wf1_dot_wf2[order1] + 3*j0**2*wf2_norm2[order1]
+            jitter1[order1] = j0 - rss_first/rss_second
+
+        #prediction should be smaller than original (which have noise)
+        pred = wf0 + jitter1[:, None]*wf1 + jitter1[:, None]**2/2*wf2
+        ok = np.sum(wf**2, axis=1) > np.sum((wf-pred)**2, axis=1)
+
+        labels = np.where(ok, k, LABEL_UNCLASSIFIED)
+        jitters = np.where(ok, jitter1, 0.)
+
+        return labels, jitters
+
+
+def _iter_prediction_waveforms(spikes, length, catalogue, safe=True):
+    """
+    Iterate over good spikes and yield (cluster_idx, pos, pred).
+    pred is the interpolated center with jitter (peak_width, nb_channel)
+    and pos its start inside a buffer of given length.
+    """
     for i in range(spikes.size):
         k = spikes[i]['cluster_label']
         if k<0: continue
@@ -690,8 +1167,8 @@ def make_prediction_signals(spikes, dtype, shape, catalogue, safe=True):
         #~ print(prediction[pos:pos+catalogue['peak_width'], :].shape)
         
         
-        if pos>=0 and  pos+catalogue['peak_width']<shape[0]:
-            prediction[pos:pos+catalogue['peak_width'], :] += pred
+        if pos>=0 and  pos+catalogue['peak_width']<length:
+            yield cluster_idx, pos, pred
         else:
             if not safe:
                 print(spikes)
@@ -702,16 +1179,42 @@ def make_prediction_signals(spikes, dtype, shape, catalogue, safe=True):
                 #~ spikes['LABEL_LEFT_LIMIT'][(local_pos<0)] = LABEL_LEFT_LIMIT
                 print('LEFT', (local_pos<0))
                 #~ spikes['cluster_label'][(local_pos+width)>=shape[0]] = LABEL_RIGHT_LIMIT
-                print('LABEL_RIGHT_LIMIT', (local_pos+width)>=shape[0])
+                print('LABEL_RIGHT_LIMIT', (local_pos+width)>=length)
                 
                 print('i', i)
-                print(dtype, shape, catalogue['n_left'], catalogue['peak_width'], pred.shape)
-                raise(ValueError('Border error {} {} {} {} {}'.format(pos, catalogue['peak_width'], shape, jitter, spikes[i])))
-                
-        
+                print(length, catalogue['n_left'], catalogue['peak_width'], pred.shape)
+                raise(ValueError('Border error {} {} {} {} {}'.format(pos, catalogue['peak_width'], length, jitter, spikes[i])))
+
+
+def make_prediction_signals(spikes, dtype, shape, catalogue, safe=True):
+    prediction = np.zeros(shape, dtype=dtype)
+    width = catalogue['peak_width']
+    for cluster_idx, pos, pred in _iter_prediction_waveforms(spikes, shape[0], catalogue, safe=safe):
+        prediction[pos:pos+width, :] += pred
+    
     return prediction
 
 
+def substract_prediction_signals(spikes, residual, catalogue, safe=True):
+    """
+    Substract in place the prediction of spikes from residual.
+    
+    Same as residual -= make_prediction_signals(...) but without
+    allocating and substracting a full size buffer for each spike.
+    
+    If the catalogue have 'substraction_channels' (see Peeler.change_params)
+    the prediction is only substracted on theses channels.
+    """
+    width = catalogue['peak_width']
+    substraction_channels = catalogue.get('substraction_channels', None)
+    for cluster_idx, pos, pred in _iter_prediction_waveforms(spikes, residual.shape[0], catalogue, safe=safe):
+        if substraction_channels is None:
+            residual[pos:pos+width, :] -= pred
+        else:
+            chans = substraction_channels[cluster_idx]
+            residual[pos:pos+width, chans] -= pred[:, chans]
+
+
     
     
     
@@ -29,6 +29,8 @@ class Peeler_OpenCl(Peeler):
         p['normalize'] = True
         p['signals_medians'] = self.catalogue['signals_medians']
         p['signals_mads'] = self.catalogue['signals_mads']
+        p['geometry'] = self.catalogue.get('geometry', None)
+        p['channel_mask'] = self.catalogue.get('channel_mask', None)
         self.signalpreprocessor.change_params(**p)
         
         
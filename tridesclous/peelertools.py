@@ -0,0 +1,255 @@
+"""
+Helpers around the Peeler.
+
+"""
+import os
+import time
+import concurrent.futures
+
+import numpy as np
+from tqdm import tqdm
+
+from .dataio import DataIO
+from .peeler import Peeler, _dtype_spike
+
+
+
+def _run_one_peeler_job(dirname, chan_grp, seg_num, catalogue_name, peeler_params, duration):
+    # each job have its own DataIO and Peeler, and write in its own segment arrays
+    dataio = DataIO(dirname=dirname)
+    catalogue = dataio.load_catalogue(name=catalogue_name, chan_grp=chan_grp)
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, **peeler_params)
+    t1 = time.perf_counter()
+    peeler.run_offline_loop_one_segment(seg_num=seg_num, duration=duration, progressbar=False)
+    t2 = time.perf_counter()
+    return chan_grp, seg_num, peeler.total_spike, t2-t1
+
+
+def _run_one_peeler_shard_job(dirname, chan_grp, seg_num, i_start, i_stop, pre_roll, catalogue_name, peeler_params):
+    # processed signals are written in the shared memmap (each shard its own rows)
+    # spikes are returned and merged by the main process
+    dataio = DataIO(dirname=dirname)
+    catalogue = dataio.load_catalogue(name=catalogue_name, chan_grp=chan_grp)
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, **peeler_params)
+    t1 = time.perf_counter()
+    spikes = peeler.run_offline_loop_one_shard(seg_num=seg_num, i_start=i_start, i_stop=i_stop,
+                                        pre_roll=min(pre_roll, i_start), progressbar=False)
+    t2 = time.perf_counter()
+    return chan_grp, seg_num, i_start, spikes, t2-t1
+
+
+def run_peeler_parallel(dataio, chan_grps=None, seg_nums=None, n_jobs=None,
+                catalogue_name='initial', peeler_params={}, duration=None,
+                shard_duration=None, pre_roll_duration=0.5, progressbar=True):
+    """
+    Run the Peeler on several (chan_grp, seg_num) in parallel with a process pool.
+
+    Each job is independent: it load the catalogue, run its own Peeler and write
+    processed signals and spikes of its own segment. This is equivalent to
+    run Peeler.run() on each channel group but use all cores.
+
+    With shard_duration, each segment is also splitted in time shards
+    (see Peeler.run_offline_loop_one_shard). Each shard start pre_roll_duration
+    before its start to settle the filters and only keep spikes inside
+    its own limits, so spikes in overlap zones are counted once.
+    Spikes of all shards are then concatenated in the segment 'spikes' array.
+    Near shard limits, results can very slightly differ from a sequential run
+    because of the filter warm-up.
+
+    Usage:
+
+      dataio = DataIO(dirname='mydir')
+      run_peeler_parallel(dataio, n_jobs=8, peeler_params={'chunksize' : 1024})
+
+    Parameters
+    ----------
+    dataio: DataIO
+        The dataio, processed arrays are reloaded at the end.
+    chan_grps: list or None
+        Channel groups to peel. None means all groups that have a catalogue.
+    seg_nums: list or None
+        Segments to peel. None means all segments.
+    n_jobs: int or None
+        Number of process. None means os.cpu_count().
+    catalogue_name: str
+        Name of the catalogue to load for each group.
+    peeler_params: dict
+        Params given to Peeler.change_params (except catalogue).
+    duration: float or None
+        Same as Peeler.run_offline_loop_one_segment.
+    shard_duration: float or None
+        Duration in s of time shards. None means one job per segment.
+    pre_roll_duration: float
+        Warm-up duration in s before each shard.
+    progressbar: bool
+        Display one progress bar over all jobs.
+
+    Returns
+    -------
+    results: dict
+        (chan_grp, seg_num) > (nb_spike, run_time)
+        run_time is the sum over shards.
+    """
+    if chan_grps is None:
+        chan_grps = [chan_grp for chan_grp in dataio.channel_groups.keys()
+                        if os.path.exists(os.path.join(dataio.channel_group_path[chan_grp], 'catalogues', catalogue_name))]
+    if seg_nums is None:
+        seg_nums = list(range(dataio.nb_segment))
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    assert 'catalogue' not in peeler_params, 'catalogue is loaded by each job with catalogue_name'
+
+    jobs = [(chan_grp, seg_num) for chan_grp in chan_grps for seg_num in seg_nums]
+
+    # each job open a DataIO that load all segments, so spikes are first reset
+    # to an empty array: arrays.json stay consistent while others process append spikes
+    for chan_grp, seg_num in jobs:
+        dataio.reset_spikes(seg_num=seg_num, chan_grp=chan_grp, dtype=_dtype_spike)
+        dataio.flush_spikes(seg_num=seg_num, chan_grp=chan_grp)
+
+    spikes_storage = {}
+    if shard_duration is not None:
+        chunksize = peeler_params.get('chunksize', 1024)
+        shard_size = max(int(shard_duration * dataio.sample_rate) // chunksize, 1) * chunksize
+        pre_roll = int(np.ceil(pre_roll_duration * dataio.sample_rate / chunksize)) * chunksize
+        for chan_grp, seg_num in jobs:
+            # shared by all shards, same dtype as Peeler.initialize_offline_segment
+            catalogue = dataio.load_catalogue(name=catalogue_name, chan_grp=chan_grp)
+            dtype = catalogue['signal_preprocessor_params'].get('output_dtype', 'float32')
+            dtype = catalogue.get('processed_signals_dtype', dtype)
+            decimation_factor = catalogue['signal_preprocessor_params'].get('decimation_factor', 1)
+            # shards write concurrently in the same array: 'compressed' storage is not possible
+            storage = catalogue.get('processed_signals_storage', 'memmap')
+            lazy_params = None
+            if storage == 'lazy':
+                lazy_params = dataio.make_lazy_params(catalogue['signal_preprocessor_params'], chunksize,
+                            catalogue['signals_medians'], catalogue['signals_mads'],
+                            channel_mask=catalogue.get('channel_mask', None), geometry=catalogue.get('geometry', None))
+            dataio.reset_processed_signals(seg_num=seg_num, chan_grp=chan_grp, dtype=dtype,
+                                    decimation_factor=decimation_factor,
+                                    storage='lazy' if storage=='lazy' else 'memmap', lazy_params=lazy_params)
+            spikes_storage[(chan_grp, seg_num)] = 'compressed' if storage=='compressed' else 'memmap'
+            dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp)
+
+    results = {}
+    shard_spikes = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = []
+        for chan_grp, seg_num in jobs:
+            if shard_duration is None:
+                futures.append(executor.submit(_run_one_peeler_job, dataio.dirname, chan_grp, seg_num,
+                                    catalogue_name, peeler_params, duration))
+            else:
+                if duration is not None:
+                    length = int(duration*dataio.sample_rate)
+                else:
+                    length = dataio.get_segment_length(seg_num)
+                shard_spikes[(chan_grp, seg_num)] = {}
+                for i_start in range(0, length, shard_size):
+                    i_stop = i_start + shard_size
+                    if i_stop + shard_size > length:
+                        # last shard is extended up to the end
+                        i_stop = length
+                    futures.append(executor.submit(_run_one_peeler_shard_job, dataio.dirname, chan_grp, seg_num,
+                                    i_start, i_stop, pre_roll, catalogue_name, peeler_params))
+                    if i_stop == length:
+                        break
+
+        iterator = concurrent.futures.as_completed(futures)
+        if progressbar:
+            iterator = tqdm(iterable=iterator, total=len(futures))
+        for future in iterator:
+            if shard_duration is None:
+                chan_grp, seg_num, nb_spike, run_time = future.result()
+                results[(chan_grp, seg_num)] = (nb_spike, run_time)
+            else:
+                chan_grp, seg_num, i_start, spikes, run_time = future.result()
+                shard_spikes[(chan_grp, seg_num)][i_start] = spikes
+                nb_spike, total_time = results.get((chan_grp, seg_num), (0, 0.))
+                results[(chan_grp, seg_num)] = (nb_spike + spikes.size, total_time + run_time)
+
+    # arrays have been written by others process
+    dataio._open_processed_data()
+
+    # merge shards in time order: each shard only keep spikes in its own limits
+    for (chan_grp, seg_num), shards in shard_spikes.items():
+        dataio.reset_spikes(seg_num=seg_num, chan_grp=chan_grp, dtype=_dtype_spike,
+                        storage=spikes_storage[(chan_grp, seg_num)])
+        for i_start in sorted(shards.keys()):
+            dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=shards[i_start])
+        dataio.flush_spikes(seg_num=seg_num, chan_grp=chan_grp)
+
+    return results
+
+
+def run_peelers_one_pass(dataio, chan_grps=None, seg_nums=None, catalogue_name='initial',
+                peeler_params={}, duration=None, progressbar=True):
+    """
+    Run the Peeler on several channel groups reading the raw signals only once.
+
+    Each raw chunk is read once (see DataIO.iter_over_chunk_multi_group) and
+    dispatched to the Peeler of every channel group in the same pass.
+    This is useful for probes with many shanks when reading the raw file
+    is the bottleneck. Results are the same as Peeler.run() on each group.
+
+    Parameters
+    ----------
+    dataio: DataIO
+        The dataio.
+    chan_grps: list or None
+        Channel groups to peel. None means all groups that have a catalogue.
+    seg_nums: list or None
+        Segments to peel. None means all segments.
+    catalogue_name: str
+        Name of the catalogue to load for each group.
+    peeler_params: dict
+        Params given to Peeler.change_params (except catalogue), same for all groups.
+    duration: float or None
+        Same as Peeler.run_offline_loop_one_segment.
+    progressbar: bool
+        Display progress bar.
+
+    Returns
+    -------
+    peelers: dict
+        chan_grp > Peeler
+    """
+    if chan_grps is None:
+        chan_grps = [chan_grp for chan_grp in dataio.channel_groups.keys()
+                        if os.path.exists(os.path.join(dataio.channel_group_path[chan_grp], 'catalogues', catalogue_name))]
+    if seg_nums is None:
+        seg_nums = list(range(dataio.nb_segment))
+
+    assert 'catalogue' not in peeler_params, 'catalogue is loaded with catalogue_name'
+    
+    if len(chan_grps) == 0:
+        return {}
+
+    peelers = {}
+    for chan_grp in chan_grps:
+        catalogue = dataio.load_catalogue(name=catalogue_name, chan_grp=chan_grp)
+        peeler = Peeler(dataio)
+        peeler.change_params(catalogue=catalogue, **peeler_params)
+        peelers[chan_grp] = peeler
+
+    chunksize = peelers[chan_grps[0]].chunksize
+
+    for seg_num in seg_nums:
+        lengths = [peeler.initialize_offline_segment(seg_num=seg_num, duration=duration) for peeler in peelers.values()]
+        length = lengths[0]
+
+        iterator = dataio.iter_over_chunk_multi_group(seg_num=seg_num, chan_grps=chan_grps,
+                                            chunksize=chunksize, i_stop=length)
+        if progressbar:
+            iterator = tqdm(iterable=iterator, total=length//chunksize)
+        for pos, sigs_chunks in iterator:
+            for chan_grp, peeler in peelers.items():
+                peeler.process_and_write_one_chunk(seg_num, pos, sigs_chunks[chan_grp])
+
+        for peeler in peelers.values():
+            peeler.finalize_offline_segment(seg_num=seg_num)
+
+    return peelers
@@ -2,13 +2,44 @@
 Very basic comand line for tridesclous
 
 
+makecatalogue and runpeeler are batch commands (no GUI) driven by
+a JSON parameter file (-p), for instance:
+
+    {
+        "fullchain_kargs": {
+            "duration": 300.,
+            "preprocessor": {"highpass_freq": 300., "chunksize": 1024, "lostfront_chunksize": 100},
+            "peak_detector": {"peak_sign": "-", "relative_threshold": 5.5, "peak_span": 0.0002},
+            "noise_snippet": {"nb_snippet": 300},
+            "extract_waveforms": {"n_left": -20, "n_right": 30, "nb_max": 20000},
+            "clean_waveforms": {"alien_value_threshold": 100.}
+        },
+        "feat_method": "global_pca",
+        "feat_kargs": {"n_components": 5},
+        "clust_method": "sawchaincut",
+        "clust_kargs": {},
+        "trash_small_cluster": {"n": 10},
+        "order_clusters": {"by": "waveforms_rms"},
+        "peeler_params": {"chunksize": 1024}
+    }
+
+Usage:
+
+    tdc makecatalogue -d mydir -p params.json -j 8
+    tdc runpeeler -d mydir -p params.json -j 8 --timing
+
+Exit status is 0 when all channel groups succeed and 1 otherwise.
+
 """
 import sys
 import os
 import argparse
+import json
+import time
+import traceback
+import concurrent.futures
 
 
-import pyqtgraph as pg
 import tridesclous as tdc
 
 comand_list =[
@@ -22,77 +53,238 @@ comand_list =[
 txt_command_list = ', '.join(comand_list)
 
 
+default_batch_params = {
+    'feat_method': 'global_pca',
+    'feat_kargs': {'n_components': 5},
+    'clust_method': 'sawchaincut',
+    'clust_kargs': {},
+    'trash_small_cluster': {},
+    'order_clusters': {'by': 'waveforms_rms'},
+    'peeler_params': {},
+}
+
+
 def open_mainwindow():
-        app = pg.mkQApp()
+        app = tdc.mkQApp()
         win = tdc.MainWindow()
         win.show()
-        app.exec_()            
-    
-def main():
-    argv = sys.argv[1:]
+        app.exec_()
+
+
+def load_batch_params(filename):
+    params = dict(default_batch_params)
+    if filename is not None:
+        with open(filename, 'r', encoding='utf8') as f:
+            params.update(json.load(f))
+    return params
+
+
+def make_one_catalogue(dirname, chan_grp, params, timing=False):
+    """
+    Run all catalogue steps for one channel group and save the catalogue for the Peeler.
+    Return a dict of step > run time.
+    """
+    times = {}
+    dataio = tdc.DataIO(dirname=dirname)
+    cc = tdc.CatalogueConstructor(dataio=dataio, chan_grp=chan_grp)
+
+    t1 = time.perf_counter()
+    tdc.apply_all_catalogue_steps(cc, params['fullchain_kargs'],
+                params['feat_method'], params['feat_kargs'],
+                params['clust_method'], params['clust_kargs'], verbose=timing)
+    t2 = time.perf_counter()
+    times['apply_all_catalogue_steps'] = t2-t1
+
+    if params['trash_small_cluster'] is not None:
+        t1 = time.perf_counter()
+        cc.trash_small_cluster(**params['trash_small_cluster'])
+        t2 = time.perf_counter()
+        times['trash_small_cluster'] = t2-t1
+
+    if params['order_clusters'] is not None:
+        t1 = time.perf_counter()
+        cc.order_clusters(**params['order_clusters'])
+        t2 = time.perf_counter()
+        times['order_clusters'] = t2-t1
+
+    t1 = time.perf_counter()
+    cc.make_catalogue_for_peeler()
+    t2 = time.perf_counter()
+    times['make_catalogue_for_peeler'] = t2-t1
+
+    return times
+
+
+def _make_one_catalogue_job(dirname, chan_grp, params, timing):
+    try:
+        return chan_grp, make_one_catalogue(dirname, chan_grp, params, timing=timing), None
+    except Exception:
+        return chan_grp, None, traceback.format_exc()
+
+
+def run_makecatalogue(dirname, chan_grps, params, n_jobs=1, timing=False):
+    """
+    Make catalogues for several channel groups, in parallel when n_jobs>1.
+    Return the number of failed channel groups.
+    """
+    assert 'fullchain_kargs' in params, 'parameters file must have "fullchain_kargs"'
+
+    if n_jobs == 1:
+        results = [_make_one_catalogue_job(dirname, chan_grp, params, timing) for chan_grp in chan_grps]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_make_one_catalogue_job, dirname, chan_grp, params, timing)
+                                    for chan_grp in chan_grps]
+            results = [future.result() for future in futures]
+
+    nb_error = 0
+    for chan_grp, times, error in results:
+        if error is not None:
+            print('chan_grp {} makecatalogue FAILED\n{}'.format(chan_grp, error), file=sys.stderr)
+            nb_error += 1
+        elif timing:
+            for step, t in times.items():
+                print('chan_grp {} {} {:.3f}s'.format(chan_grp, step, t))
+    return nb_error
+
+
+def run_runpeeler(dirname, chan_grps, params, n_jobs=1, timing=False, shard_duration=None):
+    """
+    Run the Peeler on several channel groups (all segments).
+    Return the number of failed channel groups.
+    """
+    dataio = tdc.DataIO(dirname=dirname)
+    peeler_params = dict(params['peeler_params'])
+    duration = peeler_params.pop('duration', None)
+
+    nb_error = 0
+    ok_chan_grps = []
+    for chan_grp in chan_grps:
+        if dataio.load_catalogue(chan_grp=chan_grp) is None:
+            print('chan_grp {} runpeeler FAILED: catalogue do not exists, do makecatalogue first'.format(chan_grp), file=sys.stderr)
+            nb_error += 1
+        else:
+            ok_chan_grps.append(chan_grp)
+
+    if len(ok_chan_grps) == 0:
+        return nb_error
+
+    t1 = time.perf_counter()
+    if n_jobs == 1 and shard_duration is None:
+        results = {}
+        for chan_grp in ok_chan_grps:
+            try:
+                catalogue = dataio.load_catalogue(chan_grp=chan_grp)
+                peeler = tdc.Peeler(dataio)
+                peeler.change_params(catalogue=catalogue, **peeler_params)
+                for seg_num in range(dataio.nb_segment):
+                    t3 = time.perf_counter()
+                    peeler.run_offline_loop_one_segment(seg_num=seg_num, duration=duration, progressbar=False)
+                    t4 = time.perf_counter()
+                    results[(chan_grp, seg_num)] = (peeler.total_spike, t4-t3)
+            except Exception:
+                print('chan_grp {} runpeeler FAILED\n{}'.format(chan_grp, traceback.format_exc()), file=sys.stderr)
+                nb_error += 1
+    else:
+        try:
+            results = tdc.run_peeler_parallel(dataio, chan_grps=ok_chan_grps, n_jobs=n_jobs,
+                            peeler_params=peeler_params, duration=duration,
+                            shard_duration=shard_duration, progressbar=False)
+        except Exception:
+            print('runpeeler FAILED\n{}'.format(traceback.format_exc()), file=sys.stderr)
+            return nb_error + len(ok_chan_grps)
+    t2 = time.perf_counter()
+
+    if timing:
+        for (chan_grp, seg_num), (nb_spike, run_time) in sorted(results.items()):
+            print('chan_grp {} seg_num {} nb_spike {} {:.3f}s'.format(chan_grp, seg_num, nb_spike, run_time))
+        print('runpeeler total {:.3f}s'.format(t2-t1))
+
+    return nb_error
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
 
     parser = argparse.ArgumentParser(description='tridesclous')
     parser.add_argument('command', help='command in [{}]'.format(txt_command_list), default='mainwin', nargs='?')
-    
+
     parser.add_argument('-d', '--dirname', help='working directory', default=None)
-    parser.add_argument('-c', '--chan_grp', type=int, help='channel group index', default=0)
+    parser.add_argument('-c', '--chan_grp', type=int, nargs='*',
+                help='channel group index (several for batch commands, default all)', default=None)
     parser.add_argument('-p', '--parameters', help='JSON parameter file', default=None)
-    
-    
+    parser.add_argument('-j', '--n_jobs', type=int, help='number of process for batch commands', default=1)
+    parser.add_argument('-t', '--timing', action='store_true', help='print run time of each step')
+    parser.add_argument('--shard_duration', type=float, default=None,
+                help='runpeeler: split segments in time shards of this duration (s)')
+
+
     args = parser.parse_args(argv)
     #~ print(sys.argv)
     #~ print(args)
     #~ print(args.command)
-    
+
     command = args.command
     if not command in comand_list:
-        print('command should be in [{}]'.format(txt_command_list))
-        exit()
-    
+        print('command should be in [{}]'.format(txt_command_list), file=sys.stderr)
+        return 1
+
     dirname = args.dirname
     if dirname is None:
         dirname = os.getcwd()
-    
+
     #~ print(command)
-    
-    if command in ['cataloguewin', 'peelerwin']:
+
+    if command in ['cataloguewin', 'peelerwin', 'makecatalogue', 'runpeeler']:
         if not tdc.DataIO.check_initialized(dirname):
-            print('{} is not initialized'.format(dirname))
-            exit()
+            print('{} is not initialized'.format(dirname), file=sys.stderr)
+            return 1
         dataio = tdc.DataIO(dirname=dirname)
         print(dataio)
-    
+
+    if command in ['makecatalogue', 'runpeeler']:
+        chan_grps = args.chan_grp
+        if chan_grps is None or len(chan_grps) == 0:
+            chan_grps = list(dataio.channel_groups.keys())
+        params = load_batch_params(args.parameters)
+    else:
+        chan_grp = args.chan_grp[0] if args.chan_grp else 0
+
     if command=='mainwin':
         open_mainwindow()
-    
+
     elif command=='makecatalogue':
-        pass
-    
+        nb_error = run_makecatalogue(dirname, chan_grps, params, n_jobs=args.n_jobs, timing=args.timing)
+        return 1 if nb_error>0 else 0
+
     elif command=='runpeeler':
-        pass
-        
+        nb_error = run_runpeeler(dirname, chan_grps, params, n_jobs=args.n_jobs, timing=args.timing,
+                                shard_duration=args.shard_duration)
+        return 1 if nb_error>0 else 0
+
     elif command=='cataloguewin':
-        catalogueconstructor = tdc.CatalogueConstructor(dataio=dataio, chan_grp=args.chan_grp)
-        app = pg.mkQApp()
+        catalogueconstructor = tdc.CatalogueConstructor(dataio=dataio, chan_grp=chan_grp)
+        app = tdc.mkQApp()
         win = tdc.CatalogueWindow(catalogueconstructor)
         win.show()
-        app.exec_()    
-        
+        app.exec_()
+
     elif command=='peelerwin':
-        initial_catalogue = dataio.load_catalogue(chan_grp=args.chan_grp)
-        app = pg.mkQApp()
+        initial_catalogue = dataio.load_catalogue(chan_grp=chan_grp)
+        app = tdc.mkQApp()
         win = tdc.PeelerWindow(dataio=dataio, catalogue=initial_catalogue)
         win.show()
         app.exec_()
-    
+
     elif command=='init':
-        app = pg.mkQApp()
+        app = tdc.mkQApp()
         win = tdc.InitializeDatasetWindow()
         win.show()
-        app.exec_()    
-    
-    
+        app.exec_()
+
+    return 0
 
-if __name__ =='__main__':
-    open_mainwindow()
 
+if __name__ =='__main__':
+    sys.exit(main())
@@ -1,4 +1,11 @@
+import os
+import concurrent.futures
+import importlib.util
+
 import scipy.signal
+import scipy.fft
+import scipy.special
+import scipy.sparse
 import numpy as np
 
 try:
@@ -8,16 +15,103 @@ try:
 except ImportError:
     HAVE_PYOPENCL = False
 
+try:
+    # in place cython kernel used by scipy.signal.sosfilt
+    from scipy.signal._sosfilt import _sosfilt
+    HAVE_INPLACE_SOSFILT = True
+except ImportError:
+    HAVE_INPLACE_SOSFILT = False
+
 
 #~ from pyacq.dsp.overlapfiltfilt import SosFiltfilt_Scipy
-from .tools import FifoBuffer, median_mad
+from .tools import FifoBuffer, median_mad, get_neighborhood
+
+# numba is slow to import so numba_tools is only imported by SignalPreprocessor_Numba
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
+
+common_ref_modes = ['median', 'mean', 'median_subset', 'local_mean']
+
+# number of channels for the approximated median of 'median_subset'
+_median_subset_size = 32
+
+# anti alias lowpass relative to the nyquist after decimation
+_anti_alias_ratio = 0.8
+
+
+def _anti_alias_lowpass(sample_rate, lowpass_freq, decimation_factor):
+    if decimation_factor == 1:
+        return lowpass_freq
+    anti_alias_freq = _anti_alias_ratio * sample_rate / decimation_factor / 2.
+    if lowpass_freq is None or lowpass_freq > anti_alias_freq:
+        lowpass_freq = anti_alias_freq
+    return lowpass_freq
+
+
+def _check_common_ref_mode(common_ref_removal):
+    # True is the historical exact median
+    if common_ref_removal is None or common_ref_removal is False:
+        return None
+    if common_ref_removal is True:
+        return 'median'
+    assert common_ref_removal in common_ref_modes, 'common_ref_removal must be bool or in {}'.format(common_ref_modes)
+    return common_ref_removal
+
+
+def make_local_ref_matrix(geometry, radius_um, dtype='float32'):
+    """
+    Sparse matrix (nb_channel, nb_channel) for the 'local_mean' reference: matrix @ sigs.T
+    is for each channel the mean of its neighbours (within radius_um, itself excluded).
+    A channel without neighbour is left untouched.
+    """
+    neighborhood = get_neighborhood(np.asarray(geometry), radius_um).astype(dtype)
+    np.fill_diagonal(neighborhood, 0.)
+    nb_neighbour = neighborhood.sum(axis=1)
+    nb_neighbour[nb_neighbour==0] = 1.
+    return scipy.sparse.csr_matrix(neighborhood / nb_neighbour[:, None])
+
+
+def substract_common_ref(sigs, mode, local_ref_matrix=None):
+    """
+    Remove in place the common reference of sigs (sample, channel).
+    
+    mode:
+      * 'median': exact median across channels sample by sample.
+      * 'mean': mean across channels, much faster than median but sensitive to spikes
+        with high channel count.
+      * 'median_subset': median (quickselect) on a subset of _median_subset_size channels
+        regularly spaced, approximation of 'median'.
+      * 'local_mean': mean of neighbour channels, need local_ref_matrix (see make_local_ref_matrix).
+    """
+    if mode == 'median':
+        sigs -= np.median(sigs, axis=1)[:, None]
+    elif mode == 'mean':
+        sigs -= np.mean(sigs, axis=1)[:, None]
+    elif mode == 'median_subset':
+        step = max(sigs.shape[1] // _median_subset_size, 1)
+        if step == 1:
+            sigs -= np.median(sigs, axis=1)[:, None]
+        else:
+            subset = sigs[:, ::step].copy()
+            k = subset.shape[1] // 2
+            subset.partition(k, axis=1)
+            sigs -= subset[:, k:k+1]
+    elif mode == 'local_mean':
+        assert local_ref_matrix is not None, 'local_mean need local_ref_matrix'
+        # sparse product is faster on (channel, sample) contiguous signals
+        sigs -= (local_ref_matrix @ np.ascontiguousarray(sigs.T)).T
+    else:
+        raise ValueError('Unknown common_ref_removal {}'.format(mode))
 
 
 def offline_signal_preprocessor(sigs, sample_rate, common_ref_removal=True,
-        highpass_freq=300., lowpass_freq=None, output_dtype='float32', normalize=True, **unused):
+        highpass_freq=300., lowpass_freq=None, output_dtype='float32', normalize=True,
+        geometry=None, common_ref_radius_um=100., decimation_factor=1, **unused):
     #cast
     sigs = sigs.astype(output_dtype)
     
+    lowpass_freq = _anti_alias_lowpass(sample_rate, lowpass_freq, decimation_factor)
+    
     #filter
     if highpass_freq is not None:
         b, a = scipy.signal.iirfilter(5, highpass_freq/sample_rate*2, analog=False,
@@ -30,11 +124,20 @@ def offline_signal_preprocessor(sigs, sample_rate, common_ref_removal=True,
         b, a = scipy.signal.iirfilter(5, lowpass_freq/sample_rate*2, analog=False,
                                         btype = 'lowpass', ftype = 'butter', output = 'ba')
         filtered_sigs = scipy.signal.filtfilt(b, a, filtered_sigs, axis=0)
-        
+    
+    # decimation
+    if decimation_factor > 1:
+        filtered_sigs = filtered_sigs[::decimation_factor]
 
     # common reference removal
-    if common_ref_removal:
-        filtered_sigs = filtered_sigs - np.median(filtered_sigs, axis=1)[:, None]
+    common_ref_removal = _check_common_ref_mode(common_ref_removal)
+    if common_ref_removal is not None:
+        if common_ref_removal == 'local_mean':
+            assert geometry is not None, 'common_ref_removal local_mean need geometry'
+            local_ref_matrix = make_local_ref_matrix(geometry, common_ref_radius_um, dtype=filtered_sigs.dtype)
+        else:
+            local_ref_matrix = None
+        substract_common_ref(filtered_sigs, common_ref_removal, local_ref_matrix)
     
     # normalize
     if normalize:
@@ -61,10 +164,67 @@ def estimate_medians_mads_after_preprocesing(sigs, sample_rate, **params):
     
 
 
+class RunningNoiseEstimator:
+    """
+    Streaming robust estimation of medians and mads of each channel.
+    
+    Each channel have an histogram with exponential forgetting (time_constant in s),
+    so memory is constant whatever the duration.
+    The median is the 50% quantile and the mad is estimated with the interquartile
+    range: (q75-q25)/2*1.4826 which is the same as median(|x-med|)*1.4826
+    for a symmetric noise.
+    
+    The histogram range is +-nb_mad_range initial mads around initial medians
+    and it start with a gaussian of initial medians/mads with a weight
+    of time_constant, so estimations start smoothly from initial values.
+    """
+    def __init__(self, signals_medians, signals_mads, sample_rate, time_constant, nbins=512, nb_mad_range=16.):
+        self.medians = np.array(signals_medians, dtype='float64')
+        self.mads = np.array(signals_mads, dtype='float64')
+        self.nb_channel = self.medians.size
+        self.sample_rate = sample_rate
+        self.time_constant = time_constant
+        self.nbins = nbins
+        
+        self.bin_lows = self.medians - nb_mad_range * self.mads
+        self.bin_widths = 2 * nb_mad_range * self.mads / nbins
+        
+        edges = np.linspace(-nb_mad_range, nb_mad_range, nbins+1)
+        gaussian = np.diff(scipy.special.ndtr(edges)) * sample_rate * time_constant
+        self.histograms = np.tile(gaussian[None, :], (self.nb_channel, 1))
+        self.channel_offsets = np.arange(self.nb_channel) * nbins
+    
+    def new_chunk(self, data):
+        """
+        Update histograms with a chunk (sample, channel) and then medians and mads.
+        """
+        n = data.shape[0]
+        self.histograms *= np.exp(-n / (self.sample_rate * self.time_constant))
+        
+        ind = np.floor((data - self.bin_lows) / self.bin_widths).astype('int64')
+        np.clip(ind, 0, self.nbins-1, out=ind)
+        ind += self.channel_offsets
+        counts = np.bincount(ind.flatten(), minlength=self.nb_channel * self.nbins)
+        self.histograms += counts.reshape(self.nb_channel, self.nbins)
+        
+        cumsum = np.cumsum(self.histograms, axis=1)
+        q25, q50, q75 = [self._quantile(cumsum, q) for q in (.25, .5, .75)]
+        self.medians = q50
+        self.mads = (q75 - q25) / 2. * 1.4826
+    
+    def _quantile(self, cumsum, q):
+        target = cumsum[:, -1] * q
+        ind = np.argmax(cumsum >= target[:, None], axis=1)
+        chans = np.arange(self.nb_channel)
+        before = cumsum[chans, ind] - self.histograms[chans, ind]
+        frac = (target - before) / np.maximum(self.histograms[chans, ind], 1e-12)
+        return self.bin_lows + (ind + frac) * self.bin_widths
+
+
 class SignalPreprocessor_base:
     def __init__(self,sample_rate, nb_channel, chunksize, input_dtype):
         self.sample_rate = sample_rate
-        self.nb_channel = nb_channel
+        self.full_nb_channel = self.nb_channel = nb_channel
         self.chunksize = chunksize
         self.input_dtype = input_dtype
 
@@ -76,12 +236,38 @@ class SignalPreprocessor_base:
                                             output_dtype='float32', 
                                             normalize=True,
                                             lostfront_chunksize = None,
-                                            signals_medians=None, signals_mads=None):
+                                            signals_medians=None, signals_mads=None,
+                                            noise_time_constant=None,
+                                            geometry=None, common_ref_radius_um=100.,
+                                            decimation_factor=1, channel_mask=None):
+        
+        # masked channels (bad channels) are not processed at all and are 0 in output
+        if channel_mask is not None and not np.all(channel_mask):
+            self.good_channels, = np.nonzero(channel_mask)
+            self.nb_channel = self.good_channels.size
+            assert self.nb_channel>0, 'all channels are masked'
+            if signals_medians is not None:
+                signals_medians = np.asarray(signals_medians)[self.good_channels]
+            if signals_mads is not None:
+                signals_mads = np.asarray(signals_mads)[self.good_channels]
+            if geometry is not None:
+                geometry = np.asarray(geometry)[self.good_channels]
+        else:
+            self.good_channels = None
+            self.nb_channel = self.full_nb_channel
+        
+        self.decimation_factor = int(decimation_factor)
+        assert self.decimation_factor>=1, 'decimation_factor must be >=1'
+        assert self.chunksize % self.decimation_factor == 0, 'chunksize must be a multiple of decimation_factor'
+        self.output_sample_rate = self.sample_rate / self.decimation_factor
+        lowpass_freq = _anti_alias_lowpass(self.sample_rate, lowpass_freq, self.decimation_factor)
         
         self.signals_medians = signals_medians
         self.signals_mads = signals_mads
+        self.noise_time_constant = noise_time_constant
         
-        self.common_ref_removal = common_ref_removal
+        self.common_ref_removal = _check_common_ref_mode(common_ref_removal)
+        self.common_ref_radius_um = common_ref_radius_um
         self.highpass_freq = highpass_freq
         self.lowpass_freq = lowpass_freq
         self.smooth_size = int(smooth_size)
@@ -94,6 +280,10 @@ class SignalPreprocessor_base:
             self.lostfront_chunksize = int(self.sample_rate/self.highpass_freq*3)
             #~ print('self.lostfront_chunksize', self.lostfront_chunksize)
         
+        # output chunks start on a sample kept by the decimation
+        q = self.decimation_factor
+        self.lostfront_chunksize = ((self.lostfront_chunksize + q - 1) // q) * q
+        
         self.backward_chunksize = self.chunksize + self.lostfront_chunksize
         #~ print('self.lostfront_chunksize', self.lostfront_chunksize)
         #~ print('self.backward_chunksize', self.backward_chunksize)
@@ -137,11 +327,59 @@ class SignalPreprocessor_base:
         self.forward_buffer = FifoBuffer((self.backward_chunksize, self.nb_channel), self.output_dtype)
         self.zi = np.zeros((self.nb_section, 2, self.nb_channel), dtype= self.output_dtype)
         
+        if self.common_ref_removal == 'local_mean':
+            assert geometry is not None, 'common_ref_removal local_mean need geometry'
+            self.local_ref_matrix = make_local_ref_matrix(geometry, self.common_ref_radius_um, dtype=self.output_dtype)
+        else:
+            self.local_ref_matrix = None
+        
         #~ print('self.normalize', self.normalize)
         if self.normalize:
             assert self.signals_medians is not None
             assert self.signals_mads is not None
-            
+        
+        # medians and mads follow the noise along the recording
+        if self.normalize and self.noise_time_constant is not None:
+            self.noise_estimator = RunningNoiseEstimator(self.signals_medians, self.signals_mads,
+                                            self.output_sample_rate, self.noise_time_constant)
+        else:
+            self.noise_estimator = None
+    
+    def process_data(self, pos, data):
+        """
+        Process a chunk (sample, channel) ending at pos.
+        Return pos2 (end of the processed chunk) and the processed chunk,
+        or (None, None) at the beginning.
+        """
+        if self.good_channels is None:
+            return self._process_data(pos, data)
+        
+        pos2, data2 = self._process_data(pos, data[:, self.good_channels])
+        if data2 is None:
+            return pos2, data2
+        out = np.zeros((data2.shape[0], self.full_nb_channel), dtype=data2.dtype)
+        out[:, self.good_channels] = data2
+        return pos2, out
+    
+    def _decimate(self, pos2, data2):
+        # keep samples with absolute index multiple of decimation_factor
+        # pos2 is then given in the decimated time base
+        q = self.decimation_factor
+        if q == 1:
+            return pos2, data2
+        first = (data2.shape[0] - pos2) % q
+        return (pos2 + q - 1) // q, data2[first::q]
+    
+    def _substract_common_ref(self, data2):
+        substract_common_ref(data2, self.common_ref_removal, self.local_ref_matrix)
+    
+    def _normalize(self, data2):
+        if self.noise_estimator is not None:
+            self.noise_estimator.new_chunk(data2)
+            self.signals_medians = self.noise_estimator.medians.astype(self.output_dtype)
+            self.signals_mads = self.noise_estimator.mads.astype(self.output_dtype)
+        data2 -= self.signals_medians
+        data2 /= self.signals_mads
 
 
 class SignalPreprocessor_Numpy(SignalPreprocessor_base):
@@ -153,7 +391,7 @@ class SignalPreprocessor_Numpy(SignalPreprocessor_base):
     
     """
         
-    def process_data(self, pos, data):
+    def _process_data(self, pos, data):
         
         
 
@@ -213,20 +451,125 @@ class SignalPreprocessor_Numpy(SignalPreprocessor_base):
         
         #~ print('pos', pos, 'pos2', pos2, data2.shape)
         
+        pos2, data2 = self._decimate(pos2, data2)
+        
         # removal ref
         if self.common_ref_removal:
-            data2 -= np.median(data2, axis=1)[:, None]
+            self._substract_common_ref(data2)
         
         #normalize
         if self.normalize:
-            data2 -= self.signals_medians
-            data2 /= self.signals_mads
+            self._normalize(data2)
         
         return pos2, data2
     
 
+
+class SignalPreprocessor_NumpyThread(SignalPreprocessor_base):
+    """
+    Same as SignalPreprocessor_Numpy but channels are splitted in blocks
+    and each block is filtered (forward and backward) in a thread pool.
+    scipy.signal.sosfilt release the GIL so this scale with the number of
+    cores for high channel count.
+    
+    Then common reference removal (that need all channels) and
+    normalization are done by blocks of samples in the same pool.
+    With noise_time_constant, normalization is done after on the whole chunk.
+    
+    Results are strictly the same as SignalPreprocessor_Numpy.
+    
+    nb_thread (change_params) is the number of threads, None is os.cpu_count().
+    The number of blocks is limited to have at least min_channel_per_block
+    channels per block.
+    """
+    min_channel_per_block = 8
+    
+    def change_params(self, nb_thread=None, **kargs):
+        SignalPreprocessor_base.change_params(self, **kargs)
         
+        if nb_thread is None:
+            nb_thread = os.cpu_count()
+        self.nb_thread = nb_thread
+        nb_block = max(1, min(nb_thread, self.nb_channel // self.min_channel_per_block))
+        limits = np.linspace(0, self.nb_channel, nb_block + 1).astype('int64')
+        self.channel_blocks = [slice(limits[i], limits[i+1]) for i in range(nb_block)]
+        
+        # each block have its own forward state and backward fifo
+        self.forward_buffers = []
+        self.zis = []
+        for sl in self.channel_blocks:
+            n = sl.stop - sl.start
+            self.forward_buffers.append(FifoBuffer((self.backward_chunksize, n), self.output_dtype))
+            self.zis.append(np.zeros((self.nb_section, 2, n), dtype= self.output_dtype))
+        
+        if getattr(self, 'thread_pool', None) is not None:
+            self.thread_pool.shutdown()
+        self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=nb_thread)
+    
+    def _filter_one_block(self, b, pos, chunk, i1, i2, data2):
+        sl = self.channel_blocks[b]
+        forward_chunk_filtered, self.zis[b] = scipy.signal.sosfilt(self.coefficients, chunk[:, sl], zi=self.zis[b], axis=0)
+        forward_chunk_filtered = forward_chunk_filtered.astype(self.output_dtype)
+        
+        forward_buffer = self.forward_buffers[b]
+        forward_buffer.new_chunk(forward_chunk_filtered, index=pos)
+        
+        backward_chunk = forward_buffer.buffer
+        backward_filtered = scipy.signal.sosfilt(self.coefficients, backward_chunk[::-1, :], zi=None, axis=0)
+        backward_filtered = backward_filtered[::-1, :]
+        data2[:, sl] = backward_filtered[i1:i2]
+        
+        if not self.common_ref_removal and self.normalize and self.noise_estimator is None and self.decimation_factor==1:
+            data2[:, sl] -= self.signals_medians[sl]
+            data2[:, sl] /= self.signals_mads[sl]
+    
+    def _ref_and_normalize_one_block(self, sl, data2):
+        block = data2[sl, :]
+        self._substract_common_ref(block)
+        if self.normalize and self.noise_estimator is None:
+            block -= self.signals_medians
+            block /= self.signals_mads
+    
+    def _process_data(self, pos, data):
+        chunk = data.astype(self.output_dtype)
         
+        pos2 = pos-self.lostfront_chunksize
+        i1 = self.backward_chunksize-self.lostfront_chunksize-chunk.shape[0]
+        i2 = self.chunksize
+        assert i1<i2
+        if (pos2-(i2-i1))<0:
+            i1 = i2 - max(pos2, 0)
+        data2 = np.empty((i2-i1, self.nb_channel), dtype=self.output_dtype)
+        
+        # filter state must be updated even when nothing is returned
+        futures = [self.thread_pool.submit(self._filter_one_block, b, pos, chunk, i1, i2, data2)
+                                    for b in range(len(self.channel_blocks))]
+        for future in futures:
+            future.result()
+        
+        if pos2<0:
+            return None, None
+        
+        pos2, data2 = self._decimate(pos2, data2)
+        
+        if self.common_ref_removal:
+            limits = np.linspace(0, data2.shape[0], len(self.channel_blocks) + 1).astype('int64')
+            futures = [self.thread_pool.submit(self._ref_and_normalize_one_block, slice(limits[i], limits[i+1]), data2)
+                                    for i in range(len(self.channel_blocks))]
+            for future in futures:
+                future.result()
+        elif self.normalize and self.noise_estimator is None and self.decimation_factor>1:
+            # normalize only kept samples
+            self._normalize(data2)
+        
+        if self.normalize and self.noise_estimator is not None:
+            # the estimator need the whole chunk before normalization
+            self._normalize(data2)
+        
+        return pos2, data2
+
+
+
 
 
 
@@ -247,7 +590,7 @@ class SignalPreprocessor_OpenCL(SignalPreprocessor_base):
         self.queue = pyopencl.CommandQueue(self.ctx)
     
     
-    def process_data(self, pos, data):
+    def _process_data(self, pos, data):
         
         assert data.shape[0]==self.chunksize
                 
@@ -305,16 +648,17 @@ class SignalPreprocessor_OpenCL(SignalPreprocessor_base):
 
         #~ print('pos', pos, 'start', start, 'pos2', pos2, data2.shape)
         
+        pos2, data2 = self._decimate(pos2, data2)
+        
         #TODO make OpenCL for this
         # removal ref
         if self.common_ref_removal:
-            data2 -= np.median(data2, axis=1)[:, None]
+            self._substract_common_ref(data2)
         
         #TODO make OpenCL for this
         #normalize
         if self.normalize:
-            data2 -= self.signals_medians
-            data2 /= self.signals_mads
+            self._normalize(data2)
         
         return pos2, data2        
         
@@ -449,5 +793,315 @@ class SignalPreprocessor_OpenCL(SignalPreprocessor_base):
 
 
 
+class SignalPreprocessor_NumpyInplace(SignalPreprocessor_base):
+    """
+    Same processing as SignalPreprocessor_Numpy but without temporary arrays:
+      * data stay in output_dtype (float32) end to end, the filter coefficients
+        are casted so there is no float64 upcast.
+      * all buffers are preallocated and reused at each chunk, they are in
+        (channel, sample) layout so the scipy sosfilt kernel work in place.
+      * there is no fifo roll: the backward buffer is directly filled (reversed)
+        with the new forward chunk and the tail of the previous one.
+    
+    Results differ very slightly from SignalPreprocessor_Numpy because
+    filtering is done in float32 instead of float64.
+    
+    Note that the returned chunk is a view on an internal buffer that is
+    overwritten at next call. It must be copied if kept.
+    
+    The median of common_ref_removal is computed in place on a scratch buffer.
+    """
+    def change_params(self, **kargs):
+        SignalPreprocessor_base.change_params(self, **kargs)
+        assert self.lostfront_chunksize<=self.chunksize, 'SignalPreprocessor_NumpyInplace need lostfront_chunksize<=chunksize'
+        
+        dtype = self.output_dtype
+        self.coefficients = np.ascontiguousarray(self.coefficients, dtype=dtype)
+        self.zi_forward = np.zeros((self.nb_channel, self.nb_section, 2), dtype=dtype)
+        self.zi_backward = np.zeros((self.nb_channel, self.nb_section, 2), dtype=dtype)
+        self.forward_chunk = np.zeros((self.nb_channel, self.chunksize), dtype=dtype)
+        self.forward_tail = np.zeros((self.nb_channel, self.lostfront_chunksize), dtype=dtype)
+        self.backward_chunk = np.zeros((self.nb_channel, self.backward_chunksize), dtype=dtype)
+        self.output_chunk = np.zeros((self.chunksize, self.nb_channel), dtype=dtype)
+        if self.common_ref_removal == 'median':
+            self.median_scratch = np.zeros((self.chunksize, self.nb_channel), dtype=dtype)
+            self.median_out = np.zeros((self.chunksize, ), dtype=dtype)
+        
+        if self.normalize:
+            self.signals_medians = np.asarray(self.signals_medians, dtype=dtype)
+            self.signals_mads = np.asarray(self.signals_mads, dtype=dtype)
+    
+    def _sosfilt_inplace(self, sigs, zi):
+        # sigs is (channel, sample) C contiguous
+        if HAVE_INPLACE_SOSFILT:
+            _sosfilt(self.coefficients, sigs, zi)
+        else:
+            filtered, zf = scipy.signal.sosfilt(self.coefficients, sigs, zi=zi.transpose(1, 0, 2), axis=1)
+            sigs[:] = filtered
+            zi[:] = zf.transpose(1, 0, 2)
+    
+    def _process_data(self, pos, data):
+        assert data.shape[0]==self.chunksize, 'SignalPreprocessor_NumpyInplace need constant chunksize'
+        
+        # forward
+        np.copyto(self.forward_chunk, data.T, casting='unsafe')
+        self._sosfilt_inplace(self.forward_chunk, self.zi_forward)
+        
+        # backward chunk is [previous tail, forward chunk] reversed in time
+        n = self.lostfront_chunksize
+        np.copyto(self.backward_chunk[:, :self.chunksize], self.forward_chunk[:, ::-1])
+        np.copyto(self.backward_chunk[:, self.chunksize:], self.forward_tail[:, ::-1])
+        np.copyto(self.forward_tail, self.forward_chunk[:, self.chunksize-n:])
+        
+        # backward
+        self.zi_backward[:] = 0
+        self._sosfilt_inplace(self.backward_chunk, self.zi_backward)
+        
+        pos2 = pos-self.lostfront_chunksize
+        if pos2<0:
+            return None, None
+        
+        # backward_chunk is reversed in time
+        i1 = self.lostfront_chunksize
+        i2 = self.backward_chunksize
+        if pos2<self.chunksize:
+            i2 = i1 + pos2
+        data2 = self.output_chunk[:i2-i1]
+        np.copyto(data2, self.backward_chunk[:, i1:i2][:, ::-1].T)
+        
+        pos2, data2 = self._decimate(pos2, data2)
+        
+        # removal ref
+        if self.common_ref_removal == 'median':
+            scratch = self.median_scratch[:data2.shape[0]]
+            med = self.median_out[:data2.shape[0]]
+            np.copyto(scratch, data2)
+            np.median(scratch, axis=1, overwrite_input=True, out=med)
+            data2 -= med[:, None]
+        elif self.common_ref_removal:
+            self._substract_common_ref(data2)
+        
+        #normalize
+        if self.normalize:
+            self._normalize(data2)
+        
+        return pos2, data2
+
+
+
+class SignalPreprocessor_FIR(SignalPreprocessor_base):
+    """
+    Zero phase preprocessing with a linear phase FIR filter instead of the
+    forward/backward IIR filter. The FIR is applied with overlap-save FFT
+    convolution on all channels at once, so the cost per sample do
+    not depend on the filter length.
+    
+    The FIR is designed with scipy.signal.firwin (hamming window) with
+    2*lostfront_chunksize+1 taps (highpass, lowpass or bandpass).
+    smooth_size apply the same smoothing kernel than other engines in both
+    directions so the FIR stay symmetric.
+    
+    The latency is fixed: the half length of the FIR. So lostfront_chunksize
+    is the exact delay of the returned chunk (pos2 = pos - lostfront_chunksize)
+    and there is no re-filtering of a margin at each chunk.
+    
+    Note that the frequency response is not the same as the IIR engines
+    (filtfilt square the butterworth response), catalogue and Peeler must
+    use the same engine.
+    """
+    def change_params(self, **kargs):
+        SignalPreprocessor_base.change_params(self, **kargs)
+        
+        # FIR design
+        numtaps = 2 * self.lostfront_chunksize + 1
+        nyquist = self.sample_rate/2.
+        cutoff = []
+        # like IIR engines highpass_freq=0 or >=nyquist is no highpass
+        has_highpass = self.highpass_freq is not None and 0 < self.highpass_freq < nyquist
+        if has_highpass:
+            cutoff.append(self.highpass_freq)
+        if self.lowpass_freq is not None and 0 < self.lowpass_freq < nyquist:
+            cutoff.append(self.lowpass_freq)
+        if len(cutoff) == 0:
+            fir = np.array([1.])
+        else:
+            pass_zero = not has_highpass
+            fir = scipy.signal.firwin(numtaps, cutoff, pass_zero=pass_zero, fs=self.sample_rate)
+        
+        if self.smooth_size>0:
+            b0 = (1./3)**.5
+            b1 = (1-b0)
+            for i in range(self.smooth_size):
+                fir = np.convolve(fir, [b0, b1])
+                fir = np.convolve(fir, [b1, b0])
+        
+        self.fir = fir.astype(self.output_dtype)
+        self.lostfront_chunksize = (self.fir.size - 1) // 2
+        self.backward_chunksize = self.chunksize + self.lostfront_chunksize
+        
+        # overlap-save buffers
+        self.nfft = scipy.fft.next_fast_len(self.chunksize + self.fir.size - 1, real=True)
+        self.fir_fft = scipy.fft.rfft(self.fir, n=self.nfft)[:, None]
+        self.overlap_buffer = np.zeros((self.nfft, self.nb_channel), dtype=self.output_dtype)
+    
+    def _process_data(self, pos, data):
+        n = data.shape[0]
+        assert n <= self.chunksize, 'chunk is bigger than chunksize'
+        
+        # overlap-save: input history (len(fir)-1) + new chunk
+        n_hist = self.fir.size - 1
+        buf = self.overlap_buffer
+        buf[n_hist:n_hist+n] = data
+        
+        spectrum = scipy.fft.rfft(buf[:n_hist+n], n=self.nfft, axis=0)
+        spectrum *= self.fir_fft
+        filtered = scipy.fft.irfft(spectrum, n=self.nfft, axis=0)
+        data2 = filtered[n_hist:n_hist+n].astype(self.output_dtype, copy=False)
+        
+        # history for next chunk
+        buf[:n_hist] = buf[n:n+n_hist]
+        
+        pos2 = pos-self.lostfront_chunksize
+        if pos2<0:
+            return None, None
+        if (pos2-data2.shape[0])<0:
+            data2 = data2[data2.shape[0]-pos2:]
+        
+        pos2, data2 = self._decimate(pos2, data2)
+        
+        # removal ref
+        if self.common_ref_removal:
+            self._substract_common_ref(data2)
+        
+        #normalize
+        if self.normalize:
+            self._normalize(data2)
+        
+        return pos2, data2
+
+
+
+class SignalPreprocessor_Numba(SignalPreprocessor_base):
+    """
+    Same processing as SignalPreprocessor_Numpy but forward filter, backward filter
+    and normalization are done in one numba kernel (see numba_tools), channel by
+    channel, so each sample is read and written only once per chunk.
+    Channels are splitted in blocks processed in parallel (numba threads).
+    
+    When linked with PeakDetectorEngine_Numba (see peakdetector), the rectified
+    sum for peak detection is also computed in the same pass. This is only possible
+    without common_ref_removal, decimation and noise_time_constant, otherwise
+    these steps are done after the kernel like other engines and the peak detector
+    compute the rectified sum itself.
+    
+    Note that the returned chunk is a view on an internal buffer that is
+    overwritten at next call. It must be copied if kept.
+    """
+    min_channel_per_block = 8
+    
+    def __init__(self, sample_rate, nb_channel, chunksize, input_dtype):
+        assert HAVE_NUMBA, 'numba is not installed'
+        from . import numba_tools
+        numba_tools.setup_threading_layer()
+        self.numba_filtfilt_chunk = numba_tools.numba_filtfilt_chunk
+        self.numba_get_num_threads = numba_tools.numba.get_num_threads
+        SignalPreprocessor_base.__init__(self, sample_rate, nb_channel, chunksize, input_dtype)
+        self.fused_detection = None
+    
+    def set_fused_detection(self, peak_sign, relative_threshold):
+        """
+        Compute the rectified sum for the peak detector in the same pass.
+        peak_sign=None disable it.
+        """
+        if peak_sign is None:
+            self.fused_detection = None
+        else:
+            self.fused_detection = ({'+':1, '-':-1}[peak_sign], float(relative_threshold))
+    
+    def change_params(self, **kargs):
+        SignalPreprocessor_base.change_params(self, **kargs)
+        assert self.lostfront_chunksize<=self.chunksize, 'SignalPreprocessor_Numba need lostfront_chunksize<=chunksize'
+        
+        dtype = self.output_dtype
+        self.coefficients = np.ascontiguousarray(self.coefficients, dtype='float64')
+        self.zi = np.zeros((self.nb_section, 2, self.nb_channel), dtype='float64')
+        self.zi_backward = np.zeros((self.nb_section, 2, self.nb_channel), dtype='float64')
+        self.forward_buffer = np.zeros((self.backward_chunksize, self.nb_channel), dtype=dtype)
+        self.output_chunk = np.zeros((self.chunksize, self.nb_channel), dtype=dtype)
+        
+        self.nb_block = max(1, min(self.numba_get_num_threads(), self.nb_channel // self.min_channel_per_block))
+        self.partial_sum = np.zeros((self.nb_block, self.chunksize), dtype=dtype)
+        self.sum_rectified = np.zeros(self.chunksize, dtype=dtype)
+        self.sum_rectified_pos = None
+        
+        # normalization (and so rectified sum) can be done in the kernel
+        self.fused_normalize = self.normalize and not self.common_ref_removal and \
+                    self.decimation_factor==1 and self.noise_estimator is None
+        if self.normalize:
+            self.signals_medians = np.asarray(self.signals_medians, dtype=dtype)
+            self.signals_mads = np.asarray(self.signals_mads, dtype=dtype)
+            self.kernel_medians, self.kernel_mads = self.signals_medians, self.signals_mads
+        else:
+            self.kernel_medians = self.kernel_mads = np.zeros(self.nb_channel, dtype=dtype)
+    
+    def _process_data(self, pos, data):
+        n = data.shape[0]
+        assert n<=self.chunksize, 'chunk is bigger than chunksize'
+        
+        pos2 = pos-self.lostfront_chunksize
+        if pos2<0:
+            # only forward
+            i1 = i2 = self.backward_chunksize
+        else:
+            i1 = self.chunksize - n
+            i2 = self.chunksize
+            i1 = max(i1, i2 - pos2)
+        
+        detect = self.fused_detection is not None and self.fused_normalize
+        peak_sign, thresh = self.fused_detection if detect else (0, 0.)
+        self.numba_filtfilt_chunk(data, self.coefficients, self.zi, self.zi_backward, self.forward_buffer, i1, i2, self.output_chunk,
+                        self.fused_normalize, self.kernel_medians, self.kernel_mads,
+                        detect, peak_sign, thresh, self.partial_sum, self.nb_block)
+        
+        if pos2<0:
+            return None, None
+        
+        data2 = self.output_chunk[:i2-i1]
+        if detect:
+            np.sum(self.partial_sum[:, :i2-i1], axis=0, out=self.sum_rectified[:i2-i1])
+            self.sum_rectified_pos = (pos2, i2-i1)
+        else:
+            self.sum_rectified_pos = None
+        
+        if self.fused_normalize:
+            return pos2, data2
+        
+        pos2, data2 = self._decimate(pos2, data2)
+        
+        # removal ref
+        if self.common_ref_removal:
+            self._substract_common_ref(data2)
+        
+        #normalize
+        if self.normalize:
+            self._normalize(data2)
+        
+        return pos2, data2
+    
+    def get_sum_rectified(self, pos2, n):
+        """
+        Return the rectified sum computed in the last pass if it match the chunk
+        (pos2, n) else None.
+        """
+        if self.sum_rectified_pos != (pos2, n):
+            return None
+        return self.sum_rectified[:n]
+
+
+
 signalpreprocessor_engines = { 'numpy' : SignalPreprocessor_Numpy,
+                                                'numpy_thread' : SignalPreprocessor_NumpyThread,
+                                                'numpy_inplace' : SignalPreprocessor_NumpyInplace,
+                                                'fir' : SignalPreprocessor_FIR,
+                                                'numba' : SignalPreprocessor_Numba,
                                                 'opencl' : SignalPreprocessor_OpenCL}
@@ -6,6 +6,8 @@ import shutil
 from tridesclous import download_dataset
 from tridesclous.dataio import DataIO
 from tridesclous.catalogueconstructor import CatalogueConstructor
+from tridesclous.cataloguetools import apply_all_catalogue_steps
+from tridesclous.peeler import Peeler
 from tridesclous.tools import median_mad
 
 from matplotlib import pyplot as plt
@@ -248,6 +250,162 @@ def test_create_savepoint_catalogue_constructor():
     print(copy_path)
 
 
+def test_catalogue_constructor_decimation():
+    if os.path.exists('test_catalogueconstructor_decimation'):
+        shutil.rmtree('test_catalogueconstructor_decimation')
+    
+    dataio = DataIO(dirname='test_catalogueconstructor_decimation')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.add_one_channel_group(channels=[5, 6, 7, 8, 9], chan_grp=0)
+    
+    cc = CatalogueConstructor(dataio=dataio)
+    params = {
+        'duration' : 60.,
+        'preprocessor' : {'highpass_freq' : 300., 'chunksize' : 1024, 'lostfront_chunksize' : 100, 'decimation_factor' : 2},
+        'peak_detector' : {'peak_sign' : '-', 'relative_threshold' : 7., 'peak_span' : 0.0005},
+        'extract_waveforms' : {'n_left' : -12, 'n_right' : 20, 'nb_max' : 10000},
+        'clean_waveforms' : {'alien_value_threshold' : 60.},
+        'noise_snippet' : {'nb_snippet' : 300},
+    }
+    apply_all_catalogue_steps(cc, params, 'global_pca', {'n_components' : 5}, 'kmeans', {'n_clusters' : 3})
+    
+    # processed signals are decimated but peak index are in initial sample
+    length = dataio.get_segment_length(0)
+    assert dataio.get_processed_signals_decimation(seg_num=0, chan_grp=0) == 2
+    sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed')
+    assert sigs.shape[0] == length // 2
+    assert cc.nb_peak > 0
+    assert np.all(cc.all_peaks['index'] % 2 == 0)
+    assert np.all(cc.some_noise_index['index'] % 2 == 0)
+    assert cc.some_waveforms.shape[1] == 32
+    
+    peaks = cc.all_peaks.copy()
+    
+    cc.make_catalogue_for_peeler()
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=dataio.load_catalogue(chan_grp=0), chunksize=1024)
+    peeler.run(progressbar=False)
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    assert spikes.size > 0
+    assert np.all(spikes['index'] % 2 == 0)
+    assert np.all((spikes['index'] >= 0) & (spikes['index'] < length))
+    # labeled spikes are detected peaks (up to the jitter)
+    good = spikes[spikes['cluster_label'] >= 0]
+    first_peaks = peaks['index'][peaks['index'] < int(60. * dataio.sample_rate) - 1024]
+    good = good[good['index'] < first_peaks[-1]]
+    dist = np.min(np.abs(good['index'][:, None] - first_peaks[None, :]), axis=1)
+    assert np.mean(dist <= 4) > 0.9
+    
+    # same peaks from the stored decimated signals
+    cc.re_detect_peak(peak_sign='-', relative_threshold=7., peak_span=0.0005)
+    np.testing.assert_array_equal(cc.all_peaks['index'], peaks['index'])
+
+
+def test_catalogue_constructor_bad_channel():
+    if os.path.exists('test_catalogueconstructor_bad_channel'):
+        shutil.rmtree('test_catalogueconstructor_bad_channel')
+    
+    # one dead channel and one very noisy channel
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    sigs = np.fromfile(filenames[0], dtype=params['dtype']).reshape(-1, params['total_channel'])
+    sigs = sigs[:, [5, 6, 7, 8, 9, 10, 11]].astype('float32')
+    sigs[:, 5] = 0
+    sigs[:, 6] += np.random.RandomState(0).randn(sigs.shape[0]).astype('float32') * np.std(sigs[:, 0]) * 50
+    os.mkdir('test_catalogueconstructor_bad_channel')
+    filename = os.path.join('test_catalogueconstructor_bad_channel', 'sigs.raw')
+    sigs.tofile(filename)
+    
+    dataio = DataIO(dirname='test_catalogueconstructor_bad_channel')
+    dataio.set_data_source(type='RawData', filenames=[filename], dtype='float32',
+                        sample_rate=params['sample_rate'], total_channel=7)
+    
+    cc = CatalogueConstructor(dataio=dataio)
+    params = {
+        'duration' : 60.,
+        'preprocessor' : {'highpass_freq' : 300., 'chunksize' : 1024, 'lostfront_chunksize' : 100,
+                                'bad_channel_ratios' : (0.1, 10.)},
+        'peak_detector' : {'peak_sign' : '-', 'relative_threshold' : 7., 'peak_span' : 0.0005},
+        'extract_waveforms' : {'n_left' : -12, 'n_right' : 20, 'nb_max' : 10000},
+        'clean_waveforms' : {'alien_value_threshold' : 60.},
+        'noise_snippet' : {'nb_snippet' : 300},
+    }
+    apply_all_catalogue_steps(cc, params, 'global_pca', {'n_components' : 5}, 'kmeans', {'n_clusters' : 3})
+    
+    assert np.array_equal(cc.channel_mask, [True] * 5 + [False] * 2)
+    processed = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed')
+    assert np.all(processed[:, 5:] == 0)
+    assert cc.nb_peak > 0
+    
+    cc.make_catalogue_for_peeler()
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    assert np.array_equal(catalogue['channel_mask'], cc.channel_mask)
+    
+    for use_batch_classification in (False, True):
+        peeler = Peeler(dataio)
+        peeler.change_params(catalogue=catalogue, chunksize=1024, use_batch_classification=use_batch_classification)
+        peeler.run(progressbar=False)
+        spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+        assert spikes.size > 0
+        assert np.sum(spikes['cluster_label'] >= 0) > 0.9 * spikes.size
+
+
+def test_catalogue_constructor_lazy():
+    if os.path.exists('test_catalogueconstructor_lazy'):
+        shutil.rmtree('test_catalogueconstructor_lazy')
+    
+    dataio = DataIO(dirname='test_catalogueconstructor_lazy')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.add_one_channel_group(channels=[5, 6, 7, 8, 9], chan_grp=0)
+    
+    cc = CatalogueConstructor(dataio=dataio)
+    params = {
+        'duration' : 60.,
+        'preprocessor' : {'highpass_freq' : 300., 'chunksize' : 1024, 'lostfront_chunksize' : 100},
+        'peak_detector' : {'peak_sign' : '-', 'relative_threshold' : 7., 'peak_span' : 0.0005},
+        'extract_waveforms' : {'n_left' : -12, 'n_right' : 20, 'nb_max' : 10000},
+        'clean_waveforms' : {'alien_value_threshold' : 60.},
+        'noise_snippet' : {'nb_snippet' : 300},
+    }
+    
+    # reference with stored processed signals
+    apply_all_catalogue_steps(cc, params, 'global_pca', {'n_components' : 5}, 'kmeans', {'n_clusters' : 3})
+    ref_peaks = cc.all_peaks.copy()
+    ref_sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=20000, i_stop=120000, signal_type='processed').copy()
+    ref_waveforms = cc.some_waveforms.copy()
+    
+    params['preprocessor']['processed_signals_storage'] = 'lazy'
+    apply_all_catalogue_steps(cc, params, 'global_pca', {'n_components' : 5}, 'kmeans', {'n_clusters' : 3})
+    
+    assert dataio.is_processed_signals_lazy(seg_num=0, chan_grp=0)
+    segment_path = dataio.segments_path[0][0]
+    assert not os.path.exists(os.path.join(segment_path, 'processed_signals.raw'))
+    np.testing.assert_array_equal(cc.all_peaks['index'], ref_peaks['index'])
+    
+    # recomputed after the filter warm-up
+    sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=20000, i_stop=120000, signal_type='processed')
+    np.testing.assert_allclose(sigs, ref_sigs, atol=1e-3)
+    np.testing.assert_allclose(cc.some_waveforms, ref_waveforms, atol=1e-3)
+    assert dataio.get_chunk_cache_stats()['hits'] > 0
+    
+    # reopen
+    dataio2 = DataIO(dirname='test_catalogueconstructor_lazy')
+    sigs2 = dataio2.get_signals_chunk(seg_num=0, chan_grp=0, i_start=20000, i_stop=120000, signal_type='processed')
+    np.testing.assert_array_equal(sigs2, sigs)
+    
+    cc.make_catalogue_for_peeler()
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    assert catalogue['processed_signals_storage'] == 'lazy'
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run(progressbar=False)
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    assert spikes.size > 0
+    assert dataio.is_processed_signals_lazy(seg_num=0, chan_grp=0)
+
+
     
 if __name__ == '__main__':
     test_catalogue_constructor()
@@ -258,5 +416,11 @@ if __name__ == '__main__':
     #~ test_ratio_amplitude()
     
     #~ test_create_savepoint_catalogue_constructor()
+    
+    #~ test_catalogue_constructor_decimation()
+    
+    #~ test_catalogue_constructor_bad_channel()
+    
+    #~ test_catalogue_constructor_lazy()
 
 
@@ -112,6 +112,149 @@ def test_dataio_catalogue():
     assert catalogue['signal_preprocessor_params']['highpass_freq'] == 300.
     
 
+def test_iter_over_chunk_multi_group():
+    if os.path.exists('test_DataIO_multi_group'):
+        shutil.rmtree('test_DataIO_multi_group')
+    dataio = DataIO(dirname='test_DataIO_multi_group')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    channel_groups = {0:{'channels':range(0, 7)}, 1:{'channels':range(7, 14)}, 2:{'channels':[2, 9]}}
+    dataio.set_channel_groups(channel_groups)
+    
+    for seg_num in range(dataio.nb_segment):
+        iterators = {chan_grp: dataio.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=1024) for chan_grp in channel_groups}
+        for i_stop, sigs_chunks in dataio.iter_over_chunk_multi_group(seg_num=seg_num, chunksize=1024):
+            assert list(sigs_chunks.keys()) == [0, 1, 2]
+            for chan_grp, sigs_chunk in sigs_chunks.items():
+                i_stop2, sigs_chunk2 = next(iterators[chan_grp])
+                assert i_stop == i_stop2
+                np.testing.assert_array_equal(sigs_chunk, sigs_chunk2)
+
+
+
+def test_chunk_cache():
+    if os.path.exists('test_DataIO_chunk_cache'):
+        shutil.rmtree('test_DataIO_chunk_cache')
+    dataio = DataIO(dirname='test_DataIO_chunk_cache')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.add_one_channel_group(channels=range(4,8), chan_grp=0)
+    
+    dataio.reset_processed_signals(seg_num=0, chan_grp=0, dtype='float32')
+    length = dataio.get_segment_length(0)
+    sigs = np.random.randn(length, 4).astype('float32')
+    dataio.set_signals_chunk(sigs, seg_num=0, chan_grp=0, signal_type='processed')
+    
+    # no cache
+    ref_initial = np.array(dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='initial'))
+    assert dataio.get_chunk_cache_stats()['misses'] == 0
+    
+    dataio.set_chunk_cache(max_bytes=100000, block_size=1000)
+    for i_start, i_stop in [(0, 500), (200, 700), (999, 1001), (-2500, -10), (length-5, length+100), (300, 300), (5000, 12000)]:
+        for signal_type, ref in [('initial', ref_initial), ('processed', sigs)]:
+            data = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=i_start, i_stop=i_stop, signal_type=signal_type)
+            np.testing.assert_array_equal(data, ref[i_start:i_stop])
+    stats = dataio.get_chunk_cache_stats()
+    assert stats['hits'] > 0
+    assert stats['misses'] > 0
+    assert stats['nbytes'] <= 100000
+    
+    # too big for the cache
+    data = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=20000, signal_type='processed')
+    np.testing.assert_array_equal(data, sigs[:20000])
+    assert dataio.get_chunk_cache_stats()['misses'] == stats['misses']
+    
+    # rewrite processed signals : blocks are invalidated
+    dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=3000, signal_type='processed')
+    sigs[1500:1600] = 0.
+    dataio.set_signals_chunk(sigs[1500:1600], seg_num=0, chan_grp=0, i_start=1500, i_stop=1600, signal_type='processed')
+    data = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=3000, signal_type='processed')
+    np.testing.assert_array_equal(data, sigs[:3000])
+    
+    dataio.reset_processed_signals(seg_num=0, chan_grp=0, dtype='int16')
+    data = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=3000, signal_type='processed')
+    assert np.all(data == 0)
+
+
+
+
+def test_spikes_index():
+    if os.path.exists('test_DataIO_spikes_index'):
+        shutil.rmtree('test_DataIO_spikes_index')
+    dataio = DataIO(dirname='test_DataIO_spikes_index')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.add_one_channel_group(channels=range(4), chan_grp=0)
+    
+    dtype = [('index', 'int64'), ('cluster_label', 'int64'), ('jitter', 'float64'),]
+    rng = np.random.RandomState(0)
+    
+    def check(dataio, all_spikes):
+        for i_start, i_stop in [(None, None), (0, 1000), (5000, 5000), (12345, 67890), (-5, 10**9), (90000, None)]:
+            for cluster_label in [None, -1, 0, 3, 100]:
+                spikes = dataio.get_spikes_in_time_range(seg_num=0, chan_grp=0, i_start=i_start, i_stop=i_stop,
+                                        cluster_label=cluster_label)
+                keep = np.ones(all_spikes.size, dtype='bool')
+                if i_start is not None:
+                    keep &= all_spikes['index'] >= i_start
+                if i_stop is not None:
+                    keep &= all_spikes['index'] < i_stop
+                if cluster_label is not None:
+                    keep &= all_spikes['cluster_label'] == cluster_label
+                expected = all_spikes[keep]
+                expected = expected[np.argsort(expected['index'], kind='stable')]
+                np.testing.assert_array_equal(spikes, expected)
+        counts = dataio.get_spike_counts_by_cluster(seg_num=0, chan_grp=0)
+        labels, nb = np.unique(all_spikes['cluster_label'], return_counts=True)
+        assert counts == dict(zip(labels.tolist(), nb.tolist()))
+    
+    for storage in ('memmap', 'compressed'):
+        for sorted_by_time in (True, False):
+            dataio.reset_spikes(seg_num=0, chan_grp=0, dtype=dtype, storage=storage)
+            all_spikes = []
+            for i in range(20):
+                spikes = np.zeros(rng.randint(0, 100), dtype=dtype)
+                spikes['index'] = np.sort(rng.randint(i * 5000, (i + 1) * 5000, size=spikes.size))
+                if not sorted_by_time:
+                    # like near border spikes
+                    spikes['index'] -= rng.randint(0, 300, size=spikes.size)
+                spikes['cluster_label'] = rng.randint(-1, 5, size=spikes.size)
+                dataio.append_spikes(seg_num=0, chan_grp=0, spikes=spikes)
+                all_spikes.append(spikes)
+            dataio.flush_spikes(seg_num=0, chan_grp=0)
+            all_spikes = np.concatenate(all_spikes)
+            check(dataio, all_spikes)
+            
+            # reopen
+            dataio2 = DataIO(dirname='test_DataIO_spikes_index')
+            check(dataio2, all_spikes)
+
+    # other DataIO watching spikes while appending
+    dataio.reset_spikes(seg_num=0, chan_grp=0, dtype=dtype)
+    dataio.append_spikes(seg_num=0, chan_grp=0, spikes=all_spikes[:500])
+    dataio.arrays[0][0].flush_array('spikes')
+    monitor = DataIO(dirname='test_DataIO_spikes_index')
+    check(monitor, all_spikes[:500])
+    dataio.append_spikes(seg_num=0, chan_grp=0, spikes=all_spikes[500:])
+    dataio.arrays[0][0].flush_array('spikes')
+    monitor.refresh_spikes(seg_num=0, chan_grp=0)
+    check(monitor, all_spikes)
+    dataio.flush_spikes(seg_num=0, chan_grp=0)
+    monitor.refresh_spikes(seg_num=0, chan_grp=0)
+    check(monitor, all_spikes)
+
+    # index rebuilt when missing
+    for name in ['spikes_sorted_index', 'spikes_time_order', 'spikes_cluster_ranks', 'spikes_cluster_offsets']:
+        dataio.arrays[0][0].delete_array(name)
+    check(dataio, all_spikes)
+    
+    # empty
+    dataio.reset_spikes(seg_num=0, chan_grp=0, dtype=dtype)
+    dataio.flush_spikes(seg_num=0, chan_grp=0)
+    assert dataio.get_spikes_in_time_range(seg_num=0, chan_grp=0, i_start=0, i_stop=1000).size == 0
+    assert dataio.get_spike_counts_by_cluster(seg_num=0, chan_grp=0) == {}
+
+
 
 
 if __name__=='__main__':
@@ -119,5 +262,8 @@ if __name__=='__main__':
     test_DataIO()
     test_DataIO_probes()
     test_dataio_catalogue()
+    test_iter_over_chunk_multi_group()
+    #~ test_chunk_cache()
+    #~ test_spikes_index()
     
     
\ No newline at end of file
@@ -2,7 +2,7 @@ import numpy as np
 
 import shutil, os
 
-from tridesclous.iotools import ArrayCollection
+from tridesclous.iotools import ArrayCollection, CompressedChunkArray, GrowableArray, HAVE_BLOSC
 import pytest
 
     
@@ -100,7 +100,125 @@ def test_ArrayCollection():
     one_test_ArrayCollection(withparent=True, memory_mode='memmap')
     one_test_ArrayCollection(withparent=False, memory_mode='ram')
     one_test_ArrayCollection(withparent=True, memory_mode='ram')
-    
-    
+
+
+def test_CompressedChunkArray():
+    one_test_ArrayCollection(withparent=False, memory_mode='compressed')
+    one_test_ArrayCollection(withparent=True, memory_mode='compressed')
+    
+    if os.path.exists('test_CompressedChunkArray'):
+        shutil.rmtree('test_CompressedChunkArray')
+    os.mkdir('test_CompressedChunkArray')
+    
+    codecs = ['zlib']
+    if HAVE_BLOSC:
+        codecs.append('blosc')
+    
+    sigs = np.cumsum(np.random.randn(10000, 5), axis=0).astype('float32')
+    for codec in codecs:
+        arr = CompressedChunkArray('test_CompressedChunkArray', 'sigs', 'float32', sigs.shape, mode='w+', 
+                    chunk_rows=1000, codec=codec, cache_size=2)
+        # write by blocks not aligned on chunks
+        for i in range(0, sigs.shape[0], 768):
+            arr[i:i+768, :] = sigs[i:i+768]
+        arr.close()
+        
+        arr = CompressedChunkArray('test_CompressedChunkArray', 'sigs', 'float32', sigs.shape, mode='r+',
+                    chunk_rows=1000, codec=codec, cache_size=2)
+        assert arr.compression_ratio() > 1.
+        np.testing.assert_array_equal(np.asarray(arr), sigs)
+        np.testing.assert_array_equal(arr[2500:7500, 1:3], sigs[2500:7500, 1:3])
+        np.testing.assert_array_equal(arr[::3, 2], sigs[::3, 2])
+        np.testing.assert_array_equal(arr[-1], sigs[-1])
+        mask = np.random.rand(sigs.shape[0]) > 0.5
+        np.testing.assert_array_equal(arr[mask], sigs[mask])
+        ind = np.array([9999, 3, 5000, 3])
+        np.testing.assert_array_equal(arr[ind], sigs[ind])
+        
+        # modify
+        arr[100:200, 4] = 0.
+        sigs[100:200, 4] = 0.
+        arr[ind, :2] = -1.
+        sigs[ind, :2] = -1.
+        arr.close()
+        arr = CompressedChunkArray('test_CompressedChunkArray', 'sigs', 'float32', sigs.shape, mode='r+',
+                    chunk_rows=1000, codec=codec, cache_size=2)
+        np.testing.assert_array_equal(arr[:], sigs)
+        arr.close()
+    
+    # appendable struct array in a collection
+    ac = ArrayCollection(dirname='test_CompressedChunkArray')
+    dtype = [('index', 'int64'), ('cluster_label', 'int64'), ('jitter', 'float32')]
+    ac.initialize_array('spikes', 'compressed', dtype, (-1,))
+    all_spikes = []
+    for i in range(20):
+        spikes = np.zeros(i * 300, dtype=dtype)
+        spikes['index'] = np.arange(spikes.size) * 10 + i
+        ac.append_chunk('spikes', spikes)
+        all_spikes.append(spikes)
+    ac.finalize_array('spikes')
+    all_spikes = np.concatenate(all_spikes)
+    
+    ac2 = ArrayCollection(dirname='test_CompressedChunkArray')
+    ac2.load_if_exists('spikes')
+    assert isinstance(ac2.get('spikes'), CompressedChunkArray)
+    np.testing.assert_array_equal(ac2.get('spikes')[:], all_spikes)
+    
+    
+def test_GrowableArray():
+    if os.path.exists('test_GrowableArray'):
+        shutil.rmtree('test_GrowableArray')
+    
+    dtype = [('index', 'int64'), ('label', 'int64'), ('jitter', 'float64')]
+    writer = ArrayCollection(parent=None, dirname='test_GrowableArray')
+    writer.initialize_array('spikes', 'memmap', dtype, (-1,))
+    # small block to force several commits and grows
+    writer._array['spikes'] = GrowableArray(writer.dirname, 'spikes', dtype, (), block_nbytes=24*100)
+    writer.flush_json()
+    
+    all_spikes = []
+    for i in range(50):
+        spikes = np.zeros(np.random.randint(0, 30), dtype=dtype)
+        spikes['index'] = np.arange(spikes.size) + i * 100
+        spikes['label'] = i
+        writer.append_chunk('spikes', spikes)
+        all_spikes.append(spikes)
+        
+        # same process : committed part
+        committed = writer.get('spikes')
+        all_concat = np.concatenate(all_spikes)
+        np.testing.assert_array_equal(committed, all_concat[:committed.size])
+        
+        # other reader : up to the committed length
+        reader = ArrayCollection(parent=None, dirname='test_GrowableArray')
+        reader.load_if_exists('spikes')
+        assert reader.is_appending('spikes')
+        read = reader.get('spikes')
+        assert read.size <= committed.size
+        np.testing.assert_array_equal(read, all_concat[:read.size])
+    
+    a = writer._array['spikes']
+    assert a.capacity >= a.length
+    writer.flush_array('spikes')
+    reader.load_if_exists('spikes')
+    np.testing.assert_array_equal(reader.get('spikes'), all_concat)
+    
+    writer.finalize_array('spikes')
+    assert not os.path.exists('test_GrowableArray/spikes.length')
+    assert os.path.getsize('test_GrowableArray/spikes.raw') == all_concat.nbytes
+    np.testing.assert_array_equal(writer.get('spikes'), all_concat)
+    
+    reader = ArrayCollection(parent=None, dirname='test_GrowableArray')
+    reader.load_if_exists('spikes')
+    assert not reader.is_appending('spikes')
+    np.testing.assert_array_equal(reader.get('spikes'), all_concat)
+    
+    # empty
+    writer.initialize_array('spikes', 'memmap', dtype, (-1,))
+    writer.finalize_array('spikes')
+    assert writer.get('spikes').shape == (0, )
+
+
 if __name__=='__main__':
-    test_ArrayCollection()
\ No newline at end of file
+    test_ArrayCollection()
+    test_CompressedChunkArray()
\ No newline at end of file
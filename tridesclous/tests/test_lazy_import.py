@@ -0,0 +1,31 @@
+import sys
+import subprocess
+
+
+def test_headless_import():
+    # the core must not import GUI, plotting, neo or numba
+    code = """
+import sys
+from tridesclous import DataIO, CatalogueConstructor, Peeler
+for name in ('PyQt5', 'pyqtgraph', 'matplotlib', 'seaborn', 'neo', 'numba'):
+    assert name not in sys.modules, name
+import tridesclous
+assert tridesclous.data_source_classes['RawData'] is tridesclous.RawDataSource
+assert 'neo' not in sys.modules
+# numba only when a numba engine is built
+from tridesclous.signalpreprocessor import HAVE_NUMBA
+assert 'numba' not in sys.modules
+"""
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_lazy_attributes():
+    import tridesclous
+    assert callable(tridesclous.plot_signals)
+    assert 'plot_signals' in tridesclous.__all__
+    assert 'CatalogueWindow' in tridesclous.__all__
+
+
+if __name__ == '__main__':
+    test_headless_import()
+    test_lazy_attributes()
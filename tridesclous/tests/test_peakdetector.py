@@ -1,5 +1,7 @@
 from tridesclous import get_dataset
 from tridesclous.peakdetector import peakdetector_engines
+from tridesclous.peakdetector import detect_peaks_in_chunk, IncrementalPeakDetector
+from tridesclous.peakdetector import _rectify_and_sum, _detect_peaks_sliding_extremum
 
 import time
 
@@ -11,7 +13,8 @@ from matplotlib import pyplot
 from tridesclous.tests.test_signalpreprocessor import offline_signal_preprocessor
 
 
-from tridesclous.peakdetector import HAVE_PYOPENCL
+from tridesclous.peakdetector import HAVE_PYOPENCL, HAVE_NUMBA
+from tridesclous.signalpreprocessor import signalpreprocessor_engines
 
 def offline_peak_detect(normed_sigs, sample_rate, peak_sign='-',relative_threshold = 5,  peak_span = 0.0005):
     n_span = int(sample_rate*peak_span)//2
@@ -53,6 +56,8 @@ def test_compare_offline_online_engines():
         #~ engines = ['numpy']
     else:
         engines = ['numpy']
+    if HAVE_NUMBA:
+        engines.append('numba')
 
     # get sigs
     sigs, sample_rate = get_dataset(name='olfactory_bulb')
@@ -166,6 +171,106 @@ def test_compare_offline_online_engines():
     
     
 
+
+def test_incremental_peak_detector():
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    sigs = sigs[:20000, :].astype('float32')
+    normed_sigs = (sigs - np.median(sigs, axis=0)) / np.std(sigs, axis=0)
+    
+    for peak_sign in ('-', '+'):
+        sig = normed_sigs.copy()
+        detector = IncrementalPeakDetector(3, 5., peak_sign)
+        detector.reset(sig)
+        np.testing.assert_array_equal(detector.get_peaks(), detect_peaks_in_chunk(sig, 3, 5., peak_sign))
+        
+        # modify some windows including both borders
+        for start, stop in [(0, 30), (1000, 1050), (5000, 5003), (19980, 20000)]:
+            sig[start:stop, :] *= 0.3
+            detector.update(sig, start, stop)
+            np.testing.assert_array_equal(detector.get_peaks(), detect_peaks_in_chunk(sig, 3, 5., peak_sign))
+
+
+
+def test_sliding_extremum():
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    sigs = sigs[:20000, :].astype('float32')
+    normed_sigs = (sigs - np.median(sigs, axis=0)) / np.std(sigs, axis=0)
+    # round to have many equal values
+    normed_sigs = np.round(normed_sigs * 4) / 4
+    
+    for peak_sign in ('-', '+'):
+        sig = normed_sigs.copy()
+        sum_rectified = _rectify_and_sum(sig, 5., peak_sign)
+        np.testing.assert_array_equal(sig, normed_sigs)
+        for k in (1, 2, 3, 7, 8, 15, 40):
+            peak_span = (2 * k + 0.5) / sample_rate
+            offline_peaks, _ = offline_peak_detect(sig, sample_rate, peak_sign=peak_sign,
+                                    relative_threshold=5., peak_span=peak_span)
+            peaks = _detect_peaks_sliding_extremum(sum_rectified, k, 5., peak_sign)
+            np.testing.assert_array_equal(peaks, offline_peaks)
+            np.testing.assert_array_equal(detect_peaks_in_chunk(sig, k, 5., peak_sign), offline_peaks)
+
+
+def test_fused_numba_engines():
+    if not HAVE_NUMBA:
+        return
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    sigs = np.tile(sigs, (1, 3)) # 42 channels
+    nb_channel = sigs.shape[1]
+    chunksize = 1024
+    nloop = sigs.shape[0]//chunksize
+    
+    preprocess_params = {
+                'common_ref_removal' : False,
+                'highpass_freq': 300.,
+                'lowpass_freq': 4000.,
+                'output_dtype': 'float32',
+                'normalize' : True,
+                'lostfront_chunksize': 128,
+                'signals_medians' : np.zeros(nb_channel, dtype='float32'),
+                'signals_mads' : np.ones(nb_channel, dtype='float32') * 10.,
+                }
+    peak_params = dict(peak_sign='-', relative_threshold=5., peak_span=0.0005)
+    
+    all_peaks = {}
+    for fused in (False, True):
+        signalpreprocessor = signalpreprocessor_engines['numba'](sample_rate, nb_channel, chunksize, sigs.dtype)
+        peakdetector = peakdetector_engines['numba'](sample_rate, nb_channel, chunksize, 'float32')
+        if fused:
+            peakdetector.link_preprocessor(signalpreprocessor)
+        signalpreprocessor.change_params(**preprocess_params)
+        peakdetector.change_params(**peak_params)
+        
+        # the numpy detector on the same preprocessed chunks
+        peakdetector_ref = peakdetector_engines['numpy'](sample_rate, nb_channel, chunksize, 'float32')
+        peakdetector_ref.change_params(**peak_params)
+        
+        peaks, peaks_ref = [], []
+        for i in range(nloop):
+            pos = (i+1)*chunksize
+            pos2, preprocessed_chunk = signalpreprocessor.process_data(pos, sigs[pos-chunksize:pos,:])
+            if preprocessed_chunk is None:
+                continue
+            if fused:
+                assert signalpreprocessor.get_sum_rectified(pos2, preprocessed_chunk.shape[0]) is not None
+            n_peaks, chunk_peaks = peakdetector.process_data(pos2, preprocessed_chunk)
+            if chunk_peaks is not None:
+                peaks.append(chunk_peaks)
+            n_peaks, chunk_peaks = peakdetector_ref.process_data(pos2, preprocessed_chunk)
+            if chunk_peaks is not None:
+                peaks_ref.append(chunk_peaks)
+        all_peaks[fused] = np.concatenate(peaks)
+        assert all_peaks[fused].size > 0
+        # rectified sum order can differ from numpy so very few peaks can differ
+        common = np.intersect1d(all_peaks[fused], np.concatenate(peaks_ref))
+        assert common.size > 0.99 * all_peaks[fused].size
+    
+    np.testing.assert_array_equal(all_peaks[False], all_peaks[True])
+
+
     
 if __name__ == '__main__':
-    test_compare_offline_online_engines()
\ No newline at end of file
+    test_compare_offline_online_engines()
+    test_incremental_peak_detector()
+    #~ test_sliding_extremum()
+    #~ test_fused_numba_engines()
\ No newline at end of file
@@ -7,6 +7,7 @@ import scipy.signal
 import time
 import os
 import shutil
+import threading
 
 import  pyqtgraph as pg
 
@@ -14,8 +15,10 @@ from tridesclous.dataio import DataIO
 from tridesclous.catalogueconstructor import CatalogueConstructor
 from tridesclous import Peeler, apply_all_catalogue_steps
 from tridesclous.peeler_cl import Peeler_OpenCl
+from tridesclous.iotools import CompressedChunkArray
 
 from tridesclous.peakdetector import  detect_peaks_in_chunk
+from tridesclous.peeler import make_prediction_signals, substract_prediction_signals
 
 
 from tridesclous.tests.testingtools import setup_catalogue
@@ -198,6 +201,233 @@ def test_peeler_several_chunksize():
         
         previsous_spikes = spikes
 
+def test_peeler_batch_classification():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+
+    all_spikes = []
+    for use_batch_classification in (False, True):
+        peeler = Peeler(dataio)
+        peeler.change_params(catalogue=catalogue, chunksize=1024,
+                                        use_batch_classification=use_batch_classification)
+        t1 = time.perf_counter()
+        peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+        t2 = time.perf_counter()
+        print('use_batch_classification', use_batch_classification, 'peeler.run_loop', t2-t1)
+        all_spikes.append(dataio.get_spikes(seg_num=0, chan_grp=0).copy())
+
+    # on the same residual batch and one by one must give the same result
+    residual = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=20000, signal_type='processed')
+    residual = np.array(residual)
+    local_peaks = detect_peaks_in_chunk(residual, peeler.n_span, peeler.relative_threshold, peeler.peak_sign)
+    spikes_batch = peeler.classify_and_align_batch(local_peaks, residual, peeler.catalogue)
+    for i, local_peak in enumerate(local_peaks):
+        spike = peeler.classify_and_align_one_spike(local_peak, residual, peeler.catalogue)
+        assert spike.index == spikes_batch[i]['index']
+        assert spike.cluster_label == spikes_batch[i]['cluster_label']
+        assert np.abs(spike.jitter - spikes_batch[i]['jitter'])<1e-3
+
+    # while peeling only overlapping spikes can differ
+    spikes, spikes_batch = all_spikes
+    assert np.all(np.diff(spikes_batch['index'])>=0)
+    good = spikes[spikes['cluster_label']>=0]
+    good_batch = spikes_batch[spikes_batch['cluster_label']>=0]
+    common = np.intersect1d(good['index'], good_batch['index'])
+    print('nb good', good.size, 'nb good batch', good_batch.size, 'nb common', common.size)
+    assert common.size >= 0.9 * good.size
+
+
+def test_substract_prediction_signals():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    spikes = spikes[spikes['index']<20000].copy()
+    residual = dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=20100, signal_type='processed')
+    residual = np.array(residual)
+
+    # in place must be the same as the full size prediction
+    prediction = make_prediction_signals(spikes, residual.dtype, residual.shape, peeler.catalogue)
+    residual2 = residual.copy()
+    substract_prediction_signals(spikes, residual2, peeler.catalogue)
+    np.testing.assert_allclose(residual - prediction, residual2, atol=1e-5)
+
+    # restricted to some channels
+    peeler.change_params(catalogue=catalogue, chunksize=1024, substraction_threshold_mad=4.5)
+    residual3 = residual.copy()
+    substract_prediction_signals(spikes, residual3, peeler.catalogue)
+    for i, chans in enumerate(peeler.catalogue['substraction_channels']):
+        assert peeler.catalogue['max_on_channel'][i] in chans
+
+    nb_channel = residual.shape[1]
+    # the threshold must really restrict channels for some clusters
+    assert any(len(chans) < nb_channel for chans in peeler.catalogue['substraction_channels'])
+    expected = residual.copy()
+    nb_checked = 0
+    for i in range(spikes.size):
+        k = spikes[i]['cluster_label']
+        if k<0: continue
+        chans = peeler.catalogue['substraction_channels'][peeler.catalogue['label_to_index'][k]]
+        other_chans = np.setdiff1d(np.arange(nb_channel), chans)
+        # spike alone
+        one_prediction = make_prediction_signals(spikes[i:i+1], residual.dtype, residual.shape, peeler.catalogue)
+        one_residual = residual.copy()
+        substract_prediction_signals(spikes[i:i+1], one_residual, peeler.catalogue)
+        np.testing.assert_array_equal(one_residual[:, other_chans], residual[:, other_chans])
+        np.testing.assert_allclose(one_residual[:, chans], residual[:, chans] - one_prediction[:, chans], atol=1e-5)
+        expected[:, chans] -= one_prediction[:, chans]
+        nb_checked += 1
+    assert nb_checked > 0
+    # all spikes at once
+    np.testing.assert_allclose(residual3, expected, atol=1e-5)
+
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+
+
+def test_peeler_pipelined():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+    ref_spikes = dataio.get_spikes(seg_num=0, chan_grp=0).copy()
+    ref_sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed').copy()
+    
+    t1 = time.perf_counter()
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False, pipelined=True, queue_size=4)
+    t2 = time.perf_counter()
+    print('pipelined', t2-t1)
+    
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed')
+    np.testing.assert_array_equal(spikes, ref_spikes)
+    np.testing.assert_array_equal(sigs, ref_sigs)
+
+    # error in the compute loop when the reader is at the end (3 chunks) and the
+    # read queue is full : reader thread must stop and be joined
+    nb_thread = threading.active_count()
+    def process_one_chunk(pos, sigs_chunk):
+        time.sleep(0.5)
+        raise RuntimeError('compute error')
+    peeler.process_one_chunk = process_one_chunk
+    duration = 3.5 * 1024 / dataio.sample_rate
+    with pytest.raises(RuntimeError):
+        peeler.run_offline_loop_one_segment(seg_num=0, duration=duration, progressbar=False, pipelined=True, queue_size=1)
+    assert threading.active_count() == nb_thread
+
+
+def test_peeler_int16_processed_signals():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+    ref_spikes = dataio.get_spikes(seg_num=0, chan_grp=0).copy()
+    ref_sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed').copy()
+    assert dataio.get_processed_signals_scale(seg_num=0, chan_grp=0) is None
+    
+    catalogue = dict(catalogue)
+    catalogue['processed_signals_dtype'] = 'int16'
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+    
+    # peeling is done in float so spikes do not change
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    np.testing.assert_array_equal(spikes, ref_spikes)
+    
+    scale = dataio.get_processed_signals_scale(seg_num=0, chan_grp=0)
+    raw_sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed', dequantize=False)
+    assert raw_sigs.dtype == 'int16'
+    sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed')
+    assert sigs.dtype == 'float32'
+    # the tail of the segment is not written by the peeler
+    n = sigs.shape[0] - 2 * 1024
+    np.testing.assert_allclose(sigs[:n], ref_sigs[:n], atol=np.max(scale)/2 * 1.001)
+    
+    # reopen
+    dataio = DataIO(dirname='test_peeler')
+    sigs2 = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed')
+    np.testing.assert_array_equal(sigs, sigs2)
+    
+    # back to float
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=dataio.load_catalogue(chan_grp=0), chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+    assert dataio.get_processed_signals_scale(seg_num=0, chan_grp=0) is None
+
+
+
+def test_peeler_compressed_storage():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+    ref_spikes = dataio.get_spikes(seg_num=0, chan_grp=0).copy()
+    ref_sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed').copy()
+    
+    catalogue = dict(catalogue)
+    catalogue['processed_signals_storage'] = 'compressed'
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+    
+    # lossless
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    np.testing.assert_array_equal(spikes, ref_spikes)
+    sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed')
+    np.testing.assert_array_equal(sigs, ref_sigs)
+    
+    # reopen
+    dataio = DataIO(dirname='test_peeler')
+    assert isinstance(dataio.arrays[0][0].get('processed_signals'), CompressedChunkArray)
+    sigs2 = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed', i_start=5000, i_stop=9000)
+    np.testing.assert_array_equal(sigs2, ref_sigs[5000:9000])
+    np.testing.assert_array_equal(dataio.get_spikes(seg_num=0, chan_grp=0), ref_spikes)
+    
+    # back to memmap for others tests
+    catalogue['processed_signals_storage'] = 'memmap'
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+
+
+def test_peeler_running_noise():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    catalogue['signal_preprocessor_params'] = dict(catalogue['signal_preprocessor_params'])
+    catalogue['signal_preprocessor_params']['noise_time_constant'] = 2.
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run(progressbar=False)
+    
+    for seg_num in range(dataio.nb_segment):
+        noise_trajectory = dataio.get_noise_trajectory(seg_num=seg_num, chan_grp=0)
+        assert noise_trajectory is not None
+        nb_channel = catalogue['signals_mads'].size
+        assert noise_trajectory['mads'].shape == (noise_trajectory.size, nb_channel)
+        # one record by second
+        length = dataio.get_segment_length(seg_num)
+        assert noise_trajectory.size >= int(length / dataio.sample_rate) - 1
+        assert np.all(np.diff(noise_trajectory['index']) > 0)
+        # this dataset is stationary
+        np.testing.assert_allclose(noise_trajectory['mads'][-1], catalogue['signals_mads'], rtol=0.2)
+        
+        spikes = dataio.get_spikes(seg_num=seg_num, chan_grp=0)
+        assert spikes.size > 0
+    
+    # without it the trajectory is removed
+    peeler.change_params(catalogue=dataio.load_catalogue(chan_grp=0), chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+    assert dataio.get_noise_trajectory(seg_num=0, chan_grp=0) is None
+
+
 def open_PeelerWindow():
     dataio = DataIO(dirname='test_peeler')
     initial_catalogue = dataio.load_catalogue(chan_grp=0)
@@ -268,6 +498,18 @@ if __name__ =='__main__':
     
     #~ test_peeler_several_chunksize()
     
+    #~ test_peeler_batch_classification()
+    
+    #~ test_substract_prediction_signals()
+    
+    #~ test_peeler_pipelined()
+    
+    #~ test_peeler_int16_processed_signals()
+    
+    #~ test_peeler_compressed_storage()
+    
+    #~ test_peeler_running_noise()
+    
     #~ test_export_spikes()
     
     
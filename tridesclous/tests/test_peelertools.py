@@ -0,0 +1,123 @@
+import shutil
+
+import numpy as np
+
+from tridesclous.dataio import DataIO
+from tridesclous.peeler import Peeler
+from tridesclous.peelertools import run_peeler_parallel, run_peelers_one_pass
+
+from tridesclous.tests.testingtools import setup_catalogue
+
+
+
+def setup_module():
+    setup_catalogue('test_peelertools', dataset_name='olfactory_bulb')
+    setup_catalogue('test_peelertools_multi', dataset_name='olfactory_bulb',
+                    channel_groups={0: [0, 1, 2, 3, 4], 1: [5, 6, 7, 8, 9]})
+
+def teardown_module():
+    shutil.rmtree('test_peelertools')
+    shutil.rmtree('test_peelertools_multi')
+
+
+def test_run_peeler_parallel():
+    dataio = DataIO(dirname='test_peelertools')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    # reference
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run(progressbar=False)
+    ref_spikes = [dataio.get_spikes(seg_num=seg_num, chan_grp=0).copy() for seg_num in range(dataio.nb_segment)]
+    
+    results = run_peeler_parallel(dataio, n_jobs=2, peeler_params={'chunksize': 1024}, progressbar=False)
+    assert len(results) == dataio.nb_segment
+    
+    for seg_num in range(dataio.nb_segment):
+        spikes = dataio.get_spikes(seg_num=seg_num, chan_grp=0)
+        np.testing.assert_array_equal(spikes, ref_spikes[seg_num])
+        assert results[(0, seg_num)][0] == spikes.size
+    
+    # with time shards: the merge must give each spike once and in order
+    results = run_peeler_parallel(dataio, n_jobs=2, peeler_params={'chunksize': 1024},
+                            shard_duration=3., pre_roll_duration=0.5, progressbar=False)
+    for seg_num in range(dataio.nb_segment):
+        spikes = dataio.get_spikes(seg_num=seg_num, chan_grp=0)
+        assert np.all(np.diff(spikes['index'])>=0)
+        assert results[(0, seg_num)][0] == spikes.size
+        common = np.intersect1d(spikes['index'], ref_spikes[seg_num]['index'])
+        assert common.size >= 0.99 * ref_spikes[seg_num].size
+
+
+def test_run_offline_loop_one_shard():
+    dataio = DataIO(dirname='test_peelertools')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, progressbar=False)
+    ref_spikes = dataio.get_spikes(seg_num=0, chan_grp=0).copy()
+    
+    i_start, i_stop = 1024*50, 1024*120
+    spikes = peeler.run_offline_loop_one_shard(seg_num=0, i_start=i_start, i_stop=i_stop, pre_roll=1024*10)
+    assert np.all((spikes['index']>=i_start) & (spikes['index']<i_stop))
+    
+    ref_spikes = ref_spikes[(ref_spikes['index']>=i_start) & (ref_spikes['index']<i_stop)]
+    np.testing.assert_array_equal(spikes['index'], ref_spikes['index'])
+    np.testing.assert_array_equal(spikes['cluster_label'], ref_spikes['cluster_label'])
+    
+
+
+def test_run_peelers_one_pass():
+    dataio = DataIO(dirname='test_peelertools')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, chunksize=1024)
+    peeler.run(progressbar=False)
+    ref_spikes = [dataio.get_spikes(seg_num=seg_num, chan_grp=0).copy() for seg_num in range(dataio.nb_segment)]
+    
+    peelers = run_peelers_one_pass(dataio, peeler_params={'chunksize': 1024}, progressbar=False)
+    assert list(peelers.keys()) == [0]
+    for seg_num in range(dataio.nb_segment):
+        spikes = dataio.get_spikes(seg_num=seg_num, chan_grp=0)
+        np.testing.assert_array_equal(spikes, ref_spikes[seg_num])
+    
+    assert run_peelers_one_pass(dataio, chan_grps=[], progressbar=False) == {}
+    
+
+def test_run_peelers_one_pass_multi_group():
+    dataio = DataIO(dirname='test_peelertools_multi')
+    chan_grps = [0, 1]
+    
+    # reference : Peeler.run() group by group
+    ref_spikes = {}
+    ref_sigs = {}
+    for chan_grp in chan_grps:
+        catalogue = dataio.load_catalogue(chan_grp=chan_grp)
+        peeler = Peeler(dataio)
+        peeler.change_params(catalogue=catalogue, chunksize=1024)
+        peeler.run(progressbar=False)
+        for seg_num in range(dataio.nb_segment):
+            ref_spikes[chan_grp, seg_num] = dataio.get_spikes(seg_num=seg_num, chan_grp=chan_grp).copy()
+            ref_sigs[chan_grp, seg_num] = dataio.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp,
+                                        i_start=None, i_stop=None, signal_type='processed').copy()
+    
+    peelers = run_peelers_one_pass(dataio, peeler_params={'chunksize': 1024}, progressbar=False)
+    assert sorted(peelers.keys()) == chan_grps
+    for chan_grp in chan_grps:
+        for seg_num in range(dataio.nb_segment):
+            spikes = dataio.get_spikes(seg_num=seg_num, chan_grp=chan_grp)
+            assert spikes.size > 0
+            np.testing.assert_array_equal(spikes, ref_spikes[chan_grp, seg_num])
+            sigs = dataio.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp,
+                                        i_start=None, i_stop=None, signal_type='processed')
+            np.testing.assert_array_equal(sigs, ref_sigs[chan_grp, seg_num])
+    
+    
+if __name__ == '__main__':
+    setup_module()
+    test_run_peeler_parallel()
+    test_run_offline_loop_one_shard()
+    test_run_peelers_one_pass()
+    test_run_peelers_one_pass_multi_group()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import json
+
+from tridesclous import download_dataset, DataIO
+from tridesclous.scripts.tdc import main
+
+
+def setup_module():
+    if os.path.exists('test_scripts'):
+        shutil.rmtree('test_scripts')
+    dataio = DataIO(dirname='test_scripts')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames[:1], **params)
+    dataio.set_channel_groups({0: {'channels': [5, 6, 7, 8, 9]}, 1: {'channels': [0, 1, 2, 3]}})
+    
+    params = {
+        'fullchain_kargs': {
+            'duration': 10.,
+            'preprocessor': {'highpass_freq': 300., 'chunksize': 1024, 'lostfront_chunksize': 100},
+            'peak_detector': {'peak_sign': '-', 'relative_threshold': 7., 'peak_span': 0.0005},
+            'noise_snippet': {'nb_snippet': 300},
+            'extract_waveforms': {'n_left': -25, 'n_right': 40, 'nb_max': 10000},
+            'clean_waveforms': {'alien_value_threshold': 60.},
+        },
+        'clust_method': 'kmeans',
+        'clust_kargs': {'n_clusters': 5},
+        'peeler_params': {'chunksize': 1024, 'duration': 10.},
+    }
+    with open('test_scripts_params.json', 'w', encoding='utf8') as f:
+        json.dump(params, f)
+
+
+def teardown_module():
+    shutil.rmtree('test_scripts')
+    os.remove('test_scripts_params.json')
+
+
+def test_batch_commands():
+    argv = ['-d', 'test_scripts', '-p', 'test_scripts_params.json', '--timing']
+    assert main(['makecatalogue'] + argv + ['-j', '2']) == 0
+    
+    dataio = DataIO(dirname='test_scripts')
+    for chan_grp in (0, 1):
+        assert dataio.load_catalogue(chan_grp=chan_grp) is not None
+    
+    assert main(['runpeeler'] + argv + ['-c', '0']) == 0
+    assert main(['runpeeler'] + argv + ['-j', '2']) == 0
+    dataio = DataIO(dirname='test_scripts')
+    assert dataio.get_spikes(seg_num=0, chan_grp=0).size > 0
+    assert dataio.get_spikes(seg_num=0, chan_grp=1) is not None
+    
+    # errors give a non zero exit status
+    assert main(['makecatalogue', '-d', 'not_a_dir']) == 1
+    assert main(['runpeeler'] + argv + ['-c', '3']) == 1
+    assert main(['not_a_command']) == 1
+
+
+if __name__ == '__main__':
+    setup_module()
+    test_batch_commands()
+    teardown_module()
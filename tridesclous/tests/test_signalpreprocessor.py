@@ -1,9 +1,11 @@
 from tridesclous import get_dataset
 from tridesclous.signalpreprocessor import signalpreprocessor_engines, offline_signal_preprocessor
 
-from tridesclous.signalpreprocessor import HAVE_PYOPENCL
+from tridesclous.signalpreprocessor import HAVE_PYOPENCL, HAVE_NUMBA, RunningNoiseEstimator
+from tridesclous.signalpreprocessor import substract_common_ref, make_local_ref_matrix
 
 import time
+import tracemalloc
 
 import scipy.signal
 import numpy as np
@@ -58,11 +60,11 @@ def run_online(engine, sigs, sample_rate, chunksize, **params):
 def test_compare_offline_online_engines():
     #~ HAVE_PYOPENCL = True
     if HAVE_PYOPENCL:
-        engines = ['numpy', 'opencl']
+        engines = ['numpy', 'numpy_thread', 'opencl']
         #~ engines = [ 'opencl']
         #~ engines = ['numpy']
     else:
-        engines = ['numpy']
+        engines = ['numpy', 'numpy_thread']
 
 
     # get sigs
@@ -150,6 +152,246 @@ def test_compare_offline_online_engines():
         assert np.max(residual_normed)<0.05, 'online differt from offline more than 5%'
 
 
+def test_numpy_thread_engine():
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    sigs = np.tile(sigs, (1, 4)) # 56 channels
+    nb_channel = sigs.shape[1]
+    chunksize = 1024
+    
+    for common_ref_removal in (False, True):
+        params = {
+                    'common_ref_removal' : common_ref_removal,
+                    'highpass_freq': 300.,
+                    'lowpass_freq': 4000.,
+                    'smooth_size':0,
+                    'output_dtype': 'float32',
+                    'normalize' : True,
+                    'lostfront_chunksize': 128,
+                    'signals_medians' : np.zeros(nb_channel, dtype='float32'),
+                    'signals_mads' : np.ones(nb_channel, dtype='float32') * 10.,
+                    }
+        
+        engine_ref = signalpreprocessor_engines['numpy'](sample_rate, nb_channel, chunksize, sigs.dtype)
+        engine_ref.change_params(**params)
+        engine = signalpreprocessor_engines['numpy_thread'](sample_rate, nb_channel, chunksize, sigs.dtype)
+        engine.change_params(nb_thread=4, **params)
+        assert len(engine.channel_blocks) == 4
+        
+        for i in range(20):
+            pos = (i+1)*chunksize
+            chunk = sigs[pos-chunksize:pos,:]
+            pos2_ref, preprocessed_chunk_ref = engine_ref.process_data(pos, chunk)
+            pos2, preprocessed_chunk = engine.process_data(pos, chunk)
+            assert pos2 == pos2_ref
+            if preprocessed_chunk_ref is None:
+                assert preprocessed_chunk is None
+            else:
+                assert preprocessed_chunk.dtype == preprocessed_chunk_ref.dtype
+                np.testing.assert_array_equal(preprocessed_chunk, preprocessed_chunk_ref)
+
+
+def test_fir_engine():
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    nb_channel = sigs.shape[1]
+    chunksize = 1024
+    
+    params = {
+                'common_ref_removal' : False,
+                'highpass_freq': 300.,
+                'lowpass_freq': 4000.,
+                'smooth_size':1,
+                'output_dtype': 'float32',
+                'normalize' : False,
+                'lostfront_chunksize': 100,
+                }
+    engine = signalpreprocessor_engines['fir'](sample_rate, nb_channel, chunksize, sigs.dtype)
+    engine.change_params(**params)
+    # symetric FIR, latency is the half length
+    assert engine.fir.size == 2 * engine.lostfront_chunksize + 1
+    np.testing.assert_array_equal(engine.fir, engine.fir[::-1])
+    
+    online_sig = run_online('fir', sigs, sample_rate, chunksize, **params)
+    
+    # same as offline zero phase convolution
+    delay = engine.lostfront_chunksize
+    offline_sig = scipy.signal.fftconvolve(sigs.astype('float64'), engine.fir.astype('float64')[:, None], mode='full', axes=0)
+    offline_sig = offline_sig[delay:delay+online_sig.shape[0]]
+    residual = np.abs(online_sig.astype('float64')-offline_sig)
+    assert np.max(residual) / np.max(np.abs(offline_sig)) < 1e-5
+
+    # lowpass only : highpass_freq=0 or >=nyquist is no highpass (like IIR engines)
+    for highpass_freq in (None, 0., sample_rate):
+        params2 = dict(params, highpass_freq=highpass_freq, lowpass_freq=3000., smooth_size=0)
+        engine = signalpreprocessor_engines['fir'](sample_rate, nb_channel, chunksize, sigs.dtype)
+        engine.change_params(**params2)
+        freqs, h = scipy.signal.freqz(engine.fir.astype('float64'), worN=[100., 4500.], fs=sample_rate)
+        gains = np.abs(h)
+        assert abs(gains[0] - 1) < 0.01, (highpass_freq, gains)
+        assert gains[1] < 0.01, (highpass_freq, gains)
+
+
+def test_numba_engine():
+    if not HAVE_NUMBA:
+        return
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    sigs = np.tile(sigs, (1, 4)) # 56 channels
+    nb_channel = sigs.shape[1]
+    chunksize = 1024
+    
+    for common_ref_removal in (False, True):
+        params = {
+                    'common_ref_removal' : common_ref_removal,
+                    'highpass_freq': 300.,
+                    'lowpass_freq': 4000.,
+                    'smooth_size':1,
+                    'output_dtype': 'float32',
+                    'normalize' : True,
+                    'lostfront_chunksize': 128,
+                    'signals_medians' : np.zeros(nb_channel, dtype='float32'),
+                    'signals_mads' : np.ones(nb_channel, dtype='float32') * 10.,
+                    }
+        
+        engine_ref = signalpreprocessor_engines['numpy'](sample_rate, nb_channel, chunksize, sigs.dtype)
+        engine_ref.change_params(**params)
+        engine = signalpreprocessor_engines['numba'](sample_rate, nb_channel, chunksize, sigs.dtype)
+        engine.change_params(**params)
+        assert engine.fused_normalize == (not common_ref_removal)
+        
+        for i in range(20):
+            pos = (i+1)*chunksize
+            # last chunk is smaller
+            chunk = sigs[pos-chunksize:pos - (100 if i==19 else 0),:]
+            pos = pos - (100 if i==19 else 0)
+            pos2_ref, preprocessed_chunk_ref = engine_ref.process_data(pos, chunk)
+            pos2, preprocessed_chunk = engine.process_data(pos, chunk)
+            assert pos2 == pos2_ref
+            if preprocessed_chunk_ref is None:
+                assert preprocessed_chunk is None
+            else:
+                assert preprocessed_chunk.dtype == preprocessed_chunk_ref.dtype
+                assert preprocessed_chunk.shape == preprocessed_chunk_ref.shape
+                np.testing.assert_allclose(preprocessed_chunk, preprocessed_chunk_ref, rtol=0, atol=1e-4)
+
+
+def test_running_noise_estimator():
+    sample_rate = 10000.
+    chunksize = 1024
+    nb_channel = 3
+    medians = np.array([0., 5., -2.])
+    mads = np.array([1., 2., 10.])
+    estimator = RunningNoiseEstimator(medians, mads, sample_rate, time_constant=2.)
+    
+    # stationary: stay near initial values
+    rng = np.random.RandomState(42)
+    for i in range(50):
+        chunk = rng.randn(chunksize, nb_channel) * mads + medians
+        estimator.new_chunk(chunk)
+    assert np.all(np.abs(estimator.medians - medians) < 0.05*mads)
+    np.testing.assert_allclose(estimator.mads, mads, rtol=0.05)
+    
+    # noise is doubled and shifted: follow it after some time constants
+    for i in range(200):
+        chunk = rng.randn(chunksize, nb_channel) * mads * 2 + medians + mads
+        estimator.new_chunk(chunk)
+    assert np.all(np.abs(estimator.medians - (medians + mads)) < 0.1*mads)
+    np.testing.assert_allclose(estimator.mads, mads * 2, rtol=0.05)
+
+
+def allocated_bytes_per_chunk(engine, sigs, sample_rate, chunksize, nloop=50, **params):
+    # peak of memory allocated (traced by tracemalloc) inside process_data, mean over chunks
+    nb_channel = sigs.shape[1]
+    signalpreprocessor = signalpreprocessor_engines[engine](sample_rate, nb_channel, chunksize, sigs.dtype)
+    signalpreprocessor.change_params(**params)
+    
+    allocated = []
+    tracemalloc.start()
+    for i in range(nloop):
+        pos = (i+1)*chunksize
+        chunk = sigs[pos-chunksize:pos,:]
+        # clear_traces also reset the peak (reset_peak is python>=3.9 only)
+        tracemalloc.clear_traces()
+        pos2, preprocessed_chunk = signalpreprocessor.process_data(pos, chunk)
+        _, peak = tracemalloc.get_traced_memory()
+        allocated.append(peak)
+    tracemalloc.stop()
+    
+    # first chunks are warmup
+    return np.mean(allocated[5:])
+
+
+def test_numpy_inplace_engine():
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    sigs = np.tile(sigs, (1, 4)) # 56 channels
+    nb_channel = sigs.shape[1]
+    chunksize = 1024
+    params = {
+                'common_ref_removal' : False,
+                'highpass_freq': 300.,
+                'lowpass_freq': 4000.,
+                'smooth_size':0,
+                'output_dtype': 'float32',
+                'normalize' : True,
+                'lostfront_chunksize': 128,
+                'signals_medians' : np.zeros(nb_channel, dtype='float32'),
+                'signals_mads' : np.ones(nb_channel, dtype='float32') * 10.,
+                }
+    
+    engine_ref = signalpreprocessor_engines['numpy'](sample_rate, nb_channel, chunksize, sigs.dtype)
+    engine_ref.change_params(**params)
+    engine = signalpreprocessor_engines['numpy_inplace'](sample_rate, nb_channel, chunksize, sigs.dtype)
+    engine.change_params(**params)
+    
+    for i in range(20):
+        pos = (i+1)*chunksize
+        chunk = sigs[pos-chunksize:pos,:]
+        pos2_ref, preprocessed_chunk_ref = engine_ref.process_data(pos, chunk)
+        pos2, preprocessed_chunk = engine.process_data(pos, chunk)
+        assert pos2 == pos2_ref
+        if preprocessed_chunk_ref is None:
+            assert preprocessed_chunk is None
+        else:
+            assert preprocessed_chunk.dtype == 'float32'
+            # float32 filtering instead of float64
+            np.testing.assert_allclose(preprocessed_chunk, preprocessed_chunk_ref, atol=1e-4)
+    
+    allocated = {}
+    for name in ['numpy', 'numpy_inplace']:
+        allocated[name] = allocated_bytes_per_chunk(name, sigs, sample_rate, chunksize, **params)
+        print(name, 'allocated bytes per chunk', allocated[name])
+    assert allocated['numpy_inplace'] < allocated['numpy'] / 10
+
+
+def benchmark_allocation():
+    sigs, sample_rate = get_dataset(name='olfactory_bulb')
+    sigs = np.tile(sigs, (1, 28))[:, :384]
+    nb_channel = sigs.shape[1]
+    chunksize = 1024
+    for common_ref_removal in (False, True):
+        params = {
+                    'common_ref_removal' : common_ref_removal,
+                    'highpass_freq': 300.,
+                    'lowpass_freq': 5000.,
+                    'output_dtype': 'float32',
+                    'normalize' : True,
+                    'lostfront_chunksize': 128,
+                    'signals_medians' : np.zeros(nb_channel, dtype='float32'),
+                    'signals_mads' : np.ones(nb_channel, dtype='float32') * 10.,
+                    }
+        for engine in ['numpy', 'numpy_thread', 'numpy_inplace', 'fir', 'numba']:
+            allocated = allocated_bytes_per_chunk(engine, sigs, sample_rate, chunksize, **params)
+            
+            signalpreprocessor = signalpreprocessor_engines[engine](sample_rate, nb_channel, chunksize, sigs.dtype)
+            signalpreprocessor.change_params(**params)
+            nloop = sigs.shape[0]//chunksize
+            t1 = time.perf_counter()
+            for i in range(nloop):
+                pos = (i+1)*chunksize
+                signalpreprocessor.process_data(pos, sigs[pos-chunksize:pos,:])
+            t2 = time.perf_counter()
+            print('common_ref_removal', common_ref_removal, engine, 'allocated bytes per chunk {:.0f}'.format(allocated),
+                            'time per chunk {:.3f} ms'.format((t2-t1)/nloop*1000.))
+
+
 def explore_lostfront_chunksize():
 
     sigs, sample_rate = get_dataset(name='olfactory_bulb')
@@ -287,6 +529,116 @@ def test_smooth_with_filtfilt():
     
 
 
+def test_common_ref_modes():
+    # linear probe with 2 columns like neuropixel
+    nb_channel = 384
+    geometry = np.zeros((nb_channel, 2))
+    geometry[:, 0] = (np.arange(nb_channel) % 2) * 32.
+    geometry[:, 1] = (np.arange(nb_channel) // 2) * 20.
+    
+    sigs = np.random.randn(1024, nb_channel).astype('float32')
+    sigs += np.random.randn(1024, 1).astype('float32') * 5. # common noise
+    local_ref_matrix = make_local_ref_matrix(geometry, 100.)
+    
+    # reference implementations
+    d = np.sqrt(np.sum((geometry[:, None, :] - geometry[None, :, :])**2, axis=2))
+    local_mean = np.zeros(sigs.shape, dtype='float64')
+    for c in range(nb_channel):
+        neighbours, = np.nonzero((d[c] <= 100.) & (np.arange(nb_channel) != c))
+        local_mean[:, c] = np.mean(sigs[:, neighbours], axis=1)
+    expected = {
+        'median': sigs - np.median(sigs, axis=1)[:, None],
+        'mean': sigs - np.mean(sigs, axis=1)[:, None],
+        'local_mean': sigs - local_mean,
+    }
+    
+    for mode in ['median', 'mean', 'median_subset', 'local_mean']:
+        sigs2 = sigs.copy()
+        t1 = time.perf_counter()
+        substract_common_ref(sigs2, mode, local_ref_matrix=local_ref_matrix)
+        t2 = time.perf_counter()
+        print(mode, 'time', t2-t1)
+        if mode in expected:
+            assert np.allclose(sigs2, expected[mode], atol=1e-4)
+        else:
+            # approximation of median: common noise is removed
+            assert np.std(sigs2 - expected['median']) < 0.5
+    
+    # same in engines (and True is median)
+    sample_rate = 10000.
+    sigs = np.random.randn(1024*10, 16).astype('float32')
+    geometry = np.zeros((16, 2))
+    geometry[:, 1] = np.arange(16) * 50.
+    for common_ref_removal in [True, 'mean', 'median_subset', 'local_mean']:
+        params = {
+                    'common_ref_removal' : common_ref_removal,
+                    'highpass_freq': 300.,
+                    'lowpass_freq': 4000.,
+                    'output_dtype': 'float32',
+                    'normalize' : False,
+                    'lostfront_chunksize': 128,
+                    'geometry': geometry,
+                    }
+        offline_sig = offline_signal_preprocessor(sigs, sample_rate, **params)
+        engines = ['numpy', 'numpy_thread', 'numpy_inplace']
+        if HAVE_NUMBA:
+            engines.append('numba')
+        for engine in engines:
+            SignalPreprocessorClass = signalpreprocessor_engines[engine]
+            signalpreprocessor = SignalPreprocessorClass(sample_rate, 16, 1024, sigs.dtype)
+            signalpreprocessor.change_params(**params)
+            all_online_sigs = []
+            for i in range(sigs.shape[0]//1024):
+                pos = (i+1)*1024
+                pos2, preprocessed_chunk = signalpreprocessor.process_data(pos, sigs[pos-1024:pos,:])
+                if preprocessed_chunk is not None:
+                    all_online_sigs.append(preprocessed_chunk.copy())
+            online_sig = np.concatenate(all_online_sigs)
+            residual = np.abs(online_sig[1024:] - offline_sig[1024:online_sig.shape[0]])
+            assert np.max(residual) < 0.05 * np.max(np.abs(offline_sig)), (common_ref_removal, engine)
+
+
+def test_decimation():
+    sample_rate = 30000.
+    rng = np.random.RandomState(42)
+    sigs = rng.randn(1024*30, 16).astype('float32')
+    params = {
+                'common_ref_removal' : 'mean',
+                'highpass_freq': 300.,
+                'lowpass_freq': None,
+                'output_dtype': 'float32',
+                'normalize' : False,
+                'lostfront_chunksize': 301,
+                'decimation_factor': 2,
+                }
+    offline_sig = offline_signal_preprocessor(sigs, sample_rate, **params)
+    assert offline_sig.shape[0] == sigs.shape[0] // 2
+    
+    engines = ['numpy', 'numpy_thread', 'numpy_inplace']
+    if HAVE_NUMBA:
+        engines.append('numba')
+    for engine in engines:
+        SignalPreprocessorClass = signalpreprocessor_engines[engine]
+        signalpreprocessor = SignalPreprocessorClass(sample_rate, 16, 1024, sigs.dtype)
+        signalpreprocessor.change_params(**params)
+        # lostfront_chunksize is rounded to keep the same phase
+        assert signalpreprocessor.lostfront_chunksize == 302
+        assert signalpreprocessor.output_sample_rate == 15000.
+        all_online_sigs = []
+        for i in range(sigs.shape[0]//1024):
+            pos = (i+1)*1024
+            pos2, preprocessed_chunk = signalpreprocessor.process_data(pos, sigs[pos-1024:pos,:])
+            if preprocessed_chunk is not None:
+                # pos2 is in the decimated time base and chunks are contiguous
+                assert pos2 - preprocessed_chunk.shape[0] == sum(c.shape[0] for c in all_online_sigs)
+                all_online_sigs.append(preprocessed_chunk.copy())
+        online_sig = np.concatenate(all_online_sigs)
+        assert online_sig.shape[0] == (sigs.shape[0] - 302) // 2
+        residual = np.abs(online_sig[512:] - offline_sig[512:online_sig.shape[0]])
+        print(engine, 'max residual', np.max(residual) / np.max(np.abs(offline_sig)))
+        assert np.max(residual) < 0.05 * np.max(np.abs(offline_sig))
+
+
     
 if __name__ == '__main__':
     #~ test_compare_offline_online_engines()
@@ -295,4 +647,13 @@ if __name__ == '__main__':
     #~ explore_lostfront_chunksize()
     
     test_auto_lostfront_chunksize()
+    
+    #~ test_numpy_thread_engine()
+    #~ test_numpy_inplace_engine()
+    #~ test_fir_engine()
+    #~ test_numba_engine()
+    #~ test_running_noise_estimator()
+    #~ test_common_ref_modes()
+    #~ test_decimation()
+    #~ benchmark_allocation()
 
@@ -25,7 +25,8 @@ ON_CI_CLOUD = is_running_on_ci_cloud()
     
     
 
-def setup_catalogue(dirname, dataset_name='olfactory_bulb'):
+def setup_catalogue(dirname, dataset_name='olfactory_bulb', channel_groups=None):
+    # channel_groups : None for one group or dict chan_grp > channels (one catalogue per group)
     if os.path.exists(dirname):
         shutil.rmtree(dirname)
         
@@ -33,14 +34,21 @@ def setup_catalogue(dirname, dataset_name='olfactory_bulb'):
     localdir, filenames, params = download_dataset(name=dataset_name)
     dataio.set_data_source(type='RawData', filenames=filenames, **params)
     
-    if dataset_name=='olfactory_bulb':
-        channels = [5, 6, 7, 8, 9]
-    else:
-        channels = [0,1,2,3]
-    dataio.add_one_channel_group(channels=channels)
+    if channel_groups is None:
+        if dataset_name=='olfactory_bulb':
+            channels = [5, 6, 7, 8, 9]
+        else:
+            channels = [0,1,2,3]
+        channel_groups = {0: channels}
+    for chan_grp, channels in channel_groups.items():
+        dataio.add_one_channel_group(channels=channels, chan_grp=chan_grp)
     
-    
-    catalogueconstructor = CatalogueConstructor(dataio=dataio)
+    for chan_grp in channel_groups:
+        make_one_catalogue(dataio, chan_grp)
+
+
+def make_one_catalogue(dataio, chan_grp):
+    catalogueconstructor = CatalogueConstructor(dataio=dataio, chan_grp=chan_grp)
     
     
     fullchain_kargs = {
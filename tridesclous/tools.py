@@ -1,5 +1,4 @@
 import numpy as np
-import sklearn.metrics.pairwise
 import re
 from urllib.request import urlretrieve
 import zipfile
@@ -29,6 +28,33 @@ def median_mad(data, axis=0):
     return med, mad
 
 
+def get_good_channel_mask(signals_mads, low_ratio=0.1, high_ratio=10.):
+    """
+    Detect dead or noisy channels from the noise level of each channel.
+
+    A channel is bad when its mad is below low_ratio*median(mads) (dead, flat)
+    or above high_ratio*median(mads) (noisy).
+
+    Parameters
+    ----------
+    signals_mads: np.ndarray
+        mad of each channel (see median_mad)
+    low_ratio: float
+        Ratio to the median mad under which a channel is dead.
+    high_ratio: float
+        Ratio to the median mad over which a channel is noisy.
+
+    Returns
+    ----------
+    channel_mask: np.ndarray bool
+        True for good channels.
+    """
+    signals_mads = np.asarray(signals_mads)
+    ref = np.median(signals_mads)
+    channel_mask = (signals_mads >= low_ratio * ref) & (signals_mads <= high_ratio * ref)
+    return channel_mask
+
+
 def get_pairs_over_threshold(m, labels, threshold):
     """
     detect pairs over threhold in a similarity matrice
@@ -55,7 +81,10 @@ class FifoBuffer:
     This is not efficient if shape[0]is lot greater than chunksize.
     But if shape[0]=chunksize+smallsize, it should be OK.
     
-    
+    In that case each new_chunk only copy smallsize rows in addition to
+    the new chunk itself. A circular buffer with contiguous views (double
+    length with mirrored writes, or moving head with periodic compaction)
+    is not faster in this case: it write more or break cache locality.
     """
     def __init__(self, shape, dtype):
         self.buffer = np.zeros(shape, dtype=dtype)
@@ -98,6 +127,7 @@ def get_neighborhood(geometry, radius_um):
     neighborhood: boolean numpy array (nb_channel, nb_channel)
     
     """
+    import sklearn.metrics.pairwise
     d = sklearn.metrics.pairwise.euclidean_distances(geometry)
     return d<=radius_um
 